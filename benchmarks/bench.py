@@ -0,0 +1,217 @@
+"""
+Offline microbenchmarks of the hot code paths. Every size runs against a fresh temporary SQLite file, the google
+sheets are replaced by in-memory worksheets, so neither credentials nor a network are needed (muddi/secrets.py
+still has to exist). Results are written as JSON and can be compared with the results of another commit:
+
+    python -m benchmarks.bench --size 1000:100 --size 100000:10000 -o new.json
+    python -m benchmarks.bench --compare old.json new.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+import muddi.database.db as db_module
+import muddi.spreadsheet as sh
+from muddi.database.db import DB
+from muddi.models import User, Training, Schedule
+from muddi.utils.embeds import posting_embed
+from tests import Member
+
+weekdays = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+class Worksheet:
+    """ In-memory stand-in for gspread.Worksheet, records are laid out like the real sheets """
+    def __init__(self, records: List[Dict[str, str]]):
+        self.records = records
+
+    def get_all_records(self, head=1):
+        return [dict(r) for r in self.records]
+
+
+class Client:
+    """ In-memory stand-in for gspread.Client, opens any key and returns the worksheets by title """
+    def __init__(self, worksheets: Dict[str, Worksheet]):
+        self.worksheets = worksheets
+
+    def open_by_key(self, key):
+        return self
+
+    def worksheet(self, title):
+        return self.worksheets[title]
+
+
+class Data:
+    """ Generated users, trainings and schedules of one size, with random registrations """
+    def __init__(self, users: int, trainings: int, participants: int, seed=0):
+        rnd = random.Random(seed)
+        self.players = [{sh.u_name: f"player {i}", sh.discord_tag: f"player{i}#{i % 10000:04}",
+                         sh.gender: rnd.choice("wm"), sh.member_type: rnd.choice([sh.EICHE, sh.UNI])}
+                        for i in range(users - users // 10)]
+        self.guests = [{sh.u_name: f"guest {i}", sh.discord_tag: "", sh.gender: rnd.choice("wm"),
+                        sh.member_type: sh.GUEST} for i in range(users // 10)]
+        self.members = [Member(i + 1, r[sh.u_name], r[sh.discord_tag]) for i, r in enumerate(self.players)]
+        self.schedules = [Schedule(weekdays[i % 7], f"{17 + i % 4}:00", f"{19 + i % 4}:00", f"coach {i}",
+                                   f"location {i}", "", weekdays[(i + 3) % 7]) for i in range(20)]
+        self.reference = datetime(2020, 9, 28)
+        start = self.reference - timedelta(days=trainings)
+        self.trainings = [(start + timedelta(days=i, hours=18), start + timedelta(days=i, hours=20),
+                           f"location {i % 20}", f"coach {i % 20}", "", 0, 1000 + i) for i in range(trainings)]
+        self.participants = participants
+        self.rnd = rnd
+
+    def client(self) -> Client:
+        return Client({sh.players_title: Worksheet(self.players), sh.guests_title: Worksheet(self.guests)})
+
+    def seed(self):
+        """ Fills the current database: users from the sheet and members, trainings and their participants """
+        User.update_from_sheet()
+        User.update_from_discord_members(self.members)
+        db = DB()
+        users = db.select("SELECT user_id, gender, member_type FROM users")
+        with db.transaction():
+            db.commit_many(""" INSERT INTO trainings(start, end, location, coach, description, cancelled, message_id)
+                VALUES(?,?,?,?,?,?,?)""", self.trainings)
+            training_ids = [r[0] for r in db.select("SELECT training_id FROM trainings")]
+            count = min(self.participants, len(users))
+            db.commit_many("INSERT INTO participants(user_id, training_id, gender, member_type) VALUES(?,?,?,?)",
+                           [(u, t, g, m) for t in training_ids for u, g, m in self.rnd.sample(users, count)])
+        # schedules of the reference week have been posted already
+        for s in self.schedules[::2]:
+            tr = s.next_training(self.reference)
+            tr.message_id = 10 ** 9 + self.schedules.index(s)
+            tr.insert()
+
+
+def measure(func: Callable, repeat: int, setup: Callable = None) -> Dict[str, float]:
+    """ Milliseconds per call, setup runs before every call and isn't timed """
+    samples = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        t = time.perf_counter()
+        func(*args)
+        samples.append((time.perf_counter() - t) * 1000)
+    return {"min": min(samples), "median": statistics.median(samples), "mean": statistics.mean(samples),
+            "repeat": repeat}
+
+
+def run_size(users: int, trainings: int, participants: int, repeat: int, lookups: int) -> Dict[str, Dict]:
+    data = Data(users, trainings, participants)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        default_path = db_module.database_path
+        db_module.database_path = os.path.join(directory, "bench.db")
+        sh.reset()
+        sh._client = data.client()
+        try:
+            DB().setup()
+            # the first sync inserts everyone, only measured once as it can't be repeated on the same database
+            results["update_from_sheet.insert"] = measure(User.update_from_sheet, 1)
+            results["update_from_sheet.unchanged"] = measure(User.update_from_sheet, repeat)
+            results["update_from_discord_members.ids"] = measure(User.update_from_discord_members, 1,
+                                                                 lambda: (data.members,))
+            results["update_from_discord_members.unchanged"] = measure(User.update_from_discord_members, repeat,
+                                                                       lambda: (data.members,))
+            data.seed()
+            training_ids = [r[0] for r in DB().select("SELECT training_id FROM trainings")]
+            message_ids = [r[-1] for r in data.trainings]
+
+            def fresh_training():
+                return Training.get_for_id(data.rnd.choice(training_ids)),
+            results["Training.participants"] = measure(lambda tr: tr.participants, repeat, fresh_training)
+            results["Training.get_for_message_ids"] = measure(
+                Training.get_for_message_ids, repeat, lambda: (data.rnd.sample(message_ids, min(lookups,
+                                                                                               len(message_ids))),))
+            results["Schedule.scheduled"] = measure(
+                lambda: [s.scheduled() for s in data.schedules], repeat)
+            results["Schedule.scheduled_trainings"] = measure(
+                lambda: Schedule.scheduled_trainings(data.schedules, data.reference), repeat)
+
+            def loaded_training():
+                tr = Training.get_for_id(data.rnd.choice(training_ids))
+                return tr, [(u.name, u.discord_tag, u.gender) for u in tr.participants]
+            results["posting_embed"] = measure(
+                lambda tr, rows: posting_embed(tr, rows, "👍", tr.gender_counts).to_dict(), repeat, loaded_training)
+        finally:
+            DB().close()
+            sh.reset()
+            db_module.database_path = default_path
+    return results
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run(sizes: List[str], participants: int, repeat: int, lookups: int) -> Dict:
+    report = {"meta": {"commit": commit(), "date": datetime.now().isoformat(timespec="seconds"),
+                       "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                       "participants": participants, "repeat": repeat, "lookups": lookups},
+              "results": {}}
+    for size in sizes:
+        users, trainings = (int(x) for x in size.split(":"))
+        print(f"{users} users, {trainings} trainings", file=sys.stderr)
+        for name, result in run_size(users, trainings, participants, repeat, lookups).items():
+            report["results"][f"{name}[{size}]"] = result
+            print(f"  {name}: {result['median']:.2f} ms", file=sys.stderr)
+    return report
+
+
+def compare(old: Dict, new: Dict, threshold: float) -> bool:
+    """ Prints the ratio of the medians, :return: False if a benchmark got slower than the threshold """
+    ok = True
+    for name, result in new["results"].items():
+        if name not in old["results"]:
+            continue
+        ratio = result["median"] / max(old["results"][name]["median"], 1e-6)
+        slower = ratio > threshold
+        ok &= not slower
+        print(f"{'SLOWER ' if slower else ''}{name}: {old['results'][name]['median']:.2f} ms -> "
+              f"{result['median']:.2f} ms ({ratio:.2f}x)")
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", action="append", metavar="USERS:TRAININGS",
+                        help="data size to run, can be given several times (default 100:10, 1000:100, 10000:1000)")
+    parser.add_argument("--participants", type=int, default=30, help="registrations per training")
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls per benchmark")
+    parser.add_argument("--lookups", type=int, default=50, help="message ids per get_for_message_ids call")
+    parser.add_argument("-o", "--output", help="JSON file for the results, printed if not given")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown of the median that fails --compare")
+    args = parser.parse_args(argv)
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            return 0 if compare(json.load(old), json.load(new), args.threshold) else 1
+    # keep stdout for the JSON, the models print their messages
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run(args.size or ["100:10", "1000:100", "10000:1000"], args.participants, args.repeat,
+                     args.lookups)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,96 +1,229 @@
 import discord
 from discord.ext import commands
 from muddi import secrets
-from muddi.bot import Muddi
+from muddi.bot import Muddi, ShardedMuddi, GuildState
+from muddi.database import executor
+from muddi.database import db as database
 from muddi.database.db import DB
-from muddi.models import User, Training
+from muddi.models import User, Training, Stats, Guild
 from muddi import spreadsheet as sh
-from copy import deepcopy
-from datetime import datetime
-import tempfile
-from muddi.utils.embeds import cancel_embed, posting_embed
+from muddi.utils.export import csv_buffer
+from muddi.utils.metrics import metrics
+from datetime import datetime, timedelta
 
 DB().setup()
-muddi = Muddi(command_prefix='.',)
+# statement statistics and slow query log, can be switched on and off with the queries command as well
+query_log_path = getattr(secrets, "query_log", None) or secrets.database_path + ".queries.jsonl"
+if getattr(secrets, "query_log", None):
+    database.enable_query_log(query_log_path, getattr(secrets, "query_log_threshold", 100) / 1000)
+metrics_server = None
+# one process serves every configured guild, sharded if there are too many for one gateway connection
+bot_class = ShardedMuddi if getattr(secrets, "sharded", False) else Muddi
+muddi = bot_class(command_prefix='.', backup_dir=getattr(secrets, "backup_dir", None),
+                  backup_interval=getattr(secrets, "backup_interval", 24),
+                  backup_keep=getattr(secrets, "backup_keep", 7), instance=getattr(secrets, "instance", None),
+                  lease_duration=getattr(secrets, "lease_duration", 30),
+                  registration_journal=getattr(secrets, "registration_journal",
+                                               f"{database.database_path}.registrations"))
 
 
 @muddi.event
 async def on_ready():
-    guild: discord.Guild = muddi.get_guild(secrets.guild_id)
-    muddi.guild = guild
-    muddi.posting_channel = guild.get_channel(secrets.posting_channel)
-    muddi.managing_channel = guild.get_channel(secrets.managing_channel)
+    # commits what a crash left in the journal before any participants are loaded
+    await muddi.registrations.start()
+    await muddi.start_guilds()
+    # reactions missed while offline, before the scheduler and the sync touch the trainings
+    for added, reaction in await muddi.reconcile():
+        await (on_raw_reaction_add if added else on_raw_reaction_remove)(reaction)
     print("Logged in as")
     print(muddi.user.name)
     print(muddi.user.id)
+    print(f"Serving {', '.join(str(state.guild) for state in muddi.guild_states.values())}")
     print('--------')
-    muddi.schedule_loop.start()
+    # on_ready is called again after reconnects. The leader lease decides whether this instance runs the scheduler.
+    if not muddi.leader_loop.is_running():
+        muddi.leader_loop.start()
+    # Prometheus endpoint, only if a port is configured in the secrets
+    global metrics_server
+    if (port := getattr(secrets, "metrics_port", None)) and not metrics_server:
+        metrics_server = await metrics.serve(port=port)
 
 @muddi.event
+@metrics.timed("event", event="on_member_join")
 async def on_member_join(member: discord.Member):
-    if member.guild.id == muddi.guild.id:
-        User.sync(muddi.guild.members)
+    await muddi.on_member_change(member)
 
 @muddi.event
+@metrics.timed("event", event="on_member_update")
+async def on_member_update(before: discord.Member, after: discord.Member):
+    if str(before) != str(after):
+        await muddi.on_member_change(after)
+
+@muddi.event
+@metrics.timed("event", event="on_user_update")
+async def on_user_update(before: discord.User, after: discord.User):
+    # name#discriminator changes are only sent as user updates, once for all guilds
+    if str(before) != str(after):
+        for state in list(muddi.guild_states.values()):
+            if member := state.guild.get_member(after.id):
+                await muddi.on_member_change(member)
+
+@muddi.event
+@metrics.timed("event", event="on_member_remove")
+async def on_member_remove(member: discord.Member):
+    # the user is kept for the attendance history, but the posts can't mention them anymore
+    if state := muddi.state(member.guild.id):
+        for training in state.registry.values():
+            if training.has_member(member.id) and not training.cancelled:
+                muddi.update_training_post(training)
+
+@muddi.event
+@metrics.timed("event", event="on_message_delete")
 async def on_message_delete(message: discord.Message):
-    if message.id in muddi.message_ids:
-        training = Training.get_for_message_ids([message.id])[0]
+    muddi.forget_post(message.id)
+    if (state := muddi.state(message.guild.id if message.guild else None)) and \
+            (training := state.registry.get(message.id)):
         if not training.cancelled:
             training_id = training.training_id
-            await muddi.managing_channel.send(content="Live training message has been deleted,"
+            await state.managing_channel.send(content="Live training message has been deleted,"
                                                   " which means that participants tracking doesn't work now. "
                                                   f"Enter ```.training cancel {training_id}``` to avoid errors and then"
                                                   f"```.training uncancel {training_id}``` if you want to post again.")
 
 @muddi.event
+@metrics.timed("event", event="on_raw_reaction_add")
 async def on_raw_reaction_add(reaction: discord.RawReactionActionEvent):
-    if not muddi.trainings_lock.acquire(timeout=5):
-        print("couldn't acquire trainings lock")
+    if muddi.hold_reaction(reaction, added=True):
         return
-    if str(reaction.emoji) == muddi.add_emoji and reaction.message_id in muddi.message_ids and reaction.user_id != muddi.user.id:
-        training = Training.get_for_message_ids([reaction.message_id])[0]
-        if any(p.discord_id == reaction.user_id for p in training.participants):
-            return
-        user = User.get_for_discord_id_or_tag(reaction.user_id, "no tag")
-        if not user:
-            uid = User(None, name=reaction.member.display_name, discord_tag=str(reaction.member)).insert()
-        else:
-            uid = user.user_id
-        training.add_participant(uid)
-        muddi.trainings_lock.release()
-        if training.cancelled or any(p.discord_id == reaction.user_id for p in training.participants):
-            return
-        await muddi.update_training_post(training)
-    else:
-        muddi.trainings_lock.release()
+    if str(reaction.emoji) == muddi.add_emoji and reaction.user_id != muddi.user.id and \
+            (state := muddi.state(reaction.guild_id)) and (training := state.registry.get(reaction.message_id)):
+        async with muddi.training_locks(training.training_id):
+            if training.has_member(reaction.user_id):
+                return
+            if not await muddi.registrations.add_member(training, reaction.user_id, reaction.member.display_name,
+                                                        str(reaction.member)):
+                return
+            if training.cancelled:
+                return
+            muddi.update_training_post(training)
 
 
 @muddi.event
+@metrics.timed("event", event="on_raw_reaction_remove")
 async def on_raw_reaction_remove(reaction: discord.RawReactionActionEvent):
-    if not muddi.trainings_lock.acquire(timeout=5):
-        print("couldn't acquire trainings lock")
+    if muddi.hold_reaction(reaction, added=False):
         return
-    if str(
-            reaction.emoji) == muddi.add_emoji and reaction.message_id in muddi.message_ids and reaction.user_id != muddi.user.id:
-        training = Training.get_for_message_ids([reaction.message_id])[0]
-        training.remove_participant(User.get_for_discord_id_or_tag(reaction.user_id).user_id)
-        if training.cancelled:
-            return
-        muddi.trainings_lock.release()
-        await muddi.update_training_post(training)
-    else:
-        muddi.trainings_lock.release()
+    if str(reaction.emoji) == muddi.add_emoji and reaction.user_id != muddi.user.id and \
+            (state := muddi.state(reaction.guild_id)) and (training := state.registry.get(reaction.message_id)):
+        async with muddi.training_locks(training.training_id):
+            if not (user := training.participant_for_member(reaction.user_id)):
+                return
+            muddi.registrations.remove(training, user)
+            if training.cancelled:
+                return
+            muddi.update_training_post(training)
 
 
 def check_channel(ctx: commands.Context):
-    return ctx.channel.id == secrets.managing_channel
+    """ Commands about trainings and users are given in the managing channel of the guild """
+    return ctx.guild is not None and (state := muddi.state(ctx.guild.id)) is not None \
+        and ctx.channel.id == state.config.managing_channel
+
+
+def check_operator_channel(ctx: commands.Context):
+    """ Commands about the bot and the database shared by all guilds, only in the managing channel of the operator """
+    return ctx.channel.id == getattr(secrets, "managing_channel", None)
+
+
+def guild_state(ctx: commands.Context) -> GuildState:
+    return muddi.state(ctx.guild.id)
+
+
+@muddi.group(name="guild", invoke_without_command=True)
+@commands.guild_only()
+@commands.has_guild_permissions(administrator=True)
+async def _guild(ctx: commands.Context):
+    """ Shows the bot's configuration of this guild, for administrators """
+    if not (config := await executor.read(Guild.get_for_id, ctx.guild.id)):
+        await ctx.send(content="This guild isn't set up yet, use `guild setup`")
+        return
+    await ctx.send(content=f"Posting channel: <#{config.posting_channel}>, managing channel: "
+                           f"<#{config.managing_channel}>, schedule sheet: {config.schedule_key}, "
+                           f"club sheet: {config.club_key}")
+
+
+@_guild.command(name="setup")
+async def guild_setup(ctx: commands.Context, posting_channel: discord.TextChannel,
+                      managing_channel: discord.TextChannel, schedule_key: str, club_key: str):
+    """ Sets up the bot for this guild: `guild setup #posting #managing <schedule sheet key> <club sheet key>`.
+    The sheets have to be shared with the bot's service account."""
+    config = Guild(ctx.guild.id, posting_channel.id, managing_channel.id, schedule_key, club_key)
+    if not await config.asave():
+        await ctx.send(content="Something went wrong! Try again or contact admin.")
+        return
+    await muddi.start_guild(config)
+    await ctx.send(content=f"{ctx.author.mention}, trainings are posted in {posting_channel.mention} and managed in "
+                           f"{managing_channel.mention}.")
 
 @muddi.command()
-@commands.check(check_channel)
-async def dump(ctx: commands.Context):
-    """ Get the database (SQLite3) sent as DM """
-    with open(secrets.database_path, 'rb') as data_dump:
-        await ctx.author.send(file=discord.File(data_dump, 'dump.db'))
+@commands.check(check_operator_channel)
+async def dump(ctx: commands.Context, compress: str = ""):
+    """ Get a consistent copy of the database (SQLite3) sent as DM, `dump gzip` compresses it """
+    compress = compress == "gzip"
+    buffer = await executor.background(DB().snapshot, compress)
+    await ctx.author.send(file=discord.File(buffer, f"dump.db{'.gz' if compress else ''}"))
+
+
+@muddi.command(name="metrics")
+@commands.check(check_operator_channel)
+async def show_metrics(ctx: commands.Context, match: str = ""):
+    """ Latencies of commands, events, database statements, sheet and Discord calls and lock waits since the start.
+    Filter them with e.g. `metrics db` or `metrics training`."""
+    lines, text = metrics.summary(match), ""
+    for line in lines:
+        # stay below discord's message limit
+        if len(text) + len(line) > 1900:
+            break
+        text += line + "\n"
+    await ctx.send(content=f"```{text}```" if text else "Nothing recorded yet")
+
+
+@muddi.group(name="queries", invoke_without_command=True)
+@commands.check(check_operator_channel)
+async def queries(ctx: commands.Context):
+    """ Database statements taking the most time since the query log was enabled """
+    if ctx.invoked_subcommand is None:
+        if not (log := database.query_log):
+            await ctx.send(content="The query log is off, enable it with `queries on`")
+            return
+        lines = log.top()
+        text = ""
+        for line in lines:
+            if len(text) + len(line) > 1900:
+                break
+            text += line + "\n"
+        await ctx.send(content=f"```{text}```" if text else "Nothing recorded yet")
+
+
+@queries.command(name="on")
+async def queries_on(ctx: commands.Context, threshold: int = 100):
+    """ Record statements, the ones slower than threshold milliseconds are logged with their query plan """
+    database.enable_query_log(query_log_path, threshold / 1000)
+    await ctx.send(content=f"Logging statements slower than {threshold} ms to {query_log_path}")
+
+
+@queries.command(name="off")
+async def queries_off(ctx: commands.Context):
+    database.disable_query_log()
+    await ctx.send(content="Query log is off")
+
+
+@queries.command(name="reset")
+async def queries_reset(ctx: commands.Context):
+    """ Forget the statistics and query plans recorded so far """
+    if log := database.query_log:
+        log.reset()
+    await ctx.send(content=f"{ctx.author.mention}")
 
 
 @muddi.group(name="training")
@@ -103,99 +236,90 @@ async def _training(ctx):
 @_training.command()
 async def active(ctx):
     """ Active training posts from today to next week"""
-    tr = Training.select_next_trainings(include_cancelled=True)
+    state = guild_state(ctx)
+    # watched trainings have their participants loaded already, the rest is loaded at once
+    tr = [state.registry.get_for_id(t.training_id) or t
+          for t in await Training.aselect_next_trainings(include_cancelled=True, guild_id=state.guild_id)]
+    await Training.aload_participants(tr)
     embed = discord.Embed(title="Posted trainings of today and the next week")
     fmt = "%A, %d. %b %Y %H:%Mh"
     for t in tr:
         c = "[CANCELLED] " if t.cancelled else ""
-        message = await muddi.posting_channel.fetch_message(t.message_id)
         embed.add_field(name=f"ID: {t.training_id} - {c}{t.start.strftime(fmt)} {t.location} with {t.coach}"
-                             f" - currently {len(t.participants)} participants", value=message.jump_url, inline=False)
+                             f" - currently {len(t.participants)} participants", value=state.jump_url(t.message_id),
+                        inline=False)
     await ctx.send(embed=embed)
 
 
 @_training.command(name="csv")
-async def training_csv(ctx: commands.Context, training_id):
-    """ Receive a csv listing all participants of the given training. """
-    if not muddi.trainings_lock.acquire():
-        print("Couldn't acquire trainings lock")
+async def training_csv(ctx: commands.Context, *selection: str):
+    """ Receive a csv listing all participants of the given trainings.
+    Select them by IDs (`csv 12 13 14`) or a date range (`csv 2020-09-01 2020-12-31`), add `gzip` to compress."""
+    compress = "gzip" in selection
+    selection = [s for s in selection if s != "gzip"]
+    try:
+        if len(selection) == 2 and all("-" in s for s in selection):
+            since, until = (datetime.strptime(s, "%Y-%m-%d") for s in selection)
+            # the end day is included
+            rows = Training.attendance(since=since, until=until + timedelta(days=1), guild_id=ctx.guild.id)
+            name = "-".join(selection)
+        else:
+            training_ids = [int(s) for s in selection]
+            if not training_ids:
+                raise ValueError
+            rows, name = Training.attendance(training_ids=training_ids, guild_id=ctx.guild.id), "-".join(selection)
+            if len(training_ids) == 1 and (training := await muddi.get_training(training_ids[0], ctx.guild.id)):
+                name = f"{training.start.strftime('%Y-%m-%d-%H-%M')}-{training.location}" \
+                       f"{('-' + training.coach).strip().replace(' ', '-') if training.coach else ''}" \
+                       f"{'-cancelled' if training.cancelled else ''}"
+    except ValueError:
+        await ctx.send(content="Enter training IDs or a date range like `2020-09-01 2020-12-31`!")
         return
-
-    def quotes(x):
-        return f"\"{x}\""
-
-    if training := Training.get_for_id(training_id):
-        participants = deepcopy(training.participants)
-        filename = f"{training.start.strftime('%Y-%m-%d-%H-%M')}-" \
-                   f"{training.location}{('-' + training.coach).strip().replace(' ', '-') if training.coach else ''}" \
-                   f"{'-cancelled' if training.cancelled else ''}.csv"
-        muddi.trainings_lock.release()
-        tf = tempfile.NamedTemporaryFile()
-        tf.write("name,member type\n".encode('UTF-8'))
-        tf.writelines((",".join([quotes(u.name), quotes(u.member_type)]) + "\n").encode('UTF-8') for u in participants)
-        tf.flush()
-        with open(tf.name, 'rb') as file:
-            await ctx.author.send(content="here's your file", file=discord.File(file, filename=filename))
-        tf.close()
-    else:
-        muddi.trainings_lock.release()
+    buffer = await executor.read(csv_buffer, Training.attendance_header, rows, compress)
+    filename = f"{name}.csv{'.gz' if compress else ''}"
+    await ctx.author.send(content="here's your file", file=discord.File(buffer, filename=filename))
 
 
 @_training.command(name="no-show")
 @commands.check(check_channel)
-async def no_show(ctx: commands.Context, training_id, user_tag):
+async def no_show(ctx: commands.Context, training_id: int, user_tag):
     """ Marks users as dirty no-show. Shame on them! """
-    if not muddi.trainings_lock.acquire(timeout=5):
-        print("couldn't acquire trainings lock")
-        return
     try:
         # just to be safe
         user_tag = str(await commands.MemberConverter().convert(ctx, user_tag))
-        if tr := Training.get_for_id(training_id):
-            if usr := next((u for u in tr.participants if u.discord_tag == user_tag)):
-                tr.no_show(usr.user_id)
-                await ctx.send(content=f"{ctx.author.mention}")
+        async with muddi.training_locks(training_id):
+            if tr := await muddi.get_training(training_id, ctx.guild.id):
+                if usr := next((u for u in await tr.aparticipants() if u.discord_tag == user_tag), None):
+                    await tr.ano_show(usr.user_id)
+                    await ctx.send(content=f"{ctx.author.mention}")
     except commands.BadArgument as e:
         await ctx.send(content="Invalid tag!")
     except commands.CommandError:
         await ctx.send(content="Something went wrong! Try again or contact admin.")
-    finally:
-        muddi.trainings_lock.release()
 
 
 @_training.command()
 async def cancel(ctx: commands.Context, training_id: int):
     """ Cancel a training that has been posted and has not ended more than 23 hours ago."""
-    if not muddi.trainings_lock.acquire(timeout=5):
-        print("couldn't acquire trainings lock")
-        return
-    if tr := Training.get_for_id(training_id):
+    async with muddi.training_locks(training_id):
+        if not (tr := await muddi.get_training(training_id, ctx.guild.id)):
+            return
         if tr.cancelled == 1:
             await ctx.send(content=f"{ctx.author.mention}, training #{training_id} has been cancelled already!")
-            muddi.trainings_lock.release()
             return
         tr.cancelled = 1
-        tr.update()
-        muddi.trainings_lock.release()
-        message_id = tr.message_id
-        embed = cancel_embed(tr)
-        discord_tags = [f"@{p.discord_tag}" for p in tr.participants if p.discord_tag]
-        post = await muddi.posting_channel.fetch_message(message_id)
-        await post.edit(embed=embed)
+        await tr.aupdate()
+        discord_tags = [f"@{p.discord_tag}" for p in await tr.aparticipants() if p.discord_tag]
+        muddi.update_training_post(tr)
         broadcast = f" Use ```" \
                     f"{' '.join(discord_tags)}``` to notify all participants (except guests)." if discord_tags else ""
         await ctx.send(f"{ctx.author.mention}, training #{training_id} has been cancelled.{broadcast}")
-    else:
-        muddi.trainings_lock.release()
 
 @_training.command()
 async def uncancel(ctx: commands.Context, training_id: int):
     """ Reactivates the training instance. Posts a new message, if the old one was deleted. """
-    if not muddi.trainings_lock.acquire(timeout=5):
-        print("couldn't acquire trainings lock")
-        return
-    if tr := Training.get_for_id(training_id):
-        muddi.trainings_lock.release()
+    async with muddi.training_locks(training_id):
+        tr = await muddi.get_training(training_id, ctx.guild.id)
         if not tr:
             await ctx.send(content=f"{ctx.author}, I couldn't find a training under this id!")
             return
@@ -205,35 +329,43 @@ async def uncancel(ctx: commands.Context, training_id: int):
 
         tr.cancelled = 0
         try:
-            await muddi.posting_channel.fetch_message(tr.message_id)
-            muddi.message_ids.append(tr.message_id)
-            await muddi.update_training_post(tr)  # hopefully won't lead to inconsistencies :S
-            tr.update()
+            await muddi.get_post(tr)
+            await muddi.watch(tr)
+            muddi.update_training_post(tr)  # hopefully won't lead to inconsistencies :S
+            await tr.aupdate()
             await ctx.send(content=f"{ctx.author.mention}, training #{training_id} has been uncancelled.")
 
         except discord.NotFound:
-            await muddi.post_training(tr)  # new message ID is going to be added in this method
-            await muddi.update_training_post(tr)
+            await muddi.post_training(tr)  # new message ID is going to be watched in this method
+            muddi.update_training_post(tr)
             await ctx.send(content=f"{ctx.author.mention}, I posted a new message, since the old one was deleted.")
 
 
+@_training.command()
+async def reload(ctx):
+    """ Rereads the schedules from the sheet right away instead of at the next refresh """
+    state = guild_state(ctx)
+    await muddi.reload_schedules(state)
+    await ctx.send(content=f"{ctx.author.mention}, {len(state.schedules)} schedules loaded.")
+
+
 @_training.group("set")
 async def training_set(ctx):
     """ Use to change coach or description"""
 
 
 async def training_set_attribute(ctx, training_id: int, attr: str, new_value):
-    if not muddi.trainings_lock.acquire(timeout=5):
-        print("couldn't acquire lock!")
-        return
-    training = Training.get_for_id(training_id)
-    if not training:
-        await ctx.send(content=f"Training with ID {training_id} doesn't exist!")
-        return
-    setattr(training, attr, new_value)
-    training.update()
-    muddi.trainings_lock.release()
-    await muddi.update_training_post(training)
+    async with muddi.training_locks(training_id):
+        training = await muddi.get_training(training_id, ctx.guild.id)
+        if not training:
+            await ctx.send(content=f"Training with ID {training_id} doesn't exist!")
+            return
+        setattr(training, attr, new_value)
+        await training.aupdate()
+        if training.message_id in guild_state(ctx).registry:
+            # the end might have moved
+            await muddi.watch(training)
+        muddi.update_training_post(training)
     await ctx.send(content="Successfully changed training!")
 
 
@@ -259,7 +391,7 @@ async def training_set_start(ctx, training_id: int, start: str):
     """ Change the start time in HH:MM format """
     try:
         t = datetime.strptime(start, "%H:%M")
-        new_time = Training.get_for_id(training_id).start.replace(hour=t.hour, minute=t.minute)
+        new_time = (await muddi.get_training(training_id, ctx.guild.id)).start.replace(hour=t.hour, minute=t.minute)
         await training_set_attribute(ctx, training_id=training_id, attr="start", new_value=new_time)
     except ValueError:
         await ctx.send(content="Wrong format! Example: 20:15")
@@ -269,7 +401,7 @@ async def training_set_end(ctx, training_id: int, end: str):
     """ Change the end time in HH:MM format """
     try:
         t = datetime.strptime(end, "%H:%M")
-        new_time = Training.get_for_id(training_id).end.replace(hour=t.hour, minute=t.minute)
+        new_time = (await muddi.get_training(training_id, ctx.guild.id)).end.replace(hour=t.hour, minute=t.minute)
         await training_set_attribute(ctx, training_id=training_id, attr="end", new_value=new_time)
     except ValueError:
         await ctx.send(content="Wrong format! Example: 20:15")
@@ -293,65 +425,125 @@ async def training_remove(ctx):
 async def add_guest(ctx, training_id: int, guest_rowid: int):
     """ Add a guest to the list. The spreadsheet id is the row number taken from
     https://docs.google.com/spreadsheets/d/1EBDeTRijlMmmbAiXnrs05RyveKYRahykTnVJ4x1RMG4/edit?usp=sharing"""
-    sheet = sh.Spreadsheet()
-    if not (guest_row := sheet.get_guest_at_row(row_id=guest_rowid)) or guest_row[sh.member_type] != sh.GUEST:
+    config = guild_state(ctx).config
+    sheet = config.spreadsheet()
+    if not (guest_row := await executor.read(sheet.get_guest_at_row, row_id=guest_rowid)) or guest_row[sh.member_type] != sh.GUEST:
         await ctx.send(content="The referenced row isn't a valid guest entry!")
         return
+    # check if guest is in database
+    user = await User.aget_guest_for_name(guest_row[sh.u_name], ctx.guild.id)
+    if not user:
+        await User.aupdate_from_sheet(config)
+        user = await User.aget_guest_for_name(guest_row[sh.u_name], ctx.guild.id)
     # while the training is being worked on, it shouldn't be altered in the database
-    if not muddi.trainings_lock.acquire(timeout=5):
-        print("couldn't acquire trainings lock")
-        return
-    tr: Training = Training.get_for_id(training_id)
-    if not tr:
-        await ctx.send(content=f"Training: with ID {training_id} not found!")
-    else:
-        # check if guest is in database
-        user = User.get_guest_for_name(guest_row[sh.u_name])
-        if not user:
-            User.update_from_sheet()
-            user = User.get_guest_for_name(guest_row[sh.u_name])
-        if user.name in [p.name for p in tr.participants]:
+    async with muddi.training_locks(training_id):
+        tr: Training = await muddi.get_training(training_id, ctx.guild.id)
+        if not tr:
+            await ctx.send(content=f"Training: with ID {training_id} not found!")
+            return
+        if user.name in [p.name for p in await tr.aparticipants()]:
             await ctx.send(content=f"This person is already a participant!")
             return
-        success = tr.add_participant(user_id=user.user_id)
-        muddi.trainings_lock.release()
+        success = await tr.aadd_participant(user_id=user.user_id)
         if not success:
             await ctx.send(content=f"Something went wrong when trying to add participant to training #{training_id}")
             return
-        if tr.message_id not in muddi.message_ids:
-            muddi.message_ids.append(tr.message_id)
-        await muddi.update_training_post(tr)
-        await ctx.send(content=f"{ctx.author.mention}, {user.name} has been added to training #{training_id}")
+        if tr.message_id not in guild_state(ctx).registry:
+            await muddi.watch(tr)
+        muddi.update_training_post(tr)
+    await ctx.send(content=f"{ctx.author.mention}, {user.name} has been added to training #{training_id}")
 
 
 @training_remove.command(name="guest")
 async def remove_guest(ctx: commands.Context, training_id: int, name: str):
     """ Remove a guest from the participants list. The name is the displayed name in the participants list."""
-    if not muddi.trainings_lock.acquire(timeout=5):
-        print("couldn't acquire trainings lock")
-        return
-    trainings = muddi.trainings().values()
-    for tr in trainings:
-        if tr.training_id == training_id:
-            for p in tr.participants:
-                if p.member_type == sh.GUEST and p.name == name:
-                    if tr.remove_participant(p.user_id):
-                        muddi.trainings_lock.release()
-                        await muddi.update_training_post(tr)
-                        await ctx.send(content=f"{ctx.author.mention}, {name} has been removed from training #{training_id}")
-                        return
-    muddi.trainings_lock.release()
-    past_training = Training.get_for_id(training_id)
-    if past_training:
-        if past_training.remove_guest_participant(name):
-            await muddi.update_training_post(past_training)
-            await ctx.send(content=f"Successfully removed {name} from training #{training_id}")
+    async with muddi.training_locks(training_id):
+        if not (tr := await muddi.get_training(training_id, ctx.guild.id)):
+            await ctx.send(content=f"Training with ID {training_id} doesn't exist!")
+            return
+        for p in await tr.aparticipants():
+            if p.member_type == sh.GUEST and p.name == name:
+                if await tr.aremove_participant(p.user_id):
+                    muddi.update_training_post(tr)
+                    await ctx.send(content=f"{ctx.author.mention}, {name} has been removed from training #{training_id}")
+                    return
+    await ctx.send(content=f"{name} isn't a guest of training #{training_id}!")
 
 
 async def remove_guest_name(training: Training, name: str):
-    for p in training.participants:
+    for p in await training.aparticipants():
         if p.name.lower() == name.lower() and p.member_type == sh.GUEST:
-            training.remove_participant(p.user_id)
+            await training.aremove_participant(p.user_id)
+
+
+
+@muddi.group(name="stats")
+@commands.check(check_channel)
+async def _stats(ctx):
+    """ Attendance statistics of trainings that haven't been cancelled """
+    if ctx.invoked_subcommand is None:
+        await ctx.send("Enter `help stats` to learn how to use `stats`")
+
+
+@_stats.command(name="user")
+async def stats_user(ctx: commands.Context, member: discord.Member):
+    """ Registrations and no-shows of a member """
+    if not (user := await User.aget_for_discord_id_or_tag(member.id, str(member), ctx.guild.id)):
+        await ctx.send(content="Unknown user!")
+        return
+    registrations, noshows = await Stats.afor_user(user.user_id)
+    rate = f"{noshows / registrations:.0%}" if registrations else "-"
+    await ctx.send(content=f"{user.name}: {registrations} registrations, {noshows} no-shows ({rate})")
+
+
+@_stats.command(name="training")
+async def stats_training(ctx: commands.Context, training_id: int):
+    """ Participants of a training by gender and member type """
+    stats = await Stats.afor_training(training_id) if await muddi.get_training(training_id, ctx.guild.id) else None
+    if not stats:
+        await ctx.send(content="No stats for this training, it doesn't exist or has been cancelled.")
+        return
+    await ctx.send(content=f"Training {training_id}: " + ", ".join(f"{v} {k}" for k, v in stats.items()))
+
+
+async def send_group_stats(ctx: commands.Context, kind: str, title: str):
+    embed = discord.Embed(title=title)
+    # embeds take at most 25 fields, show the latest months or the most frequent coaches and locations
+    groups = await Stats.afor_groups(kind, ctx.guild.id)
+    groups = groups[-25:] if kind == "month" else sorted(groups, key=lambda g: -g[1])[:25]
+    for key, trainings, participants, women, men, guests, noshows in groups:
+        average = participants / trainings if trainings else 0
+        embed.add_field(name=key or "(none)", value=f"{trainings} trainings, {average:.1f} participants on average\n"
+                                                    f"{women} women, {men} men, {guests} guests, {noshows} no-shows",
+                        inline=False)
+    await ctx.send(embed=embed)
+
+
+@_stats.command(name="months")
+async def stats_months(ctx: commands.Context):
+    """ Trainings and participants per month """
+    await send_group_stats(ctx, "month", "Trainings per month")
+
+
+@_stats.command(name="coaches")
+async def stats_coaches(ctx: commands.Context):
+    """ Trainings and participants per coach """
+    await send_group_stats(ctx, "coach", "Trainings per coach")
+
+
+@_stats.command(name="locations")
+async def stats_locations(ctx: commands.Context):
+    """ Trainings and participants per location """
+    await send_group_stats(ctx, "location", "Trainings per location")
+
+
+@_stats.command(name="rebuild")
+async def stats_rebuild(ctx: commands.Context):
+    """ Recount all statistics from the attendance history, e.g. after editing the database by hand """
+    if await Stats.arebuild():
+        await ctx.send(content=f"{ctx.author.mention} stats rebuilt")
+    else:
+        await ctx.send(content="Something went wrong! Try again or contact admin.")
 
 
 muddi.run(secrets.bot_token)
@@ -1,82 +1,476 @@
-from datetime import date, timedelta, datetime
-import time
-from threading import RLock
+import asyncio
+import os
+import socket
+import time as timer
+from datetime import datetime, time, timedelta
+from typing import Dict, List, Optional, Tuple
 import discord
 from discord.ext import commands, tasks
 
-from muddi.models import Training, Schedule, User
-from muddi.utils.embeds import managing_embed, posting_embed
+from muddi.database import executor
+from muddi.database.db import DB
+from muddi.models import Training, Schedule, User, Guild, Lease
+from muddi.registrations import RegistrationQueue
+from muddi.registry import TrainingRegistry, watch_duration
+from muddi.utils.deadlines import Deadlines
+from muddi.utils.debounce import Debouncer
+from muddi.utils.locks import LockRegistry
+from muddi.utils.embeds import managing_embed, posting_embed, cancel_embed, SentEmbeds
+from muddi.utils.metrics import metrics
 
 MessageID = int
 DiscordUserID = int
+GuildID = int
+
+
+class GuildState:
+    """ What the bot keeps per guild: its configuration and channels, watched training posts and schedules """
+    def __init__(self, config: Guild, guild: discord.Guild):
+        self.config = config
+        self.guild = guild
+        self.posting_channel: discord.TextChannel = guild.get_channel(config.posting_channel)
+        self.managing_channel: discord.TextChannel = guild.get_channel(config.managing_channel)
+        # watched training posts
+        self.registry = TrainingRegistry()
+        self.schedules: List[Schedule] = []
+        # a schedule must not be checked twice at once, it would be posted twice
+        self.schedules_lock = asyncio.Lock()
+
+    @property
+    def guild_id(self) -> GuildID:
+        return self.guild.id
+
+    def jump_url(self, message_id: MessageID) -> str:
+        """ Same as discord.Message.jump_url for a training post, without fetching it """
+        return f"https://discord.com/channels/{self.guild.id}/{self.posting_channel.id}/{message_id}"
+
 
 class Muddi(commands.Bot):
-    def __init__(self, command_prefix, add_emoji="\U0001F94F", ):
+    def __init__(self, command_prefix, add_emoji="\U0001F94F", update_window=2, sync_interval=60,
+                 schedule_refresh=15, backup_dir: Optional[str] = None, backup_interval=24, backup_keep=7,
+                 instance: Optional[str] = None, lease_duration=30, registration_journal: Optional[str] = None,
+                 reconcile_concurrency=8):
+        """
+        :param update_window: seconds in which changes of a training are collected into one post edit
+        :param sync_interval: minutes between full user syncs with the sheet and the guild members. Member changes are
+        handled as they happen, this only catches what the events missed.
+        :param schedule_refresh: minutes between rereading the schedules from the sheet
+        :param backup_dir: directory for compressed database backups, none are made without it
+        :param backup_interval: hours between backups, the first one is made on start
+        :param backup_keep: number of backups kept, older ones are deleted
+        :param instance: name of this instance in the leader lease, host and process id by default
+        :param lease_duration: seconds until another instance takes over from a leader that stopped renewing its lease
+        :param registration_journal: file for the registrations by reaction that haven't been committed yet
+        :param reconcile_concurrency: posts whose reactions are read at the same time on start, see reconcile
+        """
         self.command_prefix = command_prefix
-        self.message_ids = []
-        self.trainings_lock = RLock()
+        # configured guilds the bot is a member of
+        self.guild_states: Dict[GuildID, GuildState] = {}
+        # one lock per training_id, held while a training is read, changed and its post is updated
+        self.training_locks = LockRegistry(name="training")
+        # registrations by reaction are committed in batches behind the handlers' backs
+        self.registrations = RegistrationQueue(registration_journal)
+        self.reconcile_concurrency = reconcile_concurrency
+        # reaction events held back while reconciling, (added, event) in the order they came in
+        self.held_reactions: Optional[List[Tuple[bool, discord.RawReactionActionEvent]]] = None
+        self.post_updates = Debouncer(self._edit_training_post, window=update_window)
+        self.sent_embeds = SentEmbeds()
+        # handles of the training posts, so they can be edited without fetching them first
+        self.posts: Dict[MessageID, discord.Message] = {}
+        # next due event per schedule, watched training, sheet refresh of every guild and backup
+        self.deadlines = Deadlines()
+        self.schedule_refresh = timedelta(minutes=schedule_refresh)
+        self.scheduler: Optional[asyncio.Task] = None
+        self.backup_dir = backup_dir
+        self.backup_interval = timedelta(hours=backup_interval)
+        self.backup_keep = backup_keep
+        self.backup_task: Optional[asyncio.Task] = None
+        # several instances can share the database, only the leader posts schedules, syncs and backs up
+        self.lease = Lease("leader", instance or f"{socket.gethostname()}:{os.getpid()}",
+                           timedelta(seconds=lease_duration))
+        self.leader = False
+        # Training.active_version of the trainings a follower watches
+        self.followed: Optional[str] = None
         self.add_emoji = add_emoji
-        self.guild: discord.Guild = None
-        self.posting_channel: discord.TextChannel = None
-        self.managing_channel: discord.TextChannel = None
-        self.loop_count = 0
         super().__init__(command_prefix=command_prefix, help_command=commands.DefaultHelpCommand(dm_help=True))
+        self.sync_loop.change_interval(minutes=sync_interval)
+        # renewed three times per lease, so a single slow heartbeat doesn't lose it
+        self.leader_loop.change_interval(seconds=lease_duration / 3)
+        self._time_requests()
+
+    def _time_requests(self):
+        """ Records every Discord REST call in the discord_request metrics, labeled by method and route template """
+        request = self.http.request
+
+        async def timed_request(route, **kwargs):
+            with metrics.time("discord_request", method=route.method, route=route.path):
+                return await request(route, **kwargs)
+        self.http.request = timed_request
+
+    async def invoke(self, ctx: commands.Context):
+        start = timer.perf_counter()
+        try:
+            await super().invoke(ctx)
+        finally:
+            # ctx.command is the invoked subcommand by now
+            name = ctx.command.qualified_name if ctx.command else "unknown"
+            metrics.observe("command_seconds", timer.perf_counter() - start, command=name)
+            if ctx.command_failed:
+                metrics.inc("command_errors_total", command=name)
+
+    def state(self, guild_id: Optional[GuildID]) -> Optional[GuildState]:
+        return self.guild_states.get(guild_id)
+
+    def watched(self, training_id) -> Optional[Training]:
+        return next((tr for state in self.guild_states.values() if (tr := state.registry.get_for_id(training_id))),
+                    None)
+
+    async def get_training(self, training_id, guild_id: GuildID = None) -> Optional[Training]:
+        """
+        The watched instance of the training if there is one, so changes are seen by the reaction handlers
+        :param guild_id: only return the training if it belongs to this guild
+        """
+        training = self.watched(training_id) or await Training.aget_for_id(training_id)
+        if training and guild_id is not None and training.guild_id != guild_id:
+            return None
+        return training
+
+    async def start_guilds(self):
+        """ Sets up the configured guilds the bot is a member of. Already running guilds keep their state. """
+        for config in await Guild.aget_all():
+            if config.guild_id not in self.guild_states:
+                await self.start_guild(config)
+
+    async def start_guild(self, config: Guild) -> Optional[GuildState]:
+        """ Sets up or reconfigures a guild. Once the scheduler runs, the guild's posts and schedules are loaded. """
+        if not (guild := self.get_guild(config.guild_id)):
+            print(f"Not a member of the configured guild {config.guild_id}")
+            return None
+        old = self.guild_states.get(config.guild_id)
+        state = self.guild_states[config.guild_id] = GuildState(config, guild)
+        if old:
+            # keep the watched posts, the schedules are reloaded below
+            state.registry = old.registry
+            state.schedules = old.schedules
+        if self.scheduler and not self.scheduler.done():
+            await self._start_guild_schedules(state)
+        return state
+
+    async def _start_guild_schedules(self, state: GuildState):
+        try:
+            await self.reload_schedules(state)
+        except Exception as e:
+            print(f"Couldn't load schedules of {state.guild}: {e}")
+
+    @tasks.loop(minutes=60)
+    async def sync_loop(self):
+        for state in list(self.guild_states.values()):
+            sheet, members = await User.async_sync(state.guild.members, state.config)
+            print(f"Synced users of {state.guild} - sheet: {sheet}, members: {members}")
+
+    async def on_member_change(self, member: discord.Member):
+        if member.guild.id not in self.guild_states:
+            return
+        if changes := await User.aupdate_from_member(member, member.guild.id):
+            print(f"Member {member}: {changes}")
+
+    async def watch(self, training: Training):
+        """ Watches the training's post for reactions until it ended watch_duration ago """
+        if not (state := self.state(training.guild_id)):
+            return
+        await state.registry.watch(training)
+        self.deadlines.set(("training", training.training_id), training.end + watch_duration)
+
+    def unwatch(self, training_id):
+        for state in self.guild_states.values():
+            if training := state.registry.get_for_id(training_id):
+                state.registry.unwatch(training.message_id)
+                self.posts.pop(training.message_id, None)
+        self.deadlines.remove(("training", training_id))
+        self.sent_embeds.forget(training_id)
+
+    @tasks.loop(seconds=10)
+    async def leader_loop(self):
+        """ Heartbeat of the leader lease. Followers reread the active trainings, see follow. """
+        if not await self.renew_lease():
+            await self.follow()
+
+    async def renew_lease(self) -> bool:
+        """ Renews or takes over the leader lease and starts or stops leading accordingly, :return: whether leading """
+        if await self.lease.aacquire():
+            if not self.leader:
+                self.lead()
+        elif self.leader:
+            self.step_down()
+        return self.leader
+
+    def lead(self):
+        print(f"{self.lease.holder} is the leader now")
+        self.leader = True
+        if not self.sync_loop.is_running():
+            self.sync_loop.start()
+        self.start_scheduler()
 
-    def trainings(self):
-        trainings_list = Training.get_for_message_ids(self.message_ids)
-        return {tr.message_id: tr for tr in trainings_list}
-
-    @tasks.loop(seconds=30)
-    async def schedule_loop(self):
-        print("Running schedule loop")
-        t1 = time.time()
-        # should be fine to sync up every one in a while, since we sync when guests are added or users join the server
-        if self.loop_count % 5 < 1:
-            User.sync(self.guild.members)
-        self.loop_count += 1
-        self.members = User.get_all()
-        # check schedules
-        schedules = Schedule.get_schedules()
-        for schedule in schedules:
-            # add training to list if the next training for this schedule has been posted
-            if training := schedule.scheduled():
-                if not training.cancelled and training.message_id and training.message_id not in self.message_ids:
-                    self.message_ids.append(training.message_id)
-                elif not training.message_id:
-                    print("This shouldn't happen. A training has been scheduled without message_id")
-            elif schedule.next_notification() <= date.today():
-                new = schedule.next_training()
-                await self.post_training(new)
-        # check remaining pending trainings
-        if not self.trainings_lock.acquire(timeout=5):
-            print("couldn't acquire trainings lock")
+    def step_down(self):
+        print(f"{self.lease.holder} lost the leader lease")
+        self.leader = False
+        self.followed = None
+        self.sync_loop.cancel()
+        if self.scheduler:
+            self.scheduler.cancel()
+
+    async def follow(self):
+        """
+        Watches the active trainings posted by the leader, with their participants as written by any instance. They
+        are only reread when Training.active_version changed. Trainings in use by a handler or with uncommitted
+        registrations are left alone until the next heartbeat.
+        """
+        if (version := await Training.aactive_version(watch_duration)) == self.followed:
             return
-        remaining = list(filter(lambda x: x.message_id not in self.message_ids,
-                                Training.select_next_trainings()))
-        for tr in remaining:
-            if tr.message_id not in self.message_ids:
-                self.message_ids.append(tr.message_id)
-        # trainings are unwatched 1 day after end
-        trainings = self.trainings()
-        self.message_ids = list(map(lambda x: x.message_id,
-                               filter(lambda item: (item.end + timedelta(hours=23) > datetime.today()),
-                                      trainings.values())))
-        self.trainings_lock.release()
-        print(time.time() - t1)
+        active = [tr for tr in await Training.aselect_active(watch_duration) if tr.guild_id in self.guild_states]
+        ids = {tr.training_id for tr in active}
+        for state in list(self.guild_states.values()):
+            for training in state.registry.values():
+                if training.training_id not in ids:
+                    self.unwatch(training.training_id)
+        fresh = [tr for tr in active if not self.training_locks.locked(tr.training_id)
+                 and not self.registrations.pending(tr.training_id)]
+        for training in await Training.aload_participants(fresh):
+            await self.watch(training)
+        self.followed = version if len(fresh) == len(active) else None
+
+    def hold_reaction(self, reaction: discord.RawReactionActionEvent, added: bool) -> bool:
+        """ :return: True if the event is held back until reconcile is done, the caller handles it later """
+        if self.held_reactions is None:
+            return False
+        self.held_reactions.append((added, reaction))
+        return True
+
+    async def reconcile(self) -> List[Tuple[bool, discord.RawReactionActionEvent]]:
+        """
+        Registers the reactions added and removed while the bot was offline. The reactions of every active training's
+        post are read, reconcile_concurrency posts at a time, and the differences to the participants are applied in
+        one transaction. The trainings are watched afterwards.
+        Reaction events coming in meanwhile are held back, see hold_reaction. They have to be handled once this
+        returns them, on top of the reconciled participants.
+        """
+        self.held_reactions = []
+        try:
+            # after a reconnect some are watched already, their cached participants are the ones to compare
+            active = [self.watched(tr.training_id) or tr for tr in await Training.aselect_active(watch_duration)
+                      if tr.guild_id in self.guild_states and tr.message_id]
+            await Training.aload_participants(active)
+            semaphore = asyncio.Semaphore(self.reconcile_concurrency)
+
+            async def read(training: Training) -> Optional[Tuple[Training, Dict[DiscordUserID, Tuple[str, str]]]]:
+                async with semaphore:
+                    try:
+                        return training, await self.reacting_members(training)
+                    except discord.HTTPException as e:
+                        print(f"Couldn't read the reactions of training #{training.training_id}: {e}")
+                        return None
+            reactions = [r for r in await asyncio.gather(*(read(tr) for tr in active)) if r]
+            changed = await Training.aapply_reactions(reactions)
+            for training, _ in reactions:
+                await self.watch(training)
+            for training in changed:
+                self.update_training_post(training)
+            if changed:
+                print(f"Reconciled the reactions of {len(changed)} of {len(reactions)} active trainings")
+        except Exception as e:
+            print(f"Couldn't reconcile the reactions: {e}")
+        finally:
+            held, self.held_reactions = self.held_reactions, None
+        return held
+
+    async def reacting_members(self, training: Training) -> Dict[DiscordUserID, Tuple[str, str]]:
+        """ Display name and tag of every user reacting with add_emoji to the training's post, but the bot """
+        # a known handle might have missed reactions, so the post is always fetched
+        post = await self.state(training.guild_id).posting_channel.fetch_message(training.message_id)
+        self.posts[post.id] = post
+        if not (reaction := next((r for r in post.reactions if str(r.emoji) == self.add_emoji), None)):
+            return {}
+        if reaction.count <= 1 and reaction.me:
+            return {}
+        # paged by 100 users per request
+        return {user.id: (user.display_name, str(user)) async for user in reaction.users() if user.id != self.user.id}
+
+    async def watch_active(self):
+        """
+        Watches the active trainings of all guilds until they expire. The ones watched already, e.g. reconciled or
+        picked up as a follower, keep their instance but get their expiry deadline as well.
+        """
+        # one query for the active trainings of all guilds
+        active = [self.watched(tr.training_id) or tr for tr in await Training.aselect_active(watch_duration)
+                  if tr.guild_id in self.guild_states]
+        for training in await Training.aload_participants(active):
+            await self.watch(training)
+
+    def start_scheduler(self):
+        if not self.scheduler or self.scheduler.done():
+            self.scheduler = asyncio.create_task(self._run_scheduler())
+
+    async def _run_scheduler(self):
+        """ Sleeps until the next deadline instead of polling, see check_schedule for the deadlines of schedules """
+        await self.watch_active()
+        for state in list(self.guild_states.values()):
+            await self._start_guild_schedules(state)
+        if self.backup_dir:
+            self.deadlines.set(("backup", None), datetime.today())
+        while True:
+            for kind, key in await self.deadlines.wait():
+                try:
+                    if kind == "sheet":
+                        if state := self.state(key):
+                            await self.reload_schedules(state)
+                    elif kind == "schedule":
+                        await self.check_schedule(key)
+                    elif kind == "training":
+                        self.unwatch(key)
+                    elif kind == "backup":
+                        self.start_backup()
+                except Exception as e:
+                    print(f"Couldn't handle {kind} deadline: {e}")
+
+    def start_backup(self):
+        """ Backs up the database on the background thread, without holding up the other deadlines """
+        self.deadlines.set(("backup", None), datetime.today() + self.backup_interval)
+        if not self.backup_task or self.backup_task.done():
+            self.backup_task = asyncio.create_task(self._backup())
+
+    async def _backup(self):
+        try:
+            await executor.background(DB().backup_rotated, self.backup_dir, self.backup_keep)
+        except Exception as e:
+            # the database is shared by all guilds, so this is for whoever runs the bot
+            print(f"Backup failed: {e}")
+
+    async def reload_schedules(self, state: GuildState):
+        """ Rereads the schedules from the guild's sheet and reschedules their deadlines """
+        async with state.schedules_lock:
+            try:
+                schedules = await Schedule.aget_schedules(state.config)
+            finally:
+                # try again later, even if the sheet couldn't be read
+                self.deadlines.set(("sheet", state.guild_id), datetime.today() + self.schedule_refresh)
+            for schedule in state.schedules:
+                self.deadlines.remove(("schedule", schedule))
+            state.schedules = schedules
+            scheduled = await Schedule.ascheduled_trainings(schedules)
+            await Training.aload_participants([tr for tr in scheduled.values()
+                                               if tr and tr.message_id not in state.registry])
+            for schedule in schedules:
+                await self._check_schedule(state, schedule, scheduled[schedule])
+
+    async def check_schedule(self, schedule: Schedule):
+        if not (state := self.state(schedule.guild_id)):
+            return
+        async with state.schedules_lock:
+            # might have been dropped by a reload in the meantime
+            if schedule in state.schedules:
+                await self._check_schedule(state, schedule)
+
+    async def _check_schedule(self, state: GuildState, schedule: Schedule, training: Optional[Training] = None):
+        """
+        Posts the schedule's next training once its notification day has come and sets the schedule's next deadline:
+        the notification day, or the day after the posted training when the following training is up next.
+        :param training: the already created next training, looked up if not given
+        """
+        now = datetime.today()
+        if not training:
+            training = (await Schedule.ascheduled_trainings([schedule], now))[schedule]
+        if training:
+            if not training.cancelled and training.message_id and training.message_id not in state.registry:
+                await self.watch(training)
+            elif not training.message_id:
+                print("This shouldn't happen. A training has been scheduled without message_id")
+            due = datetime.combine(training.start.date() + timedelta(days=1), time.min)
+        elif (notification := schedule.next_notification(now)) <= now.date():
+            # a leader whose lease expired unnoticed, or a follower reloading by command, must not post as well
+            if not await self.renew_lease():
+                return
+            new = schedule.next_training(now)
+            await self.post_training(new)
+            due = datetime.combine(new.start.date() + timedelta(days=1), time.min)
+        else:
+            due = datetime.combine(notification, time.min)
+        self.deadlines.set(("schedule", schedule), due)
+
+    async def get_post(self, training: Training) -> discord.Message:
+        """
+        The handle of a training's post, only fetched from its guild's posting channel if it isn't known yet
+        :raises discord.NotFound: if the post has been deleted
+        """
+        if not (post := self.posts.get(training.message_id)):
+            channel = self.state(training.guild_id).posting_channel
+            post = self.posts[training.message_id] = await channel.fetch_message(training.message_id)
+        return post
+
+    async def edit_post(self, training: Training, **fields):
+        """
+        Edits a training's post through its handle. If that fails with NotFound the handle is dropped and the post
+        fetched again, which raises NotFound as well if it has really been deleted.
+        """
+        post = await self.get_post(training)
+        try:
+            await post.edit(**fields)
+        except discord.NotFound:
+            self.posts.pop(training.message_id, None)
+            await (await self.get_post(training)).edit(**fields)
+
+    def forget_post(self, message_id: MessageID):
+        self.posts.pop(message_id, None)
 
     async def post_training(self, training: Training):
-        post = await self.posting_channel.send(embed=posting_embed(training, [], self.add_emoji))
+        state = self.state(training.guild_id)
+        embed = posting_embed(training, [], self.add_emoji)
+        post = await state.posting_channel.send(embed=embed)
         await post.add_reaction(self.add_emoji)
+        self.posts[post.id] = post
         training.message_id = post.id
-        training_id = training.insert() if not training.training_id else training.training_id
-        training.training_id = training_id
-        self.message_ids.append(training.message_id)
-        await self.managing_channel.send(content="new training was just postet", embed=managing_embed(training, post))
+        if not training.training_id:
+            training.training_id = await training.ainsert()
+        else:
+            # reposted, e.g. after the old post was deleted
+            await training.aupdate()
+        self.sent_embeds.sent(training.training_id, embed)
+        await self.watch(training)
+        await state.managing_channel.send(content="new training was just postet", embed=managing_embed(training, post))
+
+
+    def update_training_post(self, training: Training):
+        """ Schedules an edit of the training's post, bursts of changes are coalesced into one edit """
+        self.post_updates.mark(training.training_id, training)
+
+    async def _edit_training_post(self, training: Training):
+        if not (state := self.state(training.guild_id)):
+            return
+        if training.cancelled:
+            embed = cancel_embed(training)
+        else:
+            embed = posting_embed(training, [(u.name, mem.mention if (mem := state.guild.get_member(u.discord_id))
+                                              else "(Guest)", u.gender) for u in await training.aparticipants()],
+                                  self.add_emoji, genders=training.gender_counts)
+        if not self.sent_embeds.changed(training.training_id, embed):
+            return
+        await self.edit_post(training, embed=embed)
+        self.sent_embeds.sent(training.training_id, embed)
+
+    async def close(self):
+        self.leader_loop.cancel()
+        if self.scheduler:
+            self.scheduler.cancel()
+        await self.registrations.stop()
+        # pending post edits still need the connection
+        await self.post_updates.flush()
+        if self.leader:
+            # hand over right away instead of after the lease expired
+            await self.lease.arelease()
+        await super().close()
+        # let queued writes finish before the process exits
+        executor.shutdown()
 
 
-    async def update_training_post(self, training: Training):
-        message = await self.posting_channel.fetch_message(training.message_id)
-        await message.edit(embed=posting_embed(
-            training, [(u.name, mem.mention if (mem := self.guild.get_member(u.discord_id)) else "(Guest)",
-                        u.gender) for u in training.participants], self.add_emoji))
 
+class ShardedMuddi(Muddi, commands.AutoShardedBot):
+    """ Muddi on several gateway connections, for when one shard can't keep up with all guilds """
@@ -1,6 +1,22 @@
+import gzip
+import io
+import os
+import re
+import shutil
 import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Optional
 
+from muddi import secrets
+from muddi.database.querylog import QueryLog
 from muddi.secrets import database_path
+from muddi.spreadsheet import GUEST
+from muddi.utils.metrics import metrics
 
 #  TODO handle multiple of the same discord tag/id
 users = """ 
@@ -54,62 +70,496 @@ participants_index = """
 
 setup_sql = [users, users_index, trainings, participants, participants_index]
 
+# Attendance rollups, only counting trainings that aren't cancelled. They are updated along with every change of
+# participants or trainings (see models.Stats) and can be rebuilt from scratch with rebuild_rollups.
+user_stats = """
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id integer PRIMARY KEY,
+        registrations integer NOT NULL DEFAULT 0,
+        noshows integer NOT NULL DEFAULT 0
+    )
+    """
+
+training_stats = """
+    CREATE TABLE IF NOT EXISTS training_stats (
+        training_id integer PRIMARY KEY,
+        participants integer NOT NULL DEFAULT 0,
+        women integer NOT NULL DEFAULT 0,
+        men integer NOT NULL DEFAULT 0,
+        guests integer NOT NULL DEFAULT 0,
+        noshows integer NOT NULL DEFAULT 0
+    )
+    """
+
+# kind is 'month' (key YYYY-MM of the start), 'coach' or 'location'. Replaced by guild_group_stats in migration 5.
+group_stats = """
+    CREATE TABLE IF NOT EXISTS group_stats (
+        kind text NOT NULL,
+        key text NOT NULL,
+        trainings integer NOT NULL DEFAULT 0,
+        participants integer NOT NULL DEFAULT 0,
+        women integer NOT NULL DEFAULT 0,
+        men integer NOT NULL DEFAULT 0,
+        guests integer NOT NULL DEFAULT 0,
+        noshows integer NOT NULL DEFAULT 0,
+        PRIMARY KEY (kind, key)
+    )
+    """
+
+# group_stats per guild, guild_id 0 stands for trainings without a guild
+guild_group_stats = """
+    CREATE TABLE IF NOT EXISTS group_stats (
+        guild_id integer NOT NULL,
+        kind text NOT NULL,
+        key text NOT NULL,
+        trainings integer NOT NULL DEFAULT 0,
+        participants integer NOT NULL DEFAULT 0,
+        women integer NOT NULL DEFAULT 0,
+        men integer NOT NULL DEFAULT 0,
+        guests integer NOT NULL DEFAULT 0,
+        noshows integer NOT NULL DEFAULT 0,
+        PRIMARY KEY (guild_id, kind, key)
+    )
+    """
+
+rollup_groups = {
+    "month": "substr(t.start, 1, 7)",
+    "coach": "COALESCE(t.coach, '')",
+    "location": "t.location",
+}
+
+
+def rebuild_rollups(conn: sqlite3.Connection):
+    """ Recounts the rollups of the current schema, see models.Stats.rebuild. Migrations use frozen copies. """
+    for table in ["user_stats", "training_stats", "group_stats"]:
+        conn.execute(f"DELETE FROM {table}")
+    conn.execute("""
+        INSERT INTO user_stats(user_id, registrations, noshows)
+        SELECT p.user_id, COUNT(*), SUM(p.noshow)
+        FROM participants AS p INNER JOIN trainings AS t ON p.training_id = t.training_id
+        WHERE t.cancelled = 0
+        GROUP BY p.user_id""")
+    conn.execute("""
+        INSERT INTO training_stats(training_id, participants, women, men, guests, noshows)
+        SELECT t.training_id, COUNT(p.user_id), COALESCE(SUM(p.gender = 'w'), 0), COALESCE(SUM(p.gender = 'm'), 0),
+               COALESCE(SUM(p.member_type = ?), 0), COALESCE(SUM(p.noshow), 0)
+        FROM trainings AS t
+        LEFT JOIN participants AS p ON p.training_id = t.training_id
+        WHERE t.cancelled = 0
+        GROUP BY t.training_id""", (GUEST,))
+    for kind, key in rollup_groups.items():
+        conn.execute(f"""
+            INSERT INTO group_stats(guild_id, kind, key, trainings, participants, women, men, guests, noshows)
+            SELECT COALESCE(t.guild_id, 0), ?, {key}, COUNT(*), SUM(s.participants), SUM(s.women), SUM(s.men),
+                   SUM(s.guests), SUM(s.noshows)
+            FROM training_stats AS s INNER JOIN trainings AS t ON s.training_id = t.training_id
+            GROUP BY COALESCE(t.guild_id, 0), {key}""", (kind,))
+
+
+def fill_rollups_4(conn: sqlite3.Connection):
+    """ Migration 4 as it shipped, frozen: later changes of rebuild_rollups mustn't change what it does """
+    conn.execute("""
+        INSERT INTO user_stats(user_id, registrations, noshows)
+        SELECT p.user_id, COUNT(*), SUM(p.noshow)
+        FROM participants AS p INNER JOIN trainings AS t ON p.training_id = t.training_id
+        WHERE t.cancelled = 0
+        GROUP BY p.user_id""")
+    conn.execute("""
+        INSERT INTO training_stats(training_id, participants, women, men, guests, noshows)
+        SELECT t.training_id, COUNT(p.user_id), COALESCE(SUM(u.gender = 'w'), 0), COALESCE(SUM(u.gender = 'm'), 0),
+               COALESCE(SUM(u.member_type = 'Gast'), 0), COALESCE(SUM(p.noshow), 0)
+        FROM trainings AS t
+        LEFT JOIN participants AS p ON p.training_id = t.training_id
+        LEFT JOIN users AS u ON p.user_id = u.user_id
+        WHERE t.cancelled = 0
+        GROUP BY t.training_id""")
+    for kind, key in [("month", "substr(t.start, 1, 7)"), ("coach", "COALESCE(t.coach, '')"),
+                      ("location", "t.location")]:
+        conn.execute(f"""
+            INSERT INTO group_stats(kind, key, trainings, participants, women, men, guests, noshows)
+            SELECT ?, {key}, COUNT(*), SUM(s.participants), SUM(s.women), SUM(s.men), SUM(s.guests), SUM(s.noshows)
+            FROM training_stats AS s INNER JOIN trainings AS t ON s.training_id = t.training_id
+            GROUP BY {key}""", (kind,))
+
+
+def fill_group_stats_5(conn: sqlite3.Connection):
+    """ Migration 5, frozen: group_stats per guild from the training_stats filled by migration 4 """
+    for kind, key in [("month", "substr(t.start, 1, 7)"), ("coach", "COALESCE(t.coach, '')"),
+                      ("location", "t.location")]:
+        conn.execute(f"""
+            INSERT INTO group_stats(guild_id, kind, key, trainings, participants, women, men, guests, noshows)
+            SELECT COALESCE(t.guild_id, 0), ?, {key}, COUNT(*), SUM(s.participants), SUM(s.women), SUM(s.men),
+                   SUM(s.guests), SUM(s.noshows)
+            FROM training_stats AS s INNER JOIN trainings AS t ON s.training_id = t.training_id
+            GROUP BY COALESCE(t.guild_id, 0), {key}""", (kind,))
+
+
+def fill_rollups_7(conn: sqlite3.Connection):
+    """ Migration 7, frozen: recounts training_stats and group_stats from the attributes stored on participants """
+    conn.execute("DELETE FROM training_stats")
+    conn.execute("DELETE FROM group_stats")
+    conn.execute("""
+        INSERT INTO training_stats(training_id, participants, women, men, guests, noshows)
+        SELECT t.training_id, COUNT(p.user_id), COALESCE(SUM(p.gender = 'w'), 0), COALESCE(SUM(p.gender = 'm'), 0),
+               COALESCE(SUM(p.member_type = 'Gast'), 0), COALESCE(SUM(p.noshow), 0)
+        FROM trainings AS t
+        LEFT JOIN participants AS p ON p.training_id = t.training_id
+        WHERE t.cancelled = 0
+        GROUP BY t.training_id""")
+    for kind, key in [("month", "substr(t.start, 1, 7)"), ("coach", "COALESCE(t.coach, '')"),
+                      ("location", "t.location")]:
+        conn.execute(f"""
+            INSERT INTO group_stats(guild_id, kind, key, trainings, participants, women, men, guests, noshows)
+            SELECT COALESCE(t.guild_id, 0), ?, {key}, COUNT(*), SUM(s.participants), SUM(s.women), SUM(s.men),
+                   SUM(s.guests), SUM(s.noshows)
+            FROM training_stats AS s INNER JOIN trainings AS t ON s.training_id = t.training_id
+            GROUP BY COALESCE(t.guild_id, 0), {key}""", (kind,))
+
+
+# per guild configuration, see models.Guild
+guilds = """
+    CREATE TABLE IF NOT EXISTS guilds (
+        guild_id integer PRIMARY KEY,
+        posting_channel integer,
+        managing_channel integer,
+        schedule_key text,
+        club_key text
+    )
+    """
+
+
+def adopt_configured_guild(conn: sqlite3.Connection):
+    """ Users and trainings from before multi guild support belong to the guild configured in the secrets """
+    if (guild_id := getattr(secrets, "guild_id", None)) is None:
+        return
+    conn.execute("INSERT OR IGNORE INTO guilds VALUES(?,?,?,?,?)",
+                 (guild_id, getattr(secrets, "posting_channel", None), getattr(secrets, "managing_channel", None),
+                  getattr(secrets, "schedule_key", None), getattr(secrets, "club_key", None)))
+    conn.execute("UPDATE users SET guild_id = ? WHERE guild_id IS NULL", (guild_id,))
+    conn.execute("UPDATE trainings SET guild_id = ? WHERE guild_id IS NULL", (guild_id,))
+
+# leases of the instances sharing the database, see models.Lease
+leases = """
+    CREATE TABLE IF NOT EXISTS leases (
+        name text PRIMARY KEY,
+        holder text NOT NULL,
+        expires timestamp NOT NULL
+    )
+    """
+
+schema_version = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version integer PRIMARY KEY,
+        applied timestamp DEFAULT CURRENT_TIMESTAMP
+    )
+    """
+
+# Ordered schema changes, each list of statements or functions taking the connection is applied in one transaction
+# and recorded in schema_version. Never edit an applied migration, append a new one instead.
+migrations = [
+    # 1: initial schema, databases created before versioning already have it
+    setup_sql,
+    # 2: participants_training_idx was on user_id, participants are looked up by training. Registering twice
+    # is prevented by a unique index instead of checking in python.
+    [
+        """ DROP INDEX IF EXISTS participants_training_idx """,
+        """ CREATE INDEX participants_user_idx ON participants (user_id) """,
+        """ DELETE FROM participants WHERE rowid NOT IN
+                (SELECT MIN(rowid) FROM participants GROUP BY training_id, user_id) """,
+        """ CREATE UNIQUE INDEX participants_training_user_idx ON participants (training_id, user_id) """,
+    ],
+    # 3: upcoming trainings are selected by start, scheduled trainings by start, end and location. Neither index
+    # covers its query: the rows are read for the other columns, and for guild_id since migration 5.
+    [
+        """ CREATE INDEX trainings_start_idx ON trainings (start, cancelled) """,
+        """ CREATE INDEX trainings_schedule_idx ON trainings (start, end, location) """,
+    ],
+    # 4: attendance rollups, filled from the existing history
+    [user_stats, training_stats, group_stats, fill_rollups_4],
+    # 5: several guilds in one database. Users are per guild, as every club has its own sheet.
+    [
+        guilds,
+        """ ALTER TABLE users ADD COLUMN guild_id integer """,
+        """ ALTER TABLE trainings ADD COLUMN guild_id integer """,
+        adopt_configured_guild,
+        """ DROP INDEX IF EXISTS idx_discord_id """,
+        """ CREATE INDEX users_guild_discord_idx ON users (guild_id, discord_id) """,
+        """ DROP TABLE group_stats """,
+        guild_group_stats,
+        fill_group_stats_5,
+    ],
+    # 6: leader election between several instances
+    [leases],
+    # 7: participants keep the gender and member type they were counted with, so unregistering subtracts the same
+    # values after the user changed. The rollups counted the current values so far, they are recounted.
+    [
+        """ ALTER TABLE participants ADD COLUMN gender text """,
+        """ ALTER TABLE participants ADD COLUMN member_type text """,
+        """ UPDATE participants SET
+                gender = (SELECT gender FROM users WHERE users.user_id = participants.user_id),
+                member_type = (SELECT member_type FROM users WHERE users.user_id = participants.user_id) """,
+        fill_rollups_7,
+    ],
+    # 8: scheduled trainings are looked up per guild. The index can't cover the lookup, it reads whole rows.
+    [
+        """ DROP INDEX IF EXISTS trainings_schedule_idx """,
+        """ CREATE INDEX trainings_schedule_idx ON trainings (start, end, location, guild_id) """,
+    ],
+]
+
+# connection tuning, applied once per connection
+pragmas = [
+    "PRAGMA journal_mode = WAL",
+    # WAL + NORMAL only syncs on checkpoints, a crash can't corrupt the database
+    "PRAGMA synchronous = NORMAL",
+    # negative values are KiB -> 16 MiB page cache
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 67108864",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA foreign_keys = ON",
+]
+
+# number of compiled statements sqlite3 keeps per connection
+statement_cache_size = 256
+
+# backups copy this many pages at once and sleep in between, so writers only wait for one step at a time
+backup_pages = 256
+backup_sleep = 0.005
+
+
+@lru_cache(maxsize=1024)
+def statement_key(sql: str) -> str:
+    """ The statement with collapsed whitespace and shortened placeholder lists, so all its executions share a key """
+    key = " ".join(sql.split())
+    key = re.sub(r"\?(\s*,\s*\?)+", "?, ...", key)
+    return re.sub(r"\(\?, \.\.\.\)(\s*,\s*\(\?, \.\.\.\))+", "(?, ...), ...", key)
+
+
+class _ThreadState(threading.local):
+    """ Connections and transaction depth of the current thread, keyed by database path """
+    def __init__(self):
+        self.connections: Dict[str, sqlite3.Connection] = {}
+        self.depth: Dict[str, int] = {}
+
+
+_state = _ThreadState()
+
+# statement statistics and slow query log, off unless enabled
+query_log: Optional[QueryLog] = None
+
+
+def enable_query_log(path: str, threshold: float = 0.1) -> QueryLog:
+    """ Starts recording the statements of all DB instances, see QueryLog. Replaces a log enabled before. """
+    global query_log
+    disable_query_log()
+    query_log = QueryLog(path, threshold)
+    return query_log
+
+
+def disable_query_log():
+    global query_log
+    if query_log:
+        query_log, log = None, query_log
+        log.close()
+
 
 class DB:
-    def __init__(self, database=database_path):
-        self.database = database
+    """
+    Cheap handle on a database file. Connections are opened once per thread and database and reused by
+    every DB instance of that thread, so creating a DB() per query doesn't cost a connection setup.
+    """
+    def __init__(self, database=None):
+        self.database = database or database_path
 
     def setup(self):
-        conn = None
         try:
-            conn = self.connect()
-            c = conn.cursor()
-            # create all tables if not exist
-            for q in setup_sql:
-                c.execute(q)
+            self.migrate()
         except sqlite3.Error as error:
             print(error)
+
+    def version(self) -> int:
+        self.connect().execute(schema_version)
+        return self.select("SELECT MAX(version) FROM schema_version")[0][0] or 0
+
+    def migrate(self, target: int = len(migrations)) -> int:
+        """
+        Applies all migrations after the current version up to target
+        :return: the version of the database afterwards
+        """
+        version = self.version()
+        for version in range(version + 1, target + 1):
+            with self.transaction() as conn:
+                for q in migrations[version - 1]:
+                    q(conn) if callable(q) else conn.execute(q)
+                conn.execute("INSERT INTO schema_version(version) VALUES(?)", (version,))
+            print(f"Migrated database to version {version}")
+        return self.version()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = _state.connections.get(self.database)
+        if conn is None:
+            # isolation_level=None: statements autocommit unless they run inside transaction()
+            conn = sqlite3.connect(self.database, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                                   isolation_level=None, cached_statements=statement_cache_size)
+            for pragma in pragmas:
+                conn.execute(pragma)
+            _state.connections[self.database] = conn
+        return conn
+
+    def close(self):
+        """ Closes the connection of the current thread, the next query reconnects """
+        if conn := _state.connections.pop(self.database, None):
+            conn.close()
+        _state.depth.pop(self.database, None)
+
+    def in_transaction(self) -> bool:
+        return _state.depth.get(self.database, 0) > 0
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups all statements of the current thread on this database into one transaction with a single commit.
+        Nested calls join the outermost transaction. Errors roll everything back and are re-raised.
+        """
+        conn = self.connect()
+        depth = _state.depth.get(self.database, 0)
+        _state.depth[self.database] = depth + 1
+        try:
+            if depth:
+                yield conn
+                return
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
         finally:
-            if conn:
-                conn.close()
+            _state.depth[self.database] = depth
 
-    def connect(self):
-        return sqlite3.connect(self.database, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+    @contextmanager
+    def timed(self, sql, parameters=None, many=False):
+        """ Records the duration of a statement in the db_statement metrics and the query log, if it's enabled """
+        key = statement_key(sql)
+        start = time.perf_counter()
+        with metrics.time("db_statement", statement=key):
+            yield
+        if log := query_log:
+            log.record(self.connect(), key, sql, parameters, time.perf_counter() - start, many)
 
-    def commit(self, sql, parameters=None, insert=False):
-        result = None
-        conn = None
+    def commit(self, sql, parameters=None, insert=False, changes=False):
+        """
+        :param insert: return the id of the inserted row
+        :param changes: return the number of changed rows, e.g. 0 if an INSERT OR IGNORE was ignored
+        """
         try:
-            conn = self.connect()
-            c = conn.cursor()
-            c.execute(sql) if not parameters else c.execute(sql, parameters)
-            conn.commit()
-            result = c.lastrowid if insert else True
+            c = self.connect().cursor()
+            with self.timed(sql, parameters):
+                c.execute(sql) if not parameters else c.execute(sql, parameters)
+            if changes:
+                return c.rowcount
+            return c.lastrowid if insert else True
         except Exception as e:
+            # let the surrounding transaction roll back instead of committing half of it
+            if self.in_transaction():
+                raise
             print(e)
-            result = False
-        finally:
-            if conn:
-                conn.close()
-            return result
+            return False
+
+    def commit_many(self, sql, seq_of_parameters) -> bool:
+        """ Executes the statement for every parameter tuple in a single transaction """
+        try:
+            with self.transaction() as conn, self.timed(sql, seq_of_parameters, many=True):
+                conn.executemany(sql, seq_of_parameters)
+            return True
+        except Exception as e:
+            if self.in_transaction():
+                raise
+            print(e)
+            return False
 
     def select(self, sql, parameters=None) -> list:
-        data = []
-        conn = None
         try:
-            conn = self.connect()
-            c = conn.cursor()
-            c.execute(sql) if not parameters else c.execute(sql, parameters)
-            data = c.fetchall()
+            c = self.connect().cursor()
+            with self.timed(sql, parameters):
+                c.execute(sql) if not parameters else c.execute(sql, parameters)
+                return c.fetchall()
         except Exception as e:
+            if self.in_transaction():
+                raise
             print(e)
+            return []
+
+    def iterate(self, sql, parameters=None, size=500):
+        """ Like select, but yields the rows while fetching them in batches of size instead of all at once """
+        c = self.connect().cursor()
+        with self.timed(sql, parameters):
+            c.execute(sql) if not parameters else c.execute(sql, parameters)
+        while rows := c.fetchmany(size):
+            yield from rows
+
+    def _copy(self, target: sqlite3.Connection, pages=backup_pages, sleep=backup_sleep):
+        """ Consistent copy with the online backup API, on a connection of its own so no transaction is shared """
+        source = sqlite3.connect(self.database)
+        try:
+            with metrics.time("db_backup"):
+                source.backup(target, pages=pages, sleep=sleep)
+            if (check := target.execute("PRAGMA quick_check").fetchone()[0]) != "ok":
+                raise sqlite3.DatabaseError(f"backup failed the integrity check: {check}")
         finally:
-            if conn:
+            source.close()
+
+    def backup(self, target: str, compress=False, pages=backup_pages, sleep=backup_sleep) -> str:
+        """
+        Copies the database into the file target while it stays in use. The copy is written next to target first and
+        only replaces it once it passed an integrity check, so target is always restorable.
+        Blocking, run it on executor.background.
+        :param compress: gzip the copy, target gets the .gz suffix
+        :return: the path of the backup
+        """
+        directory = os.path.dirname(os.path.abspath(target))
+        with tempfile.TemporaryDirectory(dir=directory) as tmp:
+            copy = os.path.join(tmp, "backup.db")
+            conn = sqlite3.connect(copy)
+            try:
+                self._copy(conn, pages, sleep)
+                # a single file, without a -wal file next to it
+                conn.execute("PRAGMA journal_mode = DELETE")
+            finally:
                 conn.close()
-            return data
+            if compress:
+                target += ".gz"
+                with open(copy, "rb") as src, gzip.open(copy + ".gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                copy += ".gz"
+            os.replace(copy, target)
+        return target
 
-    def backup(self):
-        pass  # TODO: Implementieren -> Als csv exportieren und in google sheet laden?
+    def backup_rotated(self, directory: str, keep=7, compress=True) -> str:
+        """ Writes a timestamped backup into directory and deletes all but the newest keep of them """
+        os.makedirs(directory, exist_ok=True)
+        path = self.backup(os.path.join(directory, f"muddi-{datetime.now():%Y%m%d-%H%M%S}.db"), compress)
+        backups = sorted(f for f in os.listdir(directory) if f.startswith("muddi-") and ".db" in f)
+        for old in backups[:-keep] if keep else []:
+            os.remove(os.path.join(directory, old))
+        return path
+
+    def snapshot(self, compress=False) -> io.BytesIO:
+        """ Consistent copy of the whole database file in memory, e.g. to upload it. Blocking like backup. """
+        if hasattr(sqlite3.Connection, "serialize"):
+            conn = sqlite3.connect(":memory:")
+            try:
+                self._copy(conn)
+                data = conn.serialize()
+            finally:
+                conn.close()
+        else:
+            # python < 3.11 can't serialize, go through a temporary file instead
+            with tempfile.TemporaryDirectory() as tmp:
+                with open(self.backup(os.path.join(tmp, "snapshot.db")), "rb") as f:
+                    data = f.read()
+        return io.BytesIO(gzip.compress(data) if compress else data)
 
 if __name__ == '__main__':
     DB()
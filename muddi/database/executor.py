@@ -0,0 +1,32 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# SQLite only allows one writer at a time, so all writes are funneled through a single thread.
+# With WAL, readers don't block the writer (and vice versa) and can run in parallel.
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="muddi-db-writer")
+_readers = ThreadPoolExecutor(max_workers=4, thread_name_prefix="muddi-db-reader")
+# long running maintenance (backups), so it never takes a thread from the queries
+_background = ThreadPoolExecutor(max_workers=1, thread_name_prefix="muddi-db-background")
+
+
+async def read(func, *args, **kwargs):
+    """ Runs a blocking function that doesn't write to the database (queries, sheet requests) off the event loop """
+    return await asyncio.get_running_loop().run_in_executor(_readers, partial(func, *args, **kwargs))
+
+
+async def write(func, *args, **kwargs):
+    """ Runs a blocking function that writes to the database on the writer thread """
+    return await asyncio.get_running_loop().run_in_executor(_writer, partial(func, *args, **kwargs))
+
+
+async def background(func, *args, **kwargs):
+    """ Runs a long blocking job (e.g. a backup) one at a time on its own thread """
+    return await asyncio.get_running_loop().run_in_executor(_background, partial(func, *args, **kwargs))
+
+
+def shutdown():
+    """ Waits for pending queries and backups to finish, pending writes are never dropped """
+    _readers.shutdown(wait=True)
+    _writer.shutdown(wait=True)
+    _background.shutdown(wait=True)
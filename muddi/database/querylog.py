@@ -0,0 +1,91 @@
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from typing import Dict, List, Optional
+
+
+def shape(parameters) -> Optional[str]:
+    """ Types of the parameters without their values, e.g. "int, str" or "200 x int" for long IN lists """
+    if parameters is None:
+        return None
+    if isinstance(parameters, dict):
+        return ", ".join(f"{k}: {type(v).__name__}" for k, v in parameters.items())
+    types = [type(p).__name__ for p in parameters]
+    if len(types) > 10:
+        return ", ".join(f"{types.count(t)} x {t}" for t in dict.fromkeys(types))
+    return ", ".join(types)
+
+
+class QueryLog:
+    """
+    Opt-in statement statistics of the DB layer: count, total and longest time per statement, and a JSON line with
+    the parameters' shape and the query plan for every execution slower than threshold. The file is rotated at
+    max_bytes, keeping backups old files.
+    """
+    def __init__(self, path: str, threshold: float = 0.1, max_bytes=5 * 1024 * 1024, backups=3):
+        """ :param threshold: seconds """
+        self.path = path
+        self.threshold = threshold
+        # statement -> [count, total seconds, max seconds, slow count]
+        self.stats: Dict[str, List[float]] = {}
+        # query plans are explained once per statement
+        self._plans: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+        self._handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        self._handler.setFormatter(logging.Formatter("%(message)s"))
+        # not registered with logging.getLogger, so nothing else writes to or propagates from it
+        self._logger = logging.Logger("muddi.querylog")
+        self._logger.addHandler(self._handler)
+
+    def record(self, conn: sqlite3.Connection, key: str, sql: str, parameters, seconds: float, many=False):
+        """
+        :param key: the statement_key of sql
+        :param many: parameters is a sequence of parameter tuples of executemany
+        """
+        with self._lock:
+            stats = self.stats.setdefault(key, [0, 0.0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            if seconds < self.threshold:
+                return
+            stats[3] += 1
+        rows = None
+        if many:
+            parameters = list(parameters) if parameters is not None else []
+            rows, parameters = len(parameters), parameters[0] if parameters else None
+        entry = {"time": datetime.now().isoformat(timespec="milliseconds"), "ms": round(seconds * 1000, 3),
+                 "statement": key, "parameters": shape(parameters), "plan": self.plan(conn, key, sql, parameters)}
+        if rows is not None:
+            entry["rows"] = rows
+        self._logger.warning(json.dumps(entry))
+
+    def plan(self, conn: sqlite3.Connection, key: str, sql: str, parameters) -> List[str]:
+        if (plan := self._plans.get(key)) is None:
+            try:
+                rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", parameters or ()).fetchall()
+                plan = [detail for *_, detail in rows]
+            except sqlite3.Error as e:
+                plan = [f"couldn't explain: {e}"]
+            self._plans[key] = plan
+        return plan
+
+    def top(self, limit=15) -> List[str]:
+        """ The statements taking the most time in total """
+        with self._lock:
+            rows = sorted(self.stats.items(), key=lambda i: -i[1][1])[:limit]
+        return [f"{count:.0f}x, total {total:.2f} s, avg {total / count * 1000:.1f} ms, max {longest * 1000:.1f} ms, "
+                f"{slow:.0f} slow: {key if len(key) <= 120 else key[:117] + '...'}"
+                for key, (count, total, longest, slow) in rows]
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+            self._plans.clear()
+
+    def close(self):
+        self._logger.removeHandler(self._handler)
+        self._handler.close()
@@ -1,31 +1,64 @@
+from collections import Counter
 from datetime import timedelta, datetime, time
 from time import strptime, struct_time
-from typing import List, Dict
+from typing import List, Dict, Optional, Set, Iterable, Tuple
 from discord import Member
 
 import muddi.spreadsheet as sh
-from muddi.database.db import DB
+from muddi.database import executor
+from muddi.database.db import DB, rollup_groups, rebuild_rollups
 from muddi.spreadsheet import Spreadsheet
 from muddi.utils.tools import valid_discord
 
 
+class UserChanges:
+    """ Users to insert and update to bring the database in line with a source (sheet, discord members) """
+    def __init__(self):
+        self.inserts: List[User] = []
+        self.updates: Dict[int, User] = {}
+        self.unchanged = 0
+
+    def __str__(self):
+        return f"{len(self.inserts)} inserted, {len(self.updates)} updated, {self.unchanged} unchanged"
+
+    def __bool__(self):
+        return bool(self.inserts or self.updates)
+
+
 class User:
-    def __init__(self, user_id, name, discord_tag="", discord_id="", gender="n/a", member_type="n/a"):
+    insert_sql = """ INSERT INTO users(name, discord_tag, discord_id, gender, member_type, guild_id)
+                     VALUES(?,?,?,?,?,?) """
+    update_sql = """ UPDATE users
+                     SET name = ? ,
+                         discord_tag = ? ,
+                         discord_id = ? ,
+                         gender = ? ,
+                         member_type = ? ,
+                         guild_id = ?
+                     WHERE user_id = ? """
+
+    def __init__(self, user_id, name, discord_tag="", discord_id="", gender="n/a", member_type="n/a", guild_id=None):
         self.user_id: int = user_id
         self.name: str = name
         self.discord_tag: str = discord_tag
         self.discord_id: int = discord_id
         self.gender: str = gender
         self.member_type: str = member_type
+        # users are per guild, every club has its own sheet
+        self.guild_id: Optional[int] = guild_id
 
     def __str__(self):
         return f"User: {self.name}, ID: {self.user_id}, Discord: {self.discord_tag}, Gender: {self.gender}, Member: {self.member_type}"
 
-    def insert(self) -> bool:
-        db = DB()
-        sql = """ INSERT INTO users(name, discord_tag, discord_id, gender, member_type)
-                  VALUES(?,?,?,?,?) """
-        return db.commit(sql, (self.name, self.discord_tag, self.discord_id, self.gender, self.member_type))
+    def _values(self) -> tuple:
+        return self.name, self.discord_tag, self.discord_id, self.gender, self.member_type, self.guild_id
+
+    def insert(self) -> int:
+        """ :return: the new user_id, False on failure """
+        return DB().commit(User.insert_sql, self._values(), insert=True)
+
+    async def ainsert(self) -> int:
+        return await executor.write(self.insert)
 
     def remove(self):
         pass  # implementieren
@@ -33,32 +66,39 @@ class User:
     def update(self) -> bool:
         if not self.user_id:
             return False
+        return DB().commit(User.update_sql, self._values() + (self.user_id,))
+
+    async def aupdate(self) -> bool:
+        return await executor.write(self.update)
+
+    @classmethod
+    def apply(cls, changes: UserChanges) -> UserChanges:
+        """ Writes all inserts and updates in one transaction """
         db = DB()
-        sql = """ UPDATE users
-                  SET name = ? ,
-                      discord_tag = ? ,
-                      discord_id = ? ,
-                      gender = ? ,
-                      member_type = ?
-                    WHERE user_id = ? """
-        db.commit(sql, (self.name, self.discord_tag, self.discord_id, self.gender, self.member_type, self.user_id))
-
-    @classmethod
-    def update_from_sheet(cls):
-        """ Synchronizes the google sheet with the database """
-        sheet = Spreadsheet()
-        rows = sheet.get_users()
-        users = User.get_all()
-        u_tags = dict(list(map(lambda usr: (usr.discord_tag, usr), users)))
-        u_names = dict(list(map(lambda usr: (usr.name, usr), users)))
+        with db.transaction():
+            db.commit_many(User.insert_sql, [u._values() for u in changes.inserts])
+            db.commit_many(User.update_sql, [u._values() + (u.user_id,) for u in changes.updates.values()])
+        return changes
+
+    @classmethod
+    def diff_sheet(cls, rows: List[Dict[str, str]], users: List['User'], guild_id=None) -> UserChanges:
+        """
+        Compares the sheet rows with the users, matching them by discord tag, then by name
+        :param guild_id: guild of the sheet and the users, new users are created in it
+        """
+        changes = UserChanges()
+        u_tags = {usr.discord_tag: usr for usr in users}
+        u_names = {usr.name: usr for usr in users}
         for r in rows:
             rtag = r[sh.discord_tag].strip("@")
             rname = r[sh.u_name]
             rgender = r[sh.gender]
             rmember_type = r[sh.member_type]
-            if rtag and valid_discord(rtag) and rtag not in u_tags.keys():
-                User(None, rname, discord_tag=rtag, gender=r[sh.gender], member_type=r[sh.member_type]).insert()
-            elif (valid := (valid_discord(rtag))) or rname in u_names.keys():
+            if rtag and valid_discord(rtag) and rtag not in u_tags:
+                new = User(None, rname, discord_tag=rtag, gender=rgender, member_type=rmember_type, guild_id=guild_id)
+                changes.inserts.append(new)
+                u_tags[rtag] = new
+            elif (valid := (valid_discord(rtag))) or rname in u_names:
                 user = u_tags[rtag] if valid else u_names[rname]
                 edited = False
                 if user.name != rname:
@@ -70,71 +110,182 @@ class User:
                 if user.member_type != rmember_type:
                     edited = True
                     user.member_type = rmember_type
-                if user.discord_tag != rtag and valid_discord(rtag):
+                if user.discord_tag != rtag and valid:
                     edited = True
                     user.discord_tag = rtag
-                if edited:
-                    user.update()
-            elif rname and rname not in u_names.keys():
-                User(None, rname, gender=rgender, member_type=rmember_type).insert()
-
-    @classmethod
-    def update_from_discord_members(cls, members: List[Member]):
-        all_users = User.get_all()
-        ids = list(map(lambda u: u.discord_id, all_users))
-        member_tags: Dict[str, Member] = dict(map(lambda m: (str(m), m), members))
-        member_ids: Dict[int, Member] = dict(map(lambda m: (m.id, m), members))
-        for user in all_users:
+                if not edited:
+                    changes.unchanged += 1
+                # users inserted by an earlier row are written with their latest values anyway
+                elif user.user_id:
+                    changes.updates[user.user_id] = user
+            elif rname and rname not in u_names:
+                new = User(None, rname, gender=rgender, member_type=rmember_type, guild_id=guild_id)
+                changes.inserts.append(new)
+                u_names[rname] = new
+        return changes
+
+    @classmethod
+    def update_from_sheet(cls, rows: List[Dict[str, str]] = None, guild: 'Guild' = None) -> UserChanges:
+        """
+        Synchronizes the google sheet of a guild with its users in the database
+        :param rows: the sheet's user rows, fetched if not given
+        :param guild: the default sheet and the users without guild if not given
+        """
+        guild_id = guild.guild_id if guild else None
+        rows = rows if rows is not None else Guild.spreadsheet_of(guild).get_users()
+        return User.apply(User.diff_sheet(rows, User.get_all(guild_id), guild_id))
+
+    @classmethod
+    async def aupdate_from_sheet(cls, guild: 'Guild' = None) -> UserChanges:
+        # fetch the sheet without holding up database writes
+        rows = await executor.read(Guild.spreadsheet_of(guild).get_users)
+        return await executor.write(cls.update_from_sheet, rows, guild)
+
+    @classmethod
+    def diff_discord_members(cls, members: List[Member], users: List['User'], guild_id=None) -> UserChanges:
+        """ Compares the guild members with the users of the guild in one pass over each """
+        changes = UserChanges()
+        ids = {u.discord_id for u in users if u.discord_id}
+        member_tags: Dict[str, Member] = {str(m): m for m in members}
+        member_ids: Dict[int, Member] = {m.id: m for m in members}
+        for user in users:
             utag = user.discord_tag
             uid = user.discord_id
             # add discord id if not in database
-            if utag in member_tags.keys() and not user.discord_id:
+            if utag in member_tags and not uid:
                 user.discord_id = member_tags[utag].id
-                user.update()
-                ids.append(user.discord_id)
+                changes.updates[user.user_id] = user
+                ids.add(user.discord_id)
             # update discord tag if changed TODO: will lead to new user being added if old discord tag is still in sheet
-            elif uid in member_ids.keys() and utag != (tag := str(member_ids[uid])):
+            elif uid in member_ids and utag != (tag := str(member_ids[uid])):
                 user.discord_tag = tag
-                user.update()
-        remaining: List[Member] = list(filter(lambda m: m.id not in ids, members))
-        for member in remaining:
-            User(None, name=member.display_name, discord_tag=str(member), discord_id=member.id).insert()
+                changes.updates[user.user_id] = user
+            else:
+                changes.unchanged += 1
+        changes.inserts.extend(User(None, name=m.display_name, discord_tag=str(m), discord_id=m.id, guild_id=guild_id)
+                               for m in members if m.id not in ids)
+        return changes
+
+    @classmethod
+    def update_from_discord_members(cls, members: List[Member], guild_id=None) -> UserChanges:
+        members = list(members)
+        return User.apply(User.diff_discord_members(members, User.get_all(guild_id), guild_id))
+
+    @classmethod
+    def update_from_member(cls, member: Member, guild_id=None) -> UserChanges:
+        """ update_from_discord_members for a single member, only looks at the users it could match """
+        db = DB()
+        sql = """ SELECT * FROM users WHERE guild_id IS ? AND (discord_id=? OR discord_tag=?) """
+        with db.transaction():
+            users = [User(*x) for x in db.select(sql, (guild_id, member.id, str(member)))]
+            return User.apply(User.diff_discord_members([member], users, guild_id))
 
     @classmethod
-    def sync(cls, members: List[Member]):
-        User.update_from_sheet()
-        User.update_from_discord_members(members)
+    async def aupdate_from_member(cls, member: Member, guild_id=None) -> UserChanges:
+        return await executor.write(cls.update_from_member, member, guild_id)
 
     @classmethod
-    def get_guest_for_name(cls, name):
+    def sync(cls, members: List[Member], guild: 'Guild' = None):
+        User.update_from_sheet(guild=guild)
+        User.update_from_discord_members(members, guild.guild_id if guild else None)
+
+    @classmethod
+    async def async_sync(cls, members: List[Member], guild: 'Guild' = None) -> (UserChanges, UserChanges):
+        """ :return: the changes from the sheet and from the discord members """
+        return await cls.aupdate_from_sheet(guild), await executor.write(
+            cls.update_from_discord_members, list(members), guild.guild_id if guild else None)
+
+    @classmethod
+    def get_guest_for_name(cls, name, guild_id=None):
         db = DB()
-        sql = """ SELECT * FROM users WHERE name=? AND member_type=?"""
-        data = db.select(sql, (name, sh.GUEST))
+        sql = """ SELECT * FROM users WHERE guild_id IS ? AND name=? AND member_type=?"""
+        data = db.select(sql, (guild_id, name, sh.GUEST))
         return User(*data[0]) if data else None
 
     @classmethod
-    def get_for_discord_id_or_tag(cls, discord_id, discord_tag=None):
+    async def aget_guest_for_name(cls, name, guild_id=None):
+        return await executor.read(cls.get_guest_for_name, name, guild_id)
+
+    @classmethod
+    def get_for_discord_id_or_tag(cls, discord_id, discord_tag=None, guild_id=None):
         db = DB()
-        sql = """ SELECT * FROM users WHERE discord_id=? OR discord_tag=? """
-        ls = db.select(sql, (discord_id, discord_tag))
+        sql = """ SELECT * FROM users WHERE guild_id IS ? AND (discord_id=? OR discord_tag=?) """
+        ls = db.select(sql, (guild_id, discord_id, discord_tag))
         return User(*ls[0]) if ls else None  # todo change to all results?
 
     @classmethod
-    def get_for_id(cls, user_id):
+    async def aget_for_discord_id_or_tag(cls, discord_id, discord_tag=None, guild_id=None):
+        return await executor.read(cls.get_for_discord_id_or_tag, discord_id, discord_tag, guild_id)
+
+    @classmethod
+    def get_for_id(cls, user_id) -> Optional['User']:
         db = DB()
         sql = """ SELECT * FROM users WHERE user_id=?"""
-        return User(*db.select(sql, (user_id,))[0])
+        result = db.select(sql, (user_id,))
+        return User(*result[0]) if result else None
 
     @classmethod
-    def get_all(cls):
+    def get_all(cls, guild_id=None):
+        """ All users of a guild, None for the users without guild """
         db = DB()
-        sql = """ SELECT * FROM users """
-        return [User(*x) for x in db.select(sql)]
+        sql = """ SELECT * FROM users WHERE guild_id IS ? """
+        return [User(*x) for x in db.select(sql, (guild_id,))]
+
+    @classmethod
+    async def aget_all(cls, guild_id=None):
+        return await executor.read(cls.get_all, guild_id)
+
+
+class Guild:
+    """
+    Configuration of a discord server using the bot. Users and trainings belong to one guild, guild_id None stands for
+    the ones created without a guild, e.g. in the tests.
+    """
+    def __init__(self, guild_id, posting_channel=None, managing_channel=None, schedule_key=None, club_key=None):
+        self.guild_id: int = guild_id
+        self.posting_channel: int = posting_channel
+        self.managing_channel: int = managing_channel
+        # spreadsheets with the schedules and guests, and with the players
+        self.schedule_key: str = schedule_key
+        self.club_key: str = club_key
+
+    def spreadsheet(self) -> Spreadsheet:
+        return Spreadsheet(schedule=self.schedule_key, club=self.club_key)
+
+    @classmethod
+    def spreadsheet_of(cls, guild: Optional['Guild']) -> Spreadsheet:
+        """ The guild's sheets, the ones configured in the secrets without a guild """
+        return guild.spreadsheet() if guild else Spreadsheet()
+
+    def save(self) -> bool:
+        sql = """
+            INSERT INTO guilds(guild_id, posting_channel, managing_channel, schedule_key, club_key) VALUES(?,?,?,?,?)
+            ON CONFLICT(guild_id) DO UPDATE SET posting_channel = excluded.posting_channel,
+                managing_channel = excluded.managing_channel, schedule_key = excluded.schedule_key,
+                club_key = excluded.club_key"""
+        return DB().commit(sql, (self.guild_id, self.posting_channel, self.managing_channel, self.schedule_key,
+                                 self.club_key))
+
+    async def asave(self) -> bool:
+        return await executor.write(self.save)
+
+    @classmethod
+    def get_for_id(cls, guild_id) -> Optional['Guild']:
+        result = DB().select("SELECT * FROM guilds WHERE guild_id = ?", (guild_id,))
+        return Guild(*result[0]) if result else None
+
+    @classmethod
+    def get_all(cls) -> List['Guild']:
+        return [Guild(*x) for x in DB().select("SELECT * FROM guilds")]
+
+    @classmethod
+    async def aget_all(cls) -> List['Guild']:
+        return await executor.read(cls.get_all)
 
 
 class Schedule:
     """ Make sure that local time is set correctly! """
-    def __init__(self, weekday, start: str, end: str, coach, location, description, notification):
+    def __init__(self, weekday, start: str, end: str, coach, location, description, notification, guild_id=None):
         self.weekday: str = weekday
         self.start: struct_time = strptime(start, "%H:%M")
         self.end: struct_time = strptime(end, "%H:%M")
@@ -142,6 +293,7 @@ class Schedule:
         self.location = location
         self.description = description
         self.notification = notification
+        self.guild_id: Optional[int] = guild_id
 
     def insert(self):
         raise NotImplementedError
@@ -151,54 +303,84 @@ class Schedule:
         return {"Monday": 0, "Tuesday": 1, "Wednesday": 2, "Thursday": 3,
                 "Friday": 4, "Saturday": 5, "Sunday": 6}[day]
 
-    def next_notification(self, reference: datetime = datetime.today()):
+    def next_notification(self, reference: datetime = None):
+        reference = reference or datetime.today()
         week_before = self.next_training(reference).start.date() - timedelta(days=7)
         day_diff = (self.weekdayint(self.notification) - week_before.weekday()) % 7
         return week_before + timedelta(days=day_diff)
 
-    def next_training(self, reference: datetime = datetime.today()):
+    def next_training(self, reference: datetime = None):
         """
         Create the next Training instance of this Schedule of the coming 7 days, including today
         :return:
         """
+        reference = reference or datetime.today()
         day_diff = (self.weekdayint() - reference.weekday()) % 7
         stime, etime = tuple([time(hour=x.tm_hour, minute=x.tm_min) for x in [self.start, self.end]])
         stime, etime = tuple([datetime.combine(reference + timedelta(days=day_diff), x) for x in [stime, etime]])
 
-        return Training(None, stime, etime, self.location, self.coach, self.description)
+        return Training(None, stime, etime, self.location, self.coach, self.description, guild_id=self.guild_id)
 
     def scheduled(self):
         """checks if a training within the next 7 days for this schedule has been created"""
-        nt = self.next_training()
-        result = None
-        try:
-            db = DB()
-            sql = """
-            SELECT * FROM trainings
-            WHERE start = ? AND end = ? AND location = ? """
-            trainings = db.select(sql, (nt.start, nt.end, nt.location))
-            if trainings:
-                result = Training(*trainings[0])
-            else:
-                result = None
-        except Exception as e:
-            print("Error when executing Schedule.scheduled()!")
-        finally:
-            return result
+        return Schedule.scheduled_trainings([self])[self]
+
+    async def ascheduled(self):
+        return await executor.read(self.scheduled)
+
+    @classmethod
+    def scheduled_trainings(cls, schedules: List['Schedule'], reference: datetime = None) \
+            -> Dict['Schedule', Optional['Training']]:
+        """
+        Bulk version of scheduled(): matches the next training of every schedule against the trainings table
+        with one query (per 200 schedules, to stay below SQLite's variable limit). Trainings of other guilds don't
+        match.
+        :return: the created training for every schedule, None if it hasn't been created yet
+        """
+        reference = reference or datetime.today()
+        result = dict.fromkeys(schedules)
+        chunk = 200
+        for i in range(0, len(schedules), chunk):
+            part = schedules[i:i + chunk]
+            upcoming = [s.next_training(reference) for s in part]
+            sql = f"""
+            WITH upcoming(idx, start, end, location, guild_id) AS (VALUES {','.join(['(?,?,?,?,?)'] * len(part))})
+            SELECT upcoming.idx, trainings.* FROM upcoming
+            INNER JOIN trainings ON trainings.start = upcoming.start AND trainings.end = upcoming.end
+                AND trainings.location = upcoming.location AND trainings.guild_id IS upcoming.guild_id
+            ORDER BY trainings.training_id DESC"""
+            parameters = [v for idx, nt in enumerate(upcoming)
+                          for v in (idx, nt.start, nt.end, nt.location, nt.guild_id)]
+            try:
+                # descending ids, so the oldest match wins like in a single lookup
+                for idx, *row in DB().select(sql, parameters):
+                    result[part[idx]] = Training(*row)
+            except Exception as e:
+                print("Error when executing Schedule.scheduled_trainings()!")
+        return result
+
+    @classmethod
+    async def ascheduled_trainings(cls, schedules: List['Schedule'], reference: datetime = None) \
+            -> Dict['Schedule', Optional['Training']]:
+        return await executor.read(cls.scheduled_trainings, schedules, reference)
 
     def remove(self):
         raise NotImplementedError
 
     @classmethod
-    def get_schedules(cls):
-        sheet = Spreadsheet()
-        rows = sheet.get_schedules()
+    def get_schedules(cls, guild: Guild = None):
+        rows = Guild.spreadsheet_of(guild).get_schedules()
         return [Schedule(r[sh.day], r[sh.start], r[sh.end], r[sh.coach], r[sh.location],
-                         r[sh.description], r[sh.notification]) for r in rows]
+                         r[sh.description], r[sh.notification], guild.guild_id if guild else None) for r in rows]
+
+    @classmethod
+    async def aget_schedules(cls, guild: Guild = None):
+        return await executor.read(cls.get_schedules, guild)
 
 
 class Training:
-    def __init__(self, training_id, start, end, location, coach, description="", cancelled=0, message_id=None):
+    def __init__(self, training_id, start, end, location, coach, description="", cancelled=0, message_id=None,
+                 guild_id=None):
         self.training_id = training_id
         self.start: datetime = start
         self.end: datetime = end
@@ -207,7 +389,27 @@ class Training:
         self.description = description
         self.cancelled = cancelled
         self.message_id = message_id
-        self._participants = None
+        self.guild_id: Optional[int] = guild_id
+        self._participants: Optional[List[User]] = None
+        # discord ids and gender counts of the participants, kept in sync with _participants for O(1) lookups
+        self._discord_ids: Set[int] = set()
+        self._genders: Counter = Counter()
+
+    def _set_participants(self, users: List[User]):
+        self._participants = users
+        self._discord_ids = {u.discord_id for u in users if u.discord_id}
+        self._genders = Counter(u.gender for u in users)
+
+    def _added(self, user: User):
+        self._participants.append(user)
+        if user.discord_id:
+            self._discord_ids.add(user.discord_id)
+        self._genders[user.gender] += 1
+
+    def _removed(self, user: User):
+        self._participants.remove(user)
+        self._discord_ids.discard(user.discord_id)
+        self._genders[user.gender] -= 1
 
     def insert(self):
         if (not self.message_id) or self.training_id:
@@ -215,18 +417,29 @@ class Training:
             return False
         try:
             sql = """
-            INSERT INTO trainings(start, end, location, coach, description, cancelled, message_id)
-            VALUES(?,?,?,?,?,?,?)
+            INSERT INTO trainings(start, end, location, coach, description, cancelled, message_id, guild_id)
+            VALUES(?,?,?,?,?,?,?,?)
             """
             db = DB()
-            return db.commit(sql, (self.start, self.end, self.location, self.coach, self.description,
-                        self.cancelled, self.message_id), insert=True)
+            with db.transaction():
+                training_id = db.commit(sql, (self.start, self.end, self.location, self.coach, self.description,
+                                              self.cancelled, self.message_id, self.guild_id), insert=True)
+                # the rollups are keyed by the new id
+                self.training_id = training_id
+                if not self.cancelled:
+                    Stats.apply(self, trainings=1)
+            return training_id
         except Exception as e:
+            self.training_id = None
+            if db.in_transaction():
+                raise
             print("couldn't insert")
 
+    async def ainsert(self):
+        return await executor.write(self.insert)
+
     def update(self):
         if self.training_id:
-            set = lambda x: f"{x} = ?"
             db = DB()
             sql = """
                 UPDATE trainings
@@ -238,8 +451,19 @@ class Training:
                     cancelled = ?,
                     message_id = ? 
                 WHERE training_id = ?"""
-            db.commit(sql, (self.start, self.end, self.location, self.coach,
-                            self.description, self.cancelled, self.message_id, self.training_id))
+            with db.transaction():
+                # the rollups only need to move if the training changes its groups or gets (un)cancelled
+                old = Training.get_for_id(self.training_id)
+                regroup = old and Stats.groups(old) != Stats.groups(self) or old and old.cancelled != self.cancelled
+                if regroup and not old.cancelled:
+                    Stats.apply(old, -1, trainings=1, participants=Stats.participant_rows(self.training_id))
+                db.commit(sql, (self.start, self.end, self.location, self.coach,
+                                self.description, self.cancelled, self.message_id, self.training_id))
+                if regroup and not self.cancelled:
+                    Stats.apply(self, trainings=1, participants=Stats.participant_rows(self.training_id))
+
+    async def aupdate(self):
+        return await executor.write(self.update)
 
     def remove(self):
         pass  # TODO: Implement
@@ -253,6 +477,10 @@ class Training:
         result = db.select(sql, (training_id,))
         return Training(*result[0]) if result else None
 
+    @classmethod
+    async def aget_for_id(cls, training_id):
+        return await executor.read(cls.get_for_id, training_id)
+
     @classmethod
     def get_for_message_ids(cls, ids: List[int]):
         # make list distinct
@@ -267,68 +495,493 @@ class Training:
         return [Training(*r) for r in result]
 
     @classmethod
-    def select_next_trainings(cls, day_offset=7, reference=datetime.today(), include_cancelled=False):
+    async def aget_for_message_ids(cls, ids: List[int]):
+        return await executor.read(cls.get_for_message_ids, ids)
+
+    @classmethod
+    def select_next_trainings(cls, day_offset=7, reference=None, include_cancelled=False, guild_id=None):
+        reference = reference or datetime.today()
         offset_time = reference + timedelta(days=day_offset)
         sql = """
             SELECT * FROM trainings
-            WHERE start > ? and start <= ?
-            """ if include_cancelled else """ SELECT * FROM trainings Where start > ? and start <= ? and cancelled = 0"""
+            WHERE start > ? and start <= ? and guild_id IS ?
+            """ if include_cancelled else """ SELECT * FROM trainings Where start > ? and start <= ? and cancelled = 0
+                                              and guild_id IS ?"""
+        db = DB()
+        return [Training(*x) for x in db.select(sql, (reference, offset_time, guild_id))]
+
+    @classmethod
+    async def aselect_next_trainings(cls, day_offset=7, reference=None, include_cancelled=False, guild_id=None):
+        return await executor.read(cls.select_next_trainings, day_offset=day_offset,
+                                   reference=reference, include_cancelled=include_cancelled, guild_id=guild_id)
+
+    @classmethod
+    def select_active(cls, ended_since: timedelta, day_offset=7, reference=None):
+        """
+        Trainings of all guilds starting in the next days or having ended within ended_since. Cancelled ones are
+        included, their posts stay watched like the ones cancelled while the bot runs, until they expire.
+        """
+        reference = reference or datetime.today()
+        sql = """ SELECT * FROM trainings WHERE end > ? AND start <= ? """
         db = DB()
-        return [Training(*x) for x in db.select(sql, (reference, offset_time, ))]
+        return [Training(*x) for x in db.select(sql, (reference - ended_since, reference + timedelta(days=day_offset)))]
 
-    def add_participant(self, user_id) -> bool:
+    @classmethod
+    async def aselect_active(cls, ended_since: timedelta, day_offset=7, reference=None):
+        return await executor.read(cls.select_active, ended_since, day_offset=day_offset, reference=reference)
+
+    @classmethod
+    def active_version(cls, ended_since: timedelta, day_offset=7, reference=None) -> Optional[str]:
+        """
+        Changes whenever select_active would return other trainings or one of them changes: any of its columns, like
+        cancelled, message_id or the ones edited by commands, or who takes part
+        """
+        reference = reference or datetime.today()
         sql = """
-            INSERT INTO participants(user_id, training_id)
-            VALUES(?,?)
+            SELECT group_concat(t.training_id || ':' || t.start || ':' || t.end || ':' || t.location || ':' ||
+                                COALESCE(t.coach, '') || ':' || COALESCE(t.description, '') || ':' || t.cancelled ||
+                                ':' || COALESCE(t.message_id, '') || ':' ||
+                                COALESCE((SELECT group_concat(p.user_id, ',') FROM participants AS p
+                                          WHERE p.training_id = t.training_id), ''), ';')
+            FROM (SELECT * FROM trainings WHERE end > ? AND start <= ? ORDER BY training_id) AS t"""
+        return DB().select(sql, (reference - ended_since, reference + timedelta(days=day_offset)))[0][0]
+
+    @classmethod
+    async def aactive_version(cls, ended_since: timedelta, day_offset=7, reference=None) -> Optional[str]:
+        return await executor.read(cls.active_version, ended_since, day_offset=day_offset, reference=reference)
+
+    def _counted(self) -> Optional['Training']:
+        """
+        The training as committed, if it counts towards the rollups. Commands change cancelled, start or coach before
+        update() commits them, so participant changes in between have to go by the database, inside their transaction.
+        """
+        stored = Training.get_for_id(self.training_id)
+        return stored if stored and not stored.cancelled else None
+
+    def _insert_participant(self, db: DB, user: User) -> int:
+        """ Part of the caller's transaction, moves the rollups along. :return: 0 if the user takes part already """
+        sql = """
+            INSERT OR IGNORE INTO participants(user_id, training_id, gender, member_type)
+            VALUES(?,?,?,?)
             """
-        db = DB()
-        if self.participants:
-            self._participants.append(User.get_for_id(user_id))  # ugly?
-        else:
-            self._participants = [(User.get_for_id(user_id))]
-        return db.commit(sql, (user_id, self.training_id))
+        parameters = (user.user_id, self.training_id, user.gender, user.member_type)
+        if (changes := db.commit(sql, parameters, changes=True)) and (counted := self._counted()):
+            Stats.apply(counted, participants=[(user.user_id, user.gender, user.member_type, 0)])
+        return changes
 
-    def remove_participant(self, user_id) -> bool:
+    def _delete_participant(self, db: DB, user_id) -> bool:
+        """ Part of the caller's transaction, moves the rollups along """
         sql = """
             DELETE FROM participants WHERE user_id=? AND training_id=?
             """
+        rows = Stats.participant_rows(self.training_id, user_id)
+        success = db.commit(sql, (user_id, self.training_id))
+        if rows and (counted := self._counted()):
+            Stats.apply(counted, -1, participants=rows)
+        return success
+
+    @classmethod
+    def write_participants(cls, changes: List[Tuple['Training', User, bool]]):
+        """
+        Registers (True) or unregisters (False) users of trainings in one transaction. The cached participants aren't
+        touched, the caller has updated them already. Raises if the transaction fails.
+        """
         db = DB()
-        if self.participants:
-            self._participants = list(filter(lambda u: u.user_id != user_id,self._participants))  # ugly?
-        else:
-            self._participants = []
-        return db.commit(sql, (user_id, self.training_id))
+        with db.transaction():
+            for training, user, add in changes:
+                if add:
+                    training._insert_participant(db, user)
+                else:
+                    training._delete_participant(db, user.user_id)
+
+    @classmethod
+    async def awrite_participants(cls, changes: List[Tuple['Training', User, bool]]):
+        await executor.write(cls.write_participants, changes)
+
+    @classmethod
+    def apply_reactions(cls, reactions: List[Tuple['Training', Dict[int, Tuple[str, str]]]]) -> List['Training']:
+        """
+        Brings the participants in line with the members reacting to the trainings' posts, in one transaction:
+        reacting members are registered, unknown ones created first, and members without a reaction unregistered.
+        Guests are left alone. The participants have to be loaded already.
+        :param reactions: per training the display name and tag of every reacting member by discord id
+        :return: the trainings whose participants changed
+        """
+        db = DB()
+        changes = []
+        with db.transaction():
+            for training, members in reactions:
+                for discord_id, (name, discord_tag) in members.items():
+                    if discord_id in training._discord_ids:
+                        continue
+                    if not (user := User.get_for_discord_id_or_tag(discord_id, "no tag", training.guild_id)):
+                        user = User(None, name=name, discord_tag=discord_tag, discord_id=discord_id,
+                                    guild_id=training.guild_id)
+                        user.user_id = user.insert()
+                    training._insert_participant(db, user)
+                    changes.append((training, user, True))
+                for user in training.participants:
+                    if user.discord_id and user.member_type != sh.GUEST and user.discord_id not in members:
+                        training._delete_participant(db, user.user_id)
+                        changes.append((training, user, False))
+        for training, user, add in changes:
+            if not add:
+                training._removed(user)
+            elif not any(u.user_id == user.user_id for u in training.participants):
+                training._added(user)
+        return list({training.training_id: training for training, _, _ in changes}.values())
+
+    @classmethod
+    async def aapply_reactions(cls, reactions: List[Tuple['Training', Dict[int, Tuple[str, str]]]]) -> List['Training']:
+        return await executor.write(cls.apply_reactions, reactions)
+
+    def add_participant(self, user_id, user: User = None) -> bool:
+        """
+        :param user: the participant's row, if the caller has it already. Saves a lookup.
+        :return: False if the user couldn't be added or takes part already
+        """
+        db = DB()
+        # load before inserting, otherwise the new participant would be loaded and added twice
+        self.participants
+        if not (user := user or User.get_for_id(user_id)):
+            return False
+        try:
+            with db.transaction():
+                success = self._insert_participant(db, user)
+        except Exception as e:
+            if db.in_transaction():
+                raise
+            print(e)
+            return False
+        # ignored if another instance registered them first, they still belong into this instance's participants
+        if success or not any(u.user_id == user_id for u in self.participants):
+            self._added(user)
+        return bool(success)
+
+    async def aadd_participant(self, user_id, user: User = None) -> bool:
+        return await executor.write(self.add_participant, user_id, user)
+
+    def add_member(self, discord_id, name, discord_tag) -> bool:
+        """ Registers a discord member, creating the user first if they are unknown. Both share one commit. """
+        with DB().transaction():
+            if not (user := User.get_for_discord_id_or_tag(discord_id, "no tag", self.guild_id)):
+                user = User(None, name=name, discord_tag=discord_tag, discord_id=discord_id, guild_id=self.guild_id)
+                user.user_id = user.insert()
+            return self.add_participant(user.user_id, user)
+
+    async def aadd_member(self, discord_id, name, discord_tag) -> bool:
+        return await executor.write(self.add_member, discord_id, name, discord_tag)
+
+    def remove_participant(self, user_id) -> bool:
+        db = DB()
+        removed = next((u for u in self.participants if u.user_id == user_id), None)
+        try:
+            with db.transaction():
+                success = self._delete_participant(db, user_id)
+        except Exception as e:
+            if db.in_transaction():
+                raise
+            print(e)
+            return False
+        if success and removed:
+            self._removed(removed)
+        return success
 
     def remove_guest_participant(self, name: str) -> bool:
-        guest = User.get_guest_for_name(name)
+        guest = User.get_guest_for_name(name, self.guild_id)
         return self.remove_participant(guest.user_id) if guest else False
 
+    async def aremove_participant(self, user_id) -> bool:
+        return await executor.write(self.remove_participant, user_id)
+
+    async def aremove_guest_participant(self, name: str) -> bool:
+        return await executor.write(self.remove_guest_participant, name)
+
     def no_show(self, user_id):
-        if not next((usr for usr in self.participants if u.user_id == user_id), False):
+        if not next((usr for usr in self.participants if usr.user_id == user_id), False):
             return False
         else:
             sql = """
                 UPDATE participants
-                SET no_show = 1
-                WHERE training_id = ? AND user_id = ?"""
+                SET noshow = 1
+                WHERE training_id = ? AND user_id = ? AND noshow = 0"""
             db = DB()
-            return db.commit(sql, (self.training_id, user_id))
+            try:
+                with db.transaction():
+                    if db.commit(sql, (self.training_id, user_id), changes=True) and (counted := self._counted()):
+                        Stats.apply(counted, noshows=[user_id])
+            except Exception as e:
+                if db.in_transaction():
+                    raise
+                print(e)
+                return False
+            return True
+
+    async def ano_show(self, user_id):
+        return await executor.write(self.no_show, user_id)
+
+    def has_member(self, discord_id) -> bool:
+        """ Whether the discord user takes part. Loads the participants if they haven't been loaded yet. """
+        if self._participants is None:
+            self.participants
+        return discord_id in self._discord_ids
+
+    @property
+    def gender_counts(self) -> Counter:
+        """ Number of participants per gender, maintained incrementally """
+        self.participants
+        return self._genders
+
+    def participant_for_member(self, discord_id) -> Optional[User]:
+        if not self.has_member(discord_id):
+            return None
+        return next((u for u in self._participants if u.discord_id == discord_id), None)
 
     @property
     def participants(self) -> [User]:
-        if not self._participants:
+        if self._participants is None:
             sql = """
-            SELECT u.user_id, u.name, u.discord_tag, u.discord_id, u.gender, u.member_type
+            SELECT u.user_id, u.name, u.discord_tag, u.discord_id, u.gender, u.member_type, u.guild_id
             FROM ( 
                 users AS u
                 INNER JOIN participants ON participants.user_id = u.user_id)
             INNER JOIN trainings ON participants.training_id = trainings.training_id
             WHERE trainings.training_id = ?
+            ORDER BY participants.rowid
             """
             db = DB()
-            self._participants = [User(*x) for x in db.select(sql, (self.training_id,))]
+            self._set_participants([User(*x) for x in db.select(sql, (self.training_id,))])
         return self._participants
 
+    @classmethod
+    def load_participants(cls, trainings: List['Training']) -> List['Training']:
+        """ Loads the participants of all given trainings that haven't been loaded yet with one query per 500 """
+        pending = {tr.training_id: tr for tr in trainings if tr._participants is None}
+        ids = list(pending)
+        chunk = 500
+        for i in range(0, len(ids), chunk):
+            part = ids[i:i + chunk]
+            sql = f"""
+            SELECT participants.training_id, u.user_id, u.name, u.discord_tag, u.discord_id, u.gender, u.member_type,
+                   u.guild_id
+            FROM users AS u
+            INNER JOIN participants ON participants.user_id = u.user_id
+            WHERE participants.training_id IN ({','.join(['?'] * len(part))})
+            ORDER BY participants.rowid"""
+            grouped: Dict[int, List[User]] = {tid: [] for tid in part}
+            for training_id, *row in DB().select(sql, part):
+                grouped[training_id].append(User(*row))
+            for training_id, users in grouped.items():
+                pending[training_id]._set_participants(users)
+        return trainings
+
+    attendance_header = ["training id", "start", "location", "coach", "cancelled", "name", "member type", "noshow"]
+
+    @classmethod
+    def attendance(cls, training_ids: List[int] = None, since: datetime = None, until: datetime = None,
+                   guild_id=None):
+        """
+        Yields one row per participant (see attendance_header) of the given trainings or the trainings starting in
+        [since, until), ordered by start and registration. Rows are streamed from a single query.
+        Only trainings of the guild are included.
+        """
+        if training_ids is not None:
+            condition = f"trainings.training_id IN ({','.join(['?'] * len(training_ids))})"
+            parameters = list(training_ids)
+        else:
+            condition = "trainings.start >= ? AND trainings.start < ?"
+            parameters = [since or datetime.min, until or datetime.max]
+        sql = f"""
+            SELECT trainings.training_id, trainings.start, trainings.location, trainings.coach, trainings.cancelled,
+                   u.name, u.member_type, participants.noshow
+            FROM participants
+            INNER JOIN trainings ON participants.training_id = trainings.training_id
+            INNER JOIN users AS u ON participants.user_id = u.user_id
+            WHERE {condition} AND trainings.guild_id IS ?
+            ORDER BY trainings.start, participants.rowid"""
+        return DB().iterate(sql, parameters + [guild_id])
+
+    @classmethod
+    async def aload_participants(cls, trainings: List['Training']) -> List['Training']:
+        return await executor.read(cls.load_participants, trainings)
+
+    async def aparticipants(self) -> [User]:
+        """ Awaitable version of the participants property, only queries if they haven't been loaded yet """
+        if self._participants is not None:
+            return self._participants
+        return await executor.read(lambda: self.participants)
+
+
+class Stats:
+    """
+    Attendance rollups of the trainings that aren't cancelled, moved by deltas in the same transaction as the change
+    of participants or trainings, so reading them never touches the history. Gender and member type are counted as
+    they were at registration, participants keep them for unregistering and rebuild().
+    """
+    training_columns = ["participants", "women", "men", "guests", "noshows"]
+
+    @classmethod
+    def groups(cls, training: Training) -> List[Tuple[str, str]]:
+        """ (kind, key) of the group_stats rows a training counts towards, see db.rollup_groups """
+        return [("month", str(training.start)[:7]), ("coach", training.coach or ""), ("location", training.location)]
+
+    @classmethod
+    def participant_rows(cls, training_id, user_id=None) -> List[Tuple[int, str, str, int]]:
+        """ (user_id, gender, member_type, noshow) of the participants of a training, or just of one user """
+        sql = """
+            SELECT user_id, gender, member_type, noshow
+            FROM participants
+            WHERE training_id = ?"""
+        parameters = [training_id]
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            parameters.append(user_id)
+        return DB().select(sql, parameters)
+
+    @classmethod
+    def apply(cls, training: Training, sign=1, trainings=0,
+              participants: Iterable[Tuple[int, str, str, int]] = (), noshows: Iterable[int] = ()):
+        """
+        Adds (or subtracts with sign=-1) to the rollups of a training and its participants.
+        Has to run in the transaction that changes the counted rows.
+        :param trainings: 1 if the training itself starts or stops counting
+        :param participants: (user_id, gender, member_type, noshow) of registrations
+        :param noshows: user ids of participants who became no-shows
+        """
+        db = DB()
+        users: Dict[int, List[int]] = {}
+        totals = dict.fromkeys(cls.training_columns, 0)
+        for user_id, gender, member_type, noshow in participants:
+            counts = users.setdefault(user_id, [0, 0])
+            counts[0] += sign
+            counts[1] += sign * noshow
+            totals["participants"] += sign
+            totals["women"] += sign * (gender == 'w')
+            totals["men"] += sign * (gender == 'm')
+            totals["guests"] += sign * (member_type == sh.GUEST)
+            totals["noshows"] += sign * noshow
+        for user_id in noshows:
+            users.setdefault(user_id, [0, 0])[1] += sign
+            totals["noshows"] += sign
+        if users:
+            db.commit_many("""
+                INSERT INTO user_stats(user_id, registrations, noshows) VALUES(?,?,?)
+                ON CONFLICT(user_id) DO UPDATE SET registrations = registrations + excluded.registrations,
+                                                   noshows = noshows + excluded.noshows""",
+                           [(user_id, r, n) for user_id, (r, n) in users.items()])
+            if sign < 0:
+                # like rebuild, which only has rows for users with registrations
+                db.commit_many("DELETE FROM user_stats WHERE user_id = ? AND registrations = 0",
+                               [(user_id,) for user_id in users])
+        values = [totals[c] for c in cls.training_columns]
+        updates = ", ".join(f"{c} = {c} + excluded.{c}" for c in cls.training_columns)
+        db.commit(f"""
+            INSERT INTO training_stats(training_id, {', '.join(cls.training_columns)}) VALUES(?,?,?,?,?,?)
+            ON CONFLICT(training_id) DO UPDATE SET {updates}""", [training.training_id] + values)
+        if trainings and sign < 0:
+            db.commit("DELETE FROM training_stats WHERE training_id = ?", (training.training_id,))
+        db.commit_many(f"""
+            INSERT INTO group_stats(guild_id, kind, key, trainings, {', '.join(cls.training_columns)})
+            VALUES(?,?,?,?,?,?,?,?,?)
+            ON CONFLICT(guild_id, kind, key) DO UPDATE SET trainings = trainings + excluded.trainings, {updates}""",
+                       [(training.guild_id or 0, kind, key, sign * trainings, *values)
+                        for kind, key in cls.groups(training)])
+        if trainings and sign < 0:
+            db.commit_many("DELETE FROM group_stats WHERE guild_id = ? AND kind = ? AND key = ? AND trainings = 0",
+                           [(training.guild_id or 0, kind, key) for kind, key in cls.groups(training)])
+
+    @classmethod
+    def rebuild(cls) -> bool:
+        """ Recounts all rollups from participants and trainings """
+        try:
+            with DB().transaction() as conn:
+                rebuild_rollups(conn)
+            return True
+        except Exception as e:
+            print(e)
+            return False
+
+    @classmethod
+    async def arebuild(cls) -> bool:
+        return await executor.write(cls.rebuild)
+
+    @classmethod
+    def for_user(cls, user_id) -> Tuple[int, int]:
+        """ :return: registrations and no-shows """
+        result = DB().select("SELECT registrations, noshows FROM user_stats WHERE user_id = ?", (user_id,))
+        return tuple(result[0]) if result else (0, 0)
+
+    @classmethod
+    def for_training(cls, training_id) -> Optional[Dict[str, int]]:
+        """ :return: counts per training_columns, None for unknown or cancelled trainings """
+        result = DB().select(f"SELECT {', '.join(cls.training_columns)} FROM training_stats WHERE training_id = ?",
+                             (training_id,))
+        return dict(zip(cls.training_columns, result[0])) if result else None
+
+    @classmethod
+    def for_groups(cls, kind, guild_id=None) -> List[Tuple]:
+        """ :return: (key, trainings, participants, women, men, guests, noshows) of each group of a kind in a guild """
+        if kind not in rollup_groups:
+            raise ValueError(f"unknown kind {kind}")
+        return DB().select(f"""
+            SELECT key, trainings, {', '.join(cls.training_columns)} FROM group_stats
+            WHERE guild_id = ? AND kind = ? ORDER BY key""", (guild_id or 0, kind))
+
+    @classmethod
+    async def afor_user(cls, user_id) -> Tuple[int, int]:
+        return await executor.read(cls.for_user, user_id)
+
+    @classmethod
+    async def afor_training(cls, training_id) -> Optional[Dict[str, int]]:
+        return await executor.read(cls.for_training, training_id)
+
+    @classmethod
+    async def afor_groups(cls, kind, guild_id=None) -> List[Tuple]:
+        return await executor.read(cls.for_groups, kind, guild_id)
+
+
+class Lease:
+    """
+    A named lease in the database, held by one holder at a time. The holder renews it well before it expires, any
+    other holder can take it over once it has expired.
+    """
+    def __init__(self, name: str, holder: str, duration: timedelta = timedelta(seconds=30)):
+        self.name = name
+        self.holder = holder
+        self.duration = duration
+
+    def acquire(self, now: datetime = None) -> bool:
+        """
+        Takes the lease if it's free or expired, or renews it if this holder has it. The check and the write are one
+        statement, so two holders can't both get it.
+        :return: whether this holder has the lease now
+        """
+        now = now or datetime.today()
+        sql = """
+            INSERT INTO leases(name, holder, expires) VALUES(?,?,?)
+            ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires = excluded.expires
+            WHERE leases.holder = excluded.holder OR leases.expires <= ?"""
+        return bool(DB().commit(sql, (self.name, self.holder, now + self.duration, now), changes=True))
+
+    async def aacquire(self) -> bool:
+        return await executor.write(self.acquire)
+
+    def release(self) -> bool:
+        """ Gives up the lease so another holder can take over right away instead of waiting for it to expire """
+        return bool(DB().commit("DELETE FROM leases WHERE name = ? AND holder = ?", (self.name, self.holder),
+                                changes=True))
+
+    async def arelease(self) -> bool:
+        return await executor.write(self.release)
+
+    def current(self) -> Optional[Tuple[str, datetime]]:
+        """ :return: holder and expiry of the lease, None if nobody has taken it """
+        result = DB().select("SELECT holder, expires FROM leases WHERE name = ?", (self.name,))
+        return result[0] if result else None
+
+    async def acurrent(self) -> Optional[Tuple[str, datetime]]:
+        return await executor.read(self.current)
+
 
 if __name__ == '__main__':
     User.update_from_sheet()
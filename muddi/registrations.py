@@ -0,0 +1,192 @@
+import asyncio
+import contextlib
+import json
+import os
+from typing import Dict, Optional, Tuple
+
+from muddi.database import executor
+from muddi.models import Training, User
+from muddi.utils.metrics import metrics
+
+# training_id, user_id
+Key = Tuple[int, int]
+# training, user, True to register and False to unregister
+Change = Tuple[Training, User, bool]
+
+
+class RegistrationQueue:
+    """
+    Write-behind queue for the registrations by reaction. A change shows in the training's cached participants right
+    away and is committed later by a single writer task, together with everything queued while the previous batch was
+    written. Registering and unregistering the same user before it was written cancel out. Queued changes are appended
+    to a journal file until they are committed, so a crash doesn't lose them, see replay.
+    """
+    def __init__(self, journal: Optional[str] = None, retry: float = 1):
+        """
+        :param journal: file for the changes that haven't been committed yet, none are kept without it
+        :param retry: seconds to wait before writing a batch again after it failed
+        """
+        self.journal = journal
+        self.retry = retry
+        self._pending: Dict[Key, Change] = {}
+        # the batch being written right now
+        self._writing: Dict[Key, Change] = {}
+        self._file = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def pending(self, training_id) -> bool:
+        """ Whether changes of the training haven't been committed yet, so the database doesn't show them """
+        return any(key[0] == training_id for key in self._pending) or \
+            any(key[0] == training_id for key in self._writing)
+
+    def add(self, training: Training, user: User) -> bool:
+        """ :return: False if the user takes part already """
+        if any(u.user_id == user.user_id for u in training.participants):
+            return False
+        training._added(user)
+        self._queue(training, user, True)
+        return True
+
+    def remove(self, training: Training, user: User) -> bool:
+        """ :return: False if the user doesn't take part """
+        if not (removed := next((u for u in training.participants if u.user_id == user.user_id), None)):
+            return False
+        training._removed(removed)
+        self._queue(training, removed, False)
+        return True
+
+    async def add_member(self, training: Training, discord_id, name, discord_tag) -> bool:
+        """ Registers a discord member. Unknown members are created and registered right away in one commit. """
+        if not (user := await User.aget_for_discord_id_or_tag(discord_id, "no tag", training.guild_id)):
+            return await training.aadd_member(discord_id, name, discord_tag)
+        return self.add(training, user)
+
+    def _queue(self, training: Training, user: User, add: bool):
+        key = (training.training_id, user.user_id)
+        if (queued := self._pending.get(key)) and queued[2] != add:
+            del self._pending[key]
+        else:
+            self._pending[key] = (training, user, add)
+        self._append(training.training_id, user.user_id, add)
+        self._event().set()
+
+    def _append(self, training_id, user_id, add: bool):
+        if not self.journal:
+            return
+        if not self._file:
+            self._file = open(self.journal, "a", encoding="utf-8")
+        self._file.write(json.dumps({"training_id": training_id, "user_id": user_id, "add": add}) + "\n")
+        # into the OS buffers, which survive the process. Syncing every change to disk is what this queue avoids.
+        self._file.flush()
+
+    def _rewrite_journal(self):
+        """ Keeps only the changes that are still queued in the journal """
+        if not self.journal:
+            return
+        if self._file:
+            self._file.close()
+            self._file = None
+        temp = self.journal + ".tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            for training, user, add in self._pending.values():
+                f.write(json.dumps({"training_id": training.training_id, "user_id": user.user_id, "add": add}) + "\n")
+        os.replace(temp, self.journal)
+
+    def replay(self) -> int:
+        """
+        Commits the changes a crash left in the journal, in one transaction. Registering is idempotent and so is
+        unregistering, changes committed before the crash don't matter.
+        :return: number of replayed changes
+        """
+        if not self.journal or not os.path.exists(self.journal):
+            return 0
+        entries = []
+        with open(self.journal, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # the last line might have been cut off
+                    pass
+        trainings = {tr.training_id: tr for i in {e["training_id"] for e in entries}
+                     if (tr := Training.get_for_id(i))}
+        users = {u.user_id: u for i in {e["user_id"] for e in entries} if (u := User.get_for_id(i))}
+        changes = [(trainings[e["training_id"]], users[e["user_id"]], e["add"]) for e in entries
+                   if e["training_id"] in trainings and e["user_id"] in users]
+        Training.write_participants(changes)
+        open(self.journal, "w").close()
+        return len(changes)
+
+    async def start(self):
+        """ Replays the journal and starts the writer, unless it runs already """
+        if self._writer and not self._writer.done():
+            return
+        if replayed := await executor.write(self.replay):
+            print(f"Replayed {replayed} registrations from the journal")
+        self._writer = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self._event().wait()
+            self._event().clear()
+            if not await self._write():
+                await asyncio.sleep(self.retry)
+                self._event().set()
+
+    async def _write(self) -> bool:
+        """ Commits everything queued in one transaction, :return: False if that failed """
+        async with self._get_lock():
+            if not self._pending:
+                return True
+            self._writing, self._pending = self._pending, {}
+            try:
+                await Training.awrite_participants(list(self._writing.values()))
+            except Exception as e:
+                print(f"Couldn't write {len(self._writing)} registrations: {e}")
+                # queue them again in front of the newer changes, which cancel them out or replace them
+                merged = {key: change for key, change in self._writing.items() if key not in self._pending}
+                for key, change in self._pending.items():
+                    if key not in self._writing or self._writing[key][2] == change[2]:
+                        merged[key] = change
+                self._pending = merged
+                return False
+            finally:
+                batch, self._writing = self._writing, {}
+            metrics.inc("registration_batches_total")
+            metrics.inc("registrations_written_total", len(batch))
+            self._rewrite_journal()
+            return True
+
+    async def flush(self):
+        """ Commits everything queued right away """
+        while self._pending:
+            if not await self._write():
+                return
+
+    async def stop(self):
+        """ Stops the writer and commits what's left. Whatever can't be committed stays in the journal. """
+        if self._writer:
+            # not while it writes a batch, which would be dropped from the journal
+            async with self._get_lock():
+                self._writer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._writer
+        await self.flush()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _get_lock(self) -> asyncio.Lock:
+        if not self._lock:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _event(self) -> asyncio.Event:
+        if not self._wakeup:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
@@ -0,0 +1,54 @@
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from muddi.models import Training
+
+MessageID = int
+TrainingID = int
+
+# trainings are unwatched 1 day after end
+watch_duration = timedelta(hours=23)
+
+
+class TrainingRegistry:
+    """
+    The trainings whose posts are watched for reactions, keyed by message_id. Entries are hydrated with their
+    participants once and then kept up to date by the code changing them, so events don't have to query them again.
+    """
+    def __init__(self):
+        self._trainings: Dict[MessageID, Training] = {}
+        self._message_ids: Dict[TrainingID, MessageID] = {}
+
+    def __contains__(self, message_id: MessageID) -> bool:
+        return message_id in self._trainings
+
+    def __len__(self):
+        return len(self._trainings)
+
+    def get(self, message_id: MessageID) -> Optional[Training]:
+        return self._trainings.get(message_id)
+
+    def get_for_id(self, training_id: TrainingID) -> Optional[Training]:
+        message_id = self._message_ids.get(training_id)
+        return self._trainings.get(message_id) if message_id else None
+
+    def values(self) -> List[Training]:
+        return list(self._trainings.values())
+
+    async def watch(self, training: Training):
+        """ Adds the training (or moves it to its new message_id) after loading its participants """
+        await training.aparticipants()
+        self.add(training)
+
+    def add(self, training: Training):
+        """ Adds a training whose participants have been loaded already """
+        if (old := self._message_ids.get(training.training_id)) and old != training.message_id:
+            del self._trainings[old]
+        self._trainings[training.message_id] = training
+        self._message_ids[training.training_id] = training.message_id
+
+    def unwatch(self, message_id: MessageID) -> Optional[Training]:
+        if training := self._trainings.pop(message_id, None):
+            self._message_ids.pop(training.training_id, None)
+        return training
+
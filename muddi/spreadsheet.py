@@ -1,6 +1,8 @@
 import gspread
-from typing import Dict, List, Optional
+import threading
+from typing import Dict, List, Optional, Tuple
 from muddi import secrets
+from muddi.utils.metrics import metrics
 from muddi.utils.tools import valid_discord
 
 # GOOGLESHEET KEY
@@ -38,24 +40,76 @@ def _valid_time(string: str) -> bool:
         return all(map(lambda x: x.isnumeric(), splt)) and 0 <= int(splt[0]) <= 23 and 0 <= int(splt[1]) <= 60
     
 
-class Spreadsheet: #  TODO: Optimize by not connecting to BOTH sheets on initialization (use @property?)
+# Process-wide client and handles, shared by all Spreadsheet instances. The client's authorized session is reused
+# for every request and refreshes its token by itself when it expires.
+_client: Optional[gspread.Client] = None
+_worksheets: Dict[Tuple[str, str], gspread.Worksheet] = {}
+_spreadsheets: Dict[str, gspread.Spreadsheet] = {}
+_lock = threading.Lock()
+
+
+def client() -> gspread.Client:
+    global _client
+    with _lock:
+        if _client is None:
+            with metrics.time("gspread_call", call="service_account"):
+                _client = gspread.service_account()
+        return _client
+
+
+def worksheet(key: str, title: str) -> gspread.Worksheet:
+    """ Opens the spreadsheet and worksheet on first access only """
+    gc = client()
+    with _lock:
+        if (key, title) not in _worksheets:
+            if key not in _spreadsheets:
+                with metrics.time("gspread_call", call="open_by_key"):
+                    _spreadsheets[key] = gc.open_by_key(key)
+            with metrics.time("gspread_call", call="worksheet"):
+                _worksheets[(key, title)] = _spreadsheets[key].worksheet(title)
+        return _worksheets[(key, title)]
+
+
+def reset():
+    """ Drops all cached handles, e.g. after worksheets have been renamed """
+    global _client
+    with _lock:
+        _client = None
+        _worksheets.clear()
+        _spreadsheets.clear()
+
+
+class Spreadsheet:
+    """ Cheap to create, worksheets are opened lazily and shared between instances """
     def __init__(self, schedule=schedule_key, club=club_key, players=players_title, guests=guests_title,
                  schedules=schedules_title, user_max_rows=100, schedule_max_rows=100):
-        gc = gspread.service_account()
         self.user_max_rows = user_max_rows
         self.schedule_max_rows = schedule_max_rows
-        schedule_sheet = gc.open_by_key(schedule)
-        club_sheet = gc.open_by_key(club)
-        self.guests = schedule_sheet.worksheet(guests)
-        self.players = club_sheet.worksheet(players)
-        self.schedules: gspread.Worksheet = schedule_sheet.worksheet(schedules)
+        self._schedule_key = schedule
+        self._club_key = club
+        self._players_title = players
+        self._guests_title = guests
+        self._schedules_title = schedules
+
+    @property
+    def guests(self) -> gspread.Worksheet:
+        return worksheet(self._schedule_key, self._guests_title)
+
+    @property
+    def players(self) -> gspread.Worksheet:
+        return worksheet(self._club_key, self._players_title)
+
+    @property
+    def schedules(self) -> gspread.Worksheet:
+        return worksheet(self._schedule_key, self._schedules_title)
 
     def get_schedules(self):
         """
         Fetches all valid Schedule rows from the 'Schedules' worksheet as dictionaries
         :rtype: list
         """
-        schedules = self.schedules.get_all_records(head=2)
+        with metrics.time("gspread_call", call="get_all_records", worksheet=self._schedules_title):
+            schedules = self.schedules.get_all_records(head=2)
         # only rows with weekday, start time, end time, location and notification day are valid
         return list(filter(lambda r: all([r[notification], r[day], _valid_time(r[start]),
                                           _valid_time(r[end]), r[location]]), schedules))
@@ -65,8 +119,10 @@ class Spreadsheet: #  TODO: Optimize by not connecting to BOTH sheets on initial
         Fetches all valid rows from the 'Names' worksheet as dicitionaries. Valid rows have a value in the name column.
         :return:
         """
-        guests = self.guests.get_all_records(head=2)
-        players = self.players.get_all_records(head=2)
+        with metrics.time("gspread_call", call="get_all_records", worksheet=self._guests_title):
+            guests = self.guests.get_all_records(head=2)
+        with metrics.time("gspread_call", call="get_all_records", worksheet=self._players_title):
+            players = self.players.get_all_records(head=2)
         players.extend(guests)
 
         # filter out duplicates by discord tag
@@ -92,7 +148,8 @@ class Spreadsheet: #  TODO: Optimize by not connecting to BOTH sheets on initial
         """
         if not 0 < row_id <= self.user_max_rows:
             return None
-        rows = self.guests.batch_get([f"A{row_id}:D{row_id}", "A2:D2"])
+        with metrics.time("gspread_call", call="batch_get", worksheet=self._guests_title):
+            rows = self.guests.batch_get([f"A{row_id}:D{row_id}", "A2:D2"])
         user = {headers: value for value, headers in zip(rows[0][0], rows[1][0])}
         return user if user[u_name] else None
 
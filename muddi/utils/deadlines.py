@@ -0,0 +1,72 @@
+import asyncio
+import heapq
+import itertools
+from datetime import datetime
+from typing import Callable, Dict, Hashable, List, Optional
+
+
+class Deadlines:
+    """
+    Min-heap of one deadline per key. wait() sleeps until the earliest deadline is due, setting or moving a
+    deadline wakes it up to recompute. Replaced deadlines stay in the heap and are skipped when they come up.
+    """
+    def __init__(self, clock: Callable[[], datetime] = datetime.today, max_sleep: float = 3600):
+        """ :param max_sleep: seconds after which the clock is checked again anyway, in case it has been adjusted """
+        self._clock = clock
+        self.max_sleep = max_sleep
+        self._heap = []
+        self._deadlines: Dict[Hashable, datetime] = {}
+        self._counter = itertools.count()
+        self._changed: Optional[asyncio.Event] = None
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._deadlines
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def get(self, key: Hashable) -> Optional[datetime]:
+        return self._deadlines.get(key)
+
+    def set(self, key: Hashable, when: datetime):
+        self._deadlines[key] = when
+        heapq.heappush(self._heap, (when, next(self._counter), key))
+        if self._changed:
+            self._changed.set()
+
+    def remove(self, key: Hashable):
+        self._deadlines.pop(key, None)
+
+    def next(self) -> Optional[datetime]:
+        """ The earliest deadline """
+        while self._heap:
+            when, _, key = self._heap[0]
+            if self._deadlines.get(key) == when:
+                return when
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now: datetime = None) -> List[Hashable]:
+        """ Removes and returns the keys of all deadlines up to now, earliest first """
+        now = now or self._clock()
+        due = []
+        while (when := self.next()) is not None and when <= now:
+            _, _, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            due.append(key)
+        return due
+
+    async def wait(self) -> List[Hashable]:
+        """ Sleeps until at least one deadline is due and returns the due keys """
+        if not self._changed:
+            self._changed = asyncio.Event()
+        while not (due := self.pop_due()):
+            self._changed.clear()
+            timeout = self.max_sleep
+            if (when := self.next()) is not None:
+                timeout = min(max((when - self._clock()).total_seconds(), 0), timeout)
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return due
@@ -0,0 +1,50 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+
+class Debouncer:
+    """
+    Coalesces bursts of updates per key: the first mark schedules a flush after `window` seconds, further marks
+    within that window only replace the pending value. Flushing always uses the latest value, so at most one
+    update per key and window reaches the flush function.
+    """
+    def __init__(self, flush: Callable[[object], Awaitable], window: float = 2):
+        self.window = window
+        self._flush = flush
+        self._pending: Dict[Hashable, object] = {}
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self._now: Optional[asyncio.Event] = None
+
+    def mark(self, key: Hashable, value):
+        self._pending[key] = value
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._run(key))
+
+    def pending(self, key: Hashable) -> bool:
+        return key in self._pending
+
+    async def _run(self, key: Hashable):
+        try:
+            # keep going while marks arrive during a flush, one flush at a time per key
+            while key in self._pending:
+                try:
+                    await asyncio.wait_for(self._event().wait(), self.window)
+                except asyncio.TimeoutError:
+                    pass
+                value = self._pending.pop(key)
+                try:
+                    await self._flush(value)
+                except Exception as e:
+                    print(f"Couldn't flush {key}: {e}")
+        finally:
+            del self._tasks[key]
+
+    def _event(self) -> asyncio.Event:
+        if not self._now:
+            self._now = asyncio.Event()
+        return self._now
+
+    async def flush(self):
+        """ Flushes everything pending right away and waits for it. Later marks are flushed without delay. """
+        self._event().set()
+        await asyncio.gather(*self._tasks.values())
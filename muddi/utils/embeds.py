@@ -1,4 +1,6 @@
-from functools import reduce
+import hashlib
+import json
+from typing import Dict, Mapping, Optional
 
 import discord
 
@@ -26,7 +28,8 @@ def embed_table(users: [(str, str)]):
                       for num, (name, tag) in enumerate(users)]) or "Be the first!"  # Make pretty table
 
 
-def posting_embed(training, users: [(str, str, str)], add_emoji):
+def posting_embed(training, users: [(str, str, str)], add_emoji, genders: Optional[Mapping[str, int]] = None):
+    """ :param genders: participants per gender if already known, otherwise they are counted from users """
     form = "%A, %d. %b %Y %H:%Mh"
     embed = discord.Embed(title=f"{training.start.strftime(form)} {training.location}",
                           description=training.description)
@@ -35,10 +38,31 @@ def posting_embed(training, users: [(str, str, str)], add_emoji):
                                                f"if you want to bring guests!", inline=False)
     if training.coach:
         embed.add_field(name="Coach", value=training.coach)
-    women = reduce(lambda num, el: num + 1 if el[2] == 'w' else num, users, 0)
-    men = reduce(lambda num, el: num + 1 if el[2] == 'm' else num, users, 0)
-    embed.add_field(name="Women", value=str(women))
-    embed.add_field(name="Men", value=str(men))
+    if genders is None:
+        genders = {'w': 0, 'm': 0}
+        for _, _, gender in users:
+            genders[gender] = genders.get(gender, 0) + 1
+    embed.add_field(name="Women", value=str(genders.get('w', 0)))
+    embed.add_field(name="Men", value=str(genders.get('m', 0)))
     embed.add_field(name="total", value=str(len(users)))
     embed.add_field(name="Participants", value=embed_table([(n, d) for n, d, g in users]), inline=False)
     return embed
+
+
+def fingerprint(embed: discord.Embed) -> str:
+    return hashlib.sha1(json.dumps(embed.to_dict(), sort_keys=True).encode('UTF-8')).hexdigest()
+
+
+class SentEmbeds:
+    """ Fingerprints of the embeds last sent per training, to skip edits that wouldn't change anything """
+    def __init__(self):
+        self._fingerprints: Dict[int, str] = {}
+
+    def changed(self, training_id, embed: discord.Embed) -> bool:
+        return self._fingerprints.get(training_id) != fingerprint(embed)
+
+    def sent(self, training_id, embed: discord.Embed):
+        self._fingerprints[training_id] = fingerprint(embed)
+
+    def forget(self, training_id):
+        self._fingerprints.pop(training_id, None)
@@ -0,0 +1,25 @@
+import csv
+import gzip
+import io
+from typing import Iterable, List
+
+
+def csv_buffer(header: List[str], rows: Iterable[tuple], compress=False) -> io.BytesIO:
+    """
+    Writes the rows as UTF-8 csv into an in-memory buffer, gzip compressed if wanted. The rows are consumed one by
+    one, so a generator is never materialized.
+    :return: the buffer, positioned at its start
+    """
+    buffer = io.BytesIO()
+    binary = gzip.GzipFile(fileobj=buffer, mode='wb') if compress else buffer
+    text = io.TextIOWrapper(binary, encoding='UTF-8', newline='')
+    writer = csv.writer(text, quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerow(header)
+    writer.writerows(rows)
+    text.flush()
+    # closing the wrappers would close the buffer as well
+    text.detach()
+    if compress:
+        binary.close()
+    buffer.seek(0)
+    return buffer
@@ -0,0 +1,77 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable, Optional
+
+from muddi.utils.metrics import metrics
+
+
+class LockRegistry:
+    """
+    Hands out one asyncio.Lock per key (e.g. a training id), so unrelated keys never wait for each other.
+    Locks that nobody holds or waits for are dropped again.
+    """
+    def __init__(self, timeout: Optional[float] = 5, name="lock"):
+        """ :param name: label of the time spent waiting in the lock_wait metrics """
+        self.timeout = timeout
+        self.name = name
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._users: Dict[Hashable, int] = {}
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable):
+        """
+        async with registry(key): ...
+        :raises asyncio.TimeoutError: if the lock couldn't be acquired within the registry's timeout
+        """
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._users[key] = self._users.get(key, 0) + 1
+        try:
+            try:
+                with metrics.time("lock_wait", lock=self.name):
+                    await self.acquire(lock, self.timeout)
+            except asyncio.TimeoutError:
+                print(f"couldn't acquire lock for {key}")
+                raise
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            self._users[key] -= 1
+            if not self._users[key]:
+                del self._users[key]
+                del self._locks[key]
+
+    @staticmethod
+    async def acquire(lock: asyncio.Lock, timeout: Optional[float]):
+        """
+        lock.acquire() with a timeout. asyncio.wait_for before Python 3.12 can time out just as the lock is acquired,
+        leaving it held by nobody, so a lock acquired while the attempt is given up is released again.
+        :raises asyncio.TimeoutError: if the lock couldn't be acquired in time
+        """
+        attempt = asyncio.ensure_future(lock.acquire())
+        try:
+            done, _ = await asyncio.wait({attempt}, timeout=timeout)
+        except asyncio.CancelledError:
+            await LockRegistry._give_up(lock, attempt)
+            raise
+        if not done:
+            await LockRegistry._give_up(lock, attempt)
+            raise asyncio.TimeoutError
+        attempt.result()
+
+    @staticmethod
+    async def _give_up(lock: asyncio.Lock, attempt: asyncio.Future):
+        attempt.cancel()
+        try:
+            await asyncio.shield(attempt)
+        except asyncio.CancelledError:
+            return
+        # acquired before the cancellation came through
+        lock.release()
+
+    def locked(self, key: Hashable) -> bool:
+        return key in self._locks and self._locks[key].locked()
+
+    def __len__(self):
+        return len(self._locks)
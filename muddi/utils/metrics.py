@@ -0,0 +1,147 @@
+import asyncio
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+# upper bounds in seconds, from a fast SQLite statement to a slow Google request
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        # one count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+class Metrics:
+    """
+    Process-wide counters and latency histograms, keyed by name and labels. Safe to update from the database
+    executor's threads. Names follow the Prometheus conventions (_total, _seconds) without the muddi_ prefix.
+    """
+    prefix = "muddi_"
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if (histogram := self.histograms.get(key)) is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        """
+        with metrics.time("db_statement", statement=...): ...
+        Observes the duration in <name>_seconds and counts exceptions in <name>_errors_total
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc(f"{name}_errors_total", **labels)
+            raise
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - start, **labels)
+
+    def timed(self, name: str, **labels):
+        """ Decorator version of time() for coroutine functions, keeps their name for discord's event decorator """
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.time(name, **labels):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def summary(self, match: str = "", limit: int = 20) -> List[str]:
+        """ One line per histogram whose name or labels contain match, the most total time first """
+        with self._lock:
+            rows = [(name, labels, h.count, h.sum, h.max) for (name, labels), h in self.histograms.items()
+                    if match in name or any(match in v for _, v in labels)]
+            errors = {key: value for key, value in self.counters.items() if key[0].endswith("_errors_total")}
+        rows.sort(key=lambda r: -r[3])
+        lines = []
+        for name, labels, count, total, longest in rows[:limit]:
+            failed = errors.get((name[:-len("_seconds")] + "_errors_total", labels), 0)
+            label = ", ".join(v if len(v) <= 80 else v[:77] + "..." for _, v in labels)
+            lines.append(f"{name[:-len('_seconds')]} {label}: {count}x, avg {total / count * 1000:.1f} ms, "
+                         f"max {longest * 1000:.1f} ms, total {total:.2f} s" + (f", {failed:.0f} failed" if failed
+                                                                               else ""))
+        return lines
+
+    def prometheus(self) -> str:
+        """ All metrics in the Prometheus text exposition format """
+        def fmt(labels: Labels, extra: Labels = ()) -> str:
+            pairs = labels + extra
+            if not pairs:
+                return ""
+            escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+            return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {self.prefix}{name} counter")
+                lines.extend(f"{self.prefix}{name}{fmt(labels)} {value}"
+                             for (n, labels), value in sorted(self.counters.items()) if n == name)
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {self.prefix}{name} histogram")
+                for (n, labels), h in sorted(self.histograms.items(), key=lambda i: i[0]):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(h.buckets) + ["+Inf"], h.counts):
+                        cumulative += count
+                        lines.append(f"{self.prefix}{name}_bucket{fmt(labels, (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{self.prefix}{name}_sum{fmt(labels)} {h.sum}")
+                    lines.append(f"{self.prefix}{name}_count{fmt(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host="127.0.0.1", port=9100) -> asyncio.AbstractServer:
+        """ Minimal HTTP endpoint answering every request with prometheus() """
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                # the request itself doesn't matter, read up to the end of the headers
+                await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+                body = self.prometheus().encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                             b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+                await writer.drain()
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+
+metrics = Metrics()
@@ -0,0 +1,36 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from muddi.database.db import DB
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """ Every test gets a fresh database file, which the models' own DB() handles use as well """
+    # False leaves the schema to the test, e.g. to migrate step by step
+    set_up_schema = True
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db = DB(os.path.join(self.dir.name, "test.db"))
+        if self.set_up_schema:
+            self.db.setup()
+        self.patch = mock.patch("muddi.database.db.database_path", self.db.database)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.db.close()
+        self.dir.cleanup()
+
+
+class Member:
+    """ Stand-in for discord.Member """
+    def __init__(self, id, display_name, tag):
+        self.id = id
+        self.display_name = display_name
+        self.tag = tag
+
+    def __str__(self):
+        return self.tag
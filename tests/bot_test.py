@@ -0,0 +1,190 @@
+import asyncio
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import discord
+
+from muddi.bot import Muddi, watch_duration
+from muddi.models import Training, User
+from muddi.registrations import RegistrationQueue
+from muddi.registry import TrainingRegistry
+from muddi.utils.deadlines import Deadlines
+from muddi.utils.embeds import SentEmbeds
+from muddi.utils.locks import LockRegistry
+from tests import DatabaseTestCase
+
+
+class Post:
+    """ Stand-in for discord.Message, deleted posts raise NotFound on edit """
+    def __init__(self, id, deleted=False):
+        self.id = id
+        self.deleted = deleted
+        self.edits = []
+
+    async def edit(self, **fields):
+        if self.deleted:
+            raise discord.NotFound(SimpleNamespace(status=404, reason="Not Found"), "Unknown Message")
+        self.edits.append(fields)
+
+
+class Channel:
+    """ Stand-in for the posting channel, hands out the queued posts and counts the fetches """
+    def __init__(self, *posts: Post):
+        self.posts = list(posts)
+        self.fetches = 0
+
+    async def fetch_message(self, message_id):
+        self.fetches += 1
+        if not self.posts:
+            raise discord.NotFound(SimpleNamespace(status=404, reason="Not Found"), "Unknown Message")
+        return self.posts.pop(0)
+
+
+class Bot:
+    """ Just the post handling of Muddi, without a connection to discord """
+    get_post = Muddi.get_post
+    edit_post = Muddi.edit_post
+    forget_post = Muddi.forget_post
+
+    def __init__(self, channel: Channel):
+        self.posts = {}
+        self.channel = channel
+
+    def state(self, guild_id):
+        return SimpleNamespace(posting_channel=self.channel)
+
+
+class TestPosts(unittest.TestCase):
+    def setUp(self):
+        self.training = Training(1, None, None, "x", "c", message_id=100)
+
+    def test_handle_is_reused(self):
+        post = Post(100)
+        bot = Bot(Channel(post))
+
+        async def run():
+            assert await bot.get_post(self.training) is post
+            await bot.edit_post(self.training, content="a")
+            await bot.edit_post(self.training, content="b")
+        asyncio.run(run())
+        assert bot.channel.fetches == 1
+        assert post.edits == [{"content": "a"}, {"content": "b"}]
+
+    def test_stale_handle_is_fetched_again(self):
+        stale, fresh = Post(100, deleted=True), Post(100)
+        bot = Bot(Channel(stale, fresh))
+        asyncio.run(bot.edit_post(self.training, content="a"))
+        assert bot.channel.fetches == 2
+        assert fresh.edits == [{"content": "a"}] and bot.posts[100] is fresh
+
+    def test_deleted_post_is_dropped(self):
+        bot = Bot(Channel(Post(100, deleted=True)))
+        with self.assertRaises(discord.NotFound):
+            asyncio.run(bot.edit_post(self.training, content="a"))
+        assert 100 not in bot.posts
+
+    def test_forget_post(self):
+        bot = Bot(Channel(Post(100), Post(100)))
+        asyncio.run(bot.get_post(self.training))
+        bot.forget_post(100)
+        assert 100 not in bot.posts
+        asyncio.run(bot.get_post(self.training))
+        assert bot.channel.fetches == 2
+
+
+class Instance:
+    """ Just the watching of trainings of Muddi, as follower and leader of one guild """
+    watched = Muddi.watched
+    state = Muddi.state
+    watch = Muddi.watch
+    unwatch = Muddi.unwatch
+    follow = Muddi.follow
+    watch_active = Muddi.watch_active
+
+    def __init__(self, guild_id):
+        self.guild_states = {guild_id: SimpleNamespace(guild_id=guild_id, registry=TrainingRegistry())}
+        self.deadlines = Deadlines()
+        self.training_locks = LockRegistry()
+        self.registrations = RegistrationQueue()
+        self.posts = {}
+        self.sent_embeds = SentEmbeds()
+        self.followed = None
+
+
+class TestFailover(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        now = datetime.today()
+        self.trainings = []
+        for i, start in enumerate([now - timedelta(hours=3), now + timedelta(days=1)]):
+            tr = Training(None, start, start + timedelta(hours=2), "x", "c", message_id=100 + i, guild_id=10)
+            tr.training_id = tr.insert()
+            self.trainings.append(tr)
+
+    def test_follow_rereads_changes_only(self):
+        first, second = self.trainings
+        instance = Instance(10)
+
+        async def run():
+            await instance.follow()
+            followed = instance.watched(first.training_id)
+            await instance.follow()
+            assert instance.watched(first.training_id) is followed
+            # cancelled trainings stay watched, like on the leader
+            first.cancelled = 1
+            first.update()
+            await instance.follow()
+            assert instance.watched(first.training_id) is not followed
+            assert instance.watched(first.training_id).cancelled
+        asyncio.run(run())
+        assert len(instance.guild_states[10].registry) == 2
+
+    def test_follow_rereads_swaps_and_edits(self):
+        first, _ = self.trainings
+        users = [User(None, name, f"{name}#0001", i, guild_id=10) for i, name in enumerate(["a", "b"], 1)]
+        for u in users:
+            u.user_id = u.insert()
+        first.add_participant(users[0].user_id, users[0])
+        instance = Instance(10)
+
+        async def run():
+            await instance.follow()
+            followed = instance.watched(first.training_id)
+            # the number of participants stays the same
+            first.remove_participant(users[0].user_id)
+            first.add_participant(users[1].user_id, users[1])
+            await instance.follow()
+            swapped = instance.watched(first.training_id)
+            assert swapped is not followed
+            assert [u.user_id for u in swapped.participants] == [users[1].user_id]
+            first.coach = "d"
+            first.update()
+            await instance.follow()
+            assert instance.watched(first.training_id).coach == "d"
+        asyncio.run(run())
+
+    def test_follower_becomes_leader(self):
+        trainings = self.trainings
+        instance = Instance(10)
+
+        async def run():
+            await instance.follow()
+            followed = instance.watched(trainings[0].training_id)
+            await instance.watch_active()
+            # the instances picked up as a follower are kept
+            assert instance.watched(trainings[0].training_id) is followed
+        asyncio.run(run())
+        registry = instance.guild_states[10].registry
+        assert len(registry) == 2
+        for tr in trainings:
+            assert instance.deadlines.get(("training", tr.training_id)) == tr.end + watch_duration
+        # the leader expires them like the ones it posted itself
+        expired = instance.deadlines.pop_due(trainings[0].end + watch_duration)
+        assert expired == [("training", trainings[0].training_id)]
+        instance.unwatch(trainings[0].training_id)
+        assert len(registry) == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
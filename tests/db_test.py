@@ -0,0 +1,181 @@
+import asyncio
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import unittest
+from datetime import datetime
+
+from muddi.database import executor
+from muddi.database import db as database
+from muddi.database.db import DB, migrations
+from muddi.models import Schedule, Training, User
+from tests import DatabaseTestCase
+
+
+class TestDB(DatabaseTestCase):
+    def test_connection_is_reused(self):
+        assert self.db.connect() is DB(self.db.database).connect()
+
+    def test_wal(self):
+        assert self.db.select("PRAGMA journal_mode")[0][0] == "wal"
+
+    def test_transaction_commits_once(self):
+        sql = "INSERT INTO users(name) VALUES(?)"
+        with self.db.transaction():
+            self.db.commit(sql, ("a",))
+            with self.db.transaction():
+                self.db.commit(sql, ("b",))
+            assert self.db.in_transaction()
+        assert not self.db.in_transaction()
+        assert len(self.db.select("SELECT * FROM users")) == 2
+
+    def test_transaction_rollback(self):
+        with self.assertRaises(Exception):
+            with self.db.transaction():
+                self.db.commit("INSERT INTO users(name) VALUES(?)", ("a",))
+                self.db.commit("INSERT INTO users(name) VALUES(NULL)")
+        assert self.db.select("SELECT * FROM users") == []
+
+    def test_query_log(self):
+        path = os.path.join(self.dir.name, "queries.jsonl")
+        log = database.enable_query_log(path, threshold=0)
+        try:
+            self.db.commit_many("INSERT INTO users(name) VALUES(?)", [("a",), ("b",)])
+            self.db.select("SELECT * FROM users WHERE discord_tag = ? OR user_id IN (?,?)", ("a#0001", 1, 2))
+            self.db.select("SELECT * FROM users WHERE discord_tag = ? OR user_id IN (?,?,?)", ("a#0001", 1, 2, 3))
+        finally:
+            database.disable_query_log()
+        with open(path) as f:
+            entries = [json.loads(line) for line in f]
+        assert entries[0]["rows"] == 2 and entries[0]["parameters"] == "str"
+        assert entries[-1]["statement"] == "SELECT * FROM users WHERE discord_tag = ? OR user_id IN (?, ...)"
+        assert entries[-1]["parameters"] == "str, int, int, int"
+        assert entries[-1]["plan"]
+        assert log.stats[entries[-1]["statement"]][0] == 2
+        assert database.query_log is None
+
+    def test_backup_while_writing(self):
+        stop = threading.Event()
+
+        def write():
+            db = DB(self.db.database)
+            while not stop.is_set():
+                db.commit("INSERT INTO users(name) VALUES(?)", ("x" * 500,))
+            db.close()
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            path = self.db.backup(os.path.join(self.dir.name, "backup.db"), pages=1, sleep=0)
+        finally:
+            stop.set()
+            writer.join()
+        conn = sqlite3.connect(path)
+        assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+        assert conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] == len(migrations)
+        conn.close()
+
+    def test_backup_rotation(self):
+        directory = os.path.join(self.dir.name, "backups")
+        os.makedirs(directory)
+        for name in ["muddi-20200101-000000.db.gz", "muddi-20200102-000000.db.gz"]:
+            open(os.path.join(directory, name), "w").close()
+        path = self.db.backup_rotated(directory, keep=2)
+        assert sorted(os.listdir(directory)) == ["muddi-20200102-000000.db.gz", os.path.basename(path)]
+        restored = os.path.join(self.dir.name, "restored.db")
+        with gzip.open(path) as src, open(restored, "wb") as dst:
+            dst.write(src.read())
+        assert DB(restored).version() == len(migrations)
+        DB(restored).close()
+
+    def test_snapshot(self):
+        self.db.commit("INSERT INTO users(name) VALUES(?)", ("a",))
+        path = os.path.join(self.dir.name, "snapshot.db")
+        with open(path, "wb") as f:
+            f.write(gzip.decompress(self.db.snapshot(compress=True).getvalue()))
+        conn = sqlite3.connect(path)
+        assert conn.execute("SELECT name FROM users").fetchall() == [("a",)]
+        conn.close()
+
+    def test_executor_runs_off_loop(self):
+        async def run():
+            await executor.write(self.db.commit, "INSERT INTO users(name) VALUES(?)", ("a",))
+            rows = await executor.read(self.db.select, "SELECT name FROM users")
+            thread = await executor.write(threading.current_thread)
+            return rows, thread
+        rows, thread = asyncio.run(run())
+        assert rows == [("a",)]
+        assert thread is not threading.current_thread()
+
+
+class TestMigrations(DatabaseTestCase):
+    set_up_schema = False
+
+    def test_upgrade_removes_duplicates(self):
+        assert self.db.migrate(target=1) == 1
+        self.db.commit("INSERT INTO users(name) VALUES('a')")
+        self.db.commit("INSERT INTO trainings(start, end, location) VALUES(?,?,'x')", (datetime.now(), datetime.now()))
+        for _ in range(2):
+            self.db.commit("INSERT INTO participants(user_id, training_id) VALUES(1, 1)")
+        assert self.db.migrate() == len(migrations)
+        assert self.db.select("SELECT COUNT(*) FROM participants") == [(1,)]
+        # running it again is a no-op
+        assert self.db.migrate() == len(migrations)
+        with self.assertRaises(Exception):
+            with self.db.transaction():
+                self.db.commit("INSERT INTO participants(user_id, training_id) VALUES(1, 1)")
+
+    def test_migrated_rollups_match_rebuild(self):
+        assert self.db.migrate(target=3) == 3
+        self.db.commit("INSERT INTO users(name, gender, member_type) VALUES('a', 'w', 'Gast')")
+        for day in (1, 2):
+            self.db.commit("INSERT INTO trainings(start, end, location, coach) VALUES(?,?,'x','c')",
+                           (datetime(2020, 9, day, 18), datetime(2020, 9, day, 20)))
+        self.db.commit("INSERT INTO participants(user_id, training_id) VALUES(1, 1)")
+        assert self.db.migrate(target=4) == 4
+        assert self.db.select("SELECT kind, key, trainings, guests FROM group_stats ORDER BY 1") == \
+            [("coach", "c", 2, 1), ("location", "x", 2, 1), ("month", "2020-09", 2, 1)]
+        self.db.migrate()
+        tables = ["user_stats", "training_stats", "group_stats"]
+        migrated = [self.db.select(f"SELECT * FROM {t} ORDER BY 1, 2, 3") for t in tables]
+        with self.db.transaction() as conn:
+            database.rebuild_rollups(conn)
+        assert [self.db.select(f"SELECT * FROM {t} ORDER BY 1, 2, 3") for t in tables] == migrated
+
+    def test_foreign_keys(self):
+        self.db.setup()
+        assert not self.db.commit("INSERT INTO participants(user_id, training_id) VALUES(1, 1)")
+
+    def test_query_plans(self):
+        """ Explains the statements the models run, as recorded by the query log """
+        self.db.setup()
+        path = os.path.join(self.dir.name, "queries.jsonl")
+        database.enable_query_log(path, threshold=0)
+        try:
+            reference = datetime(2020, 9, 26)
+            user = User(None, "a", "a#0001", 1, "w", guild_id=10)
+            user.user_id = user.insert()
+            schedule = Schedule("Sunday", "18:00", "20:00", "Jesus", "Fritzewiese", "", "Friday", 10)
+            training = schedule.next_training(reference)
+            training.message_id = 100
+            training.training_id = training.insert()
+            assert training.add_participant(user.user_id, user)
+            assert Training.get_for_id(training.training_id).participants
+            assert training.remove_participant(user.user_id)
+            assert Training.select_next_trainings(reference=reference, guild_id=10)
+            assert Schedule.scheduled_trainings([schedule], reference)[schedule]
+        finally:
+            database.disable_query_log()
+        with open(path) as f:
+            plans = {entry["statement"]: " ".join(entry["plan"]) for entry in map(json.loads, f)}
+
+        def plan(*fragments):
+            return next(p for statement, p in plans.items() if all(f in statement for f in fragments))
+        assert "participants_training_user_idx (training_id=?)" in plan("users AS u", "trainings.training_id = ?")
+        assert "participants_training_user_idx (training_id=? AND user_id=?)" in plan("DELETE FROM participants")
+        assert "trainings_start_idx (start>? AND start<?)" in plan("FROM trainings Where start > ?", "cancelled = 0")
+        assert "trainings_schedule_idx (start=? AND end=? AND location=? AND guild_id=?)" in plan("WITH upcoming")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import asyncio
+import unittest
+from datetime import datetime, timedelta
+
+from muddi.utils.deadlines import Deadlines
+
+
+class TestDeadlines(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime(2020, 9, 26, 12)
+        self.deadlines = Deadlines(clock=lambda: self.now)
+
+    def test_pop_due_in_order(self):
+        self.deadlines.set("b", self.now + timedelta(hours=2))
+        self.deadlines.set("a", self.now + timedelta(hours=1))
+        self.deadlines.set("c", self.now + timedelta(hours=3))
+        assert self.deadlines.pop_due() == []
+        assert self.deadlines.pop_due(self.now + timedelta(hours=2)) == ["a", "b"]
+        assert self.deadlines.next() == self.now + timedelta(hours=3)
+
+    def test_moved_and_removed(self):
+        self.deadlines.set("a", self.now + timedelta(hours=1))
+        self.deadlines.set("a", self.now + timedelta(hours=5))
+        self.deadlines.set("b", self.now + timedelta(hours=2))
+        self.deadlines.remove("b")
+        assert self.deadlines.pop_due(self.now + timedelta(hours=4)) == []
+        assert len(self.deadlines) == 1
+        assert self.deadlines.pop_due(self.now + timedelta(hours=5)) == ["a"]
+
+    def test_wait_wakes_up_for_earlier_deadline(self):
+        self.deadlines.set("later", self.now + timedelta(days=1))
+
+        async def run():
+            waiting = asyncio.create_task(self.deadlines.wait())
+            await asyncio.sleep(0.01)
+            assert not waiting.done()
+            self.deadlines.set("now", self.now)
+            return await asyncio.wait_for(waiting, 1)
+        assert asyncio.run(run()) == ["now"]
+
+
+if __name__ == '__main__':
+    unittest.main()
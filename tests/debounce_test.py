@@ -0,0 +1,44 @@
+import asyncio
+import unittest
+
+from muddi.utils.debounce import Debouncer
+
+
+class TestDebouncer(unittest.TestCase):
+    def setUp(self):
+        self.flushed = []
+
+        async def flush(value):
+            self.flushed.append(value)
+        self.debouncer = Debouncer(flush, window=0.05)
+
+    def test_burst_is_coalesced(self):
+        async def run():
+            for i in range(30):
+                self.debouncer.mark(1, i)
+                self.debouncer.mark(2, -i)
+            await asyncio.sleep(0.1)
+        asyncio.run(run())
+        assert sorted(self.flushed) == [-29, 29]
+
+    def test_marks_during_flush_are_not_lost(self):
+        async def run():
+            self.debouncer.mark(1, "a")
+            await asyncio.sleep(0.07)
+            self.debouncer.mark(1, "b")
+            await asyncio.sleep(0.07)
+        asyncio.run(run())
+        assert self.flushed == ["a", "b"]
+
+    def test_flush_now(self):
+        async def run():
+            self.debouncer.window = 60
+            self.debouncer.mark(1, "a")
+            await asyncio.wait_for(self.debouncer.flush(), 1)
+            assert not self.debouncer.pending(1)
+        asyncio.run(run())
+        assert self.flushed == ["a"]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+from datetime import datetime
+
+from muddi.models import Training, User
+from muddi.utils.embeds import posting_embed, SentEmbeds
+
+
+class TestPostingEmbed(unittest.TestCase):
+    def setUp(self):
+        self.training = Training(1, datetime(2020, 9, 27, 18), datetime(2020, 9, 27, 20), "Fritzewiese", "Jesus",
+                                 message_id=100)
+        self.training._set_participants([User(1, "Anna", gender="w"), User(2, "Ben", gender="m"),
+                                         User(3, "Cleo", gender="w")])
+        self.users = [(u.name, "(Guest)", u.gender) for u in self.training.participants]
+
+    def fields(self, embed):
+        return {f.name: f.value for f in embed.fields}
+
+    def test_counts(self):
+        counted = self.fields(posting_embed(self.training, self.users, "x"))
+        assert (counted["Women"], counted["Men"], counted["total"]) == ("2", "1", "3")
+        assert counted == self.fields(posting_embed(self.training, self.users, "x", self.training.gender_counts))
+
+    def test_counts_follow_changes(self):
+        self.training._removed(self.training.participants[0])
+        self.training._added(User(4, "Dana", gender="m"))
+        assert self.training.gender_counts["w"] == 1
+        assert self.training.gender_counts["m"] == 2
+
+    def test_unchanged_embeds_are_skipped(self):
+        sent = SentEmbeds()
+        embed = posting_embed(self.training, self.users, "x")
+        assert sent.changed(1, embed)
+        sent.sent(1, embed)
+        assert not sent.changed(1, posting_embed(self.training, self.users, "x"))
+        assert sent.changed(1, posting_embed(self.training, self.users[:2], "x"))
+        sent.forget(1)
+        assert sent.changed(1, embed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import unittest
+from datetime import datetime
+
+import muddi.spreadsheet as sh
+from muddi import secrets
+from muddi.database.db import DB
+from muddi.models import Guild, Schedule, Stats, User
+from tests import DatabaseTestCase
+
+
+class TestGuilds(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.guilds = [Guild(10, 11, 12, "schedule a", "club a"), Guild(20, 21, 22, "schedule b", "club b")]
+        for guild in self.guilds:
+            guild.save()
+
+    def test_config(self):
+        self.guilds[0].club_key = "club c"
+        self.guilds[0].save()
+        assert Guild.get_for_id(10).club_key == "club c"
+        # besides the guild adopted from the secrets
+        assert {10, 20} <= {g.guild_id for g in Guild.get_all()}
+        assert Guild.get_for_id(30) is None
+
+    def test_users_per_guild(self):
+        rows = [{sh.u_name: "Anna", sh.discord_tag: "anna#1234", sh.gender: "w", sh.member_type: sh.EICHE}]
+        for guild in self.guilds:
+            assert len(User.update_from_sheet(rows, guild).inserts) == 1
+        # the same person is a user of both clubs, each sync only sees its own
+        assert not User.update_from_sheet(rows, self.guilds[0])
+        first, second = (User.get_for_discord_id_or_tag(None, "anna#1234", g.guild_id) for g in self.guilds)
+        assert first.user_id != second.user_id and first.guild_id == 10 and second.guild_id == 20
+
+    def test_trainings_per_guild(self):
+        reference = datetime(2020, 9, 26)
+        schedules = [Schedule("Sunday", "18:00", "20:00", "Jesus", "Fritzewiese", "", "Friday", g.guild_id)
+                     for g in self.guilds]
+        training = schedules[0].next_training(reference)
+        training.message_id = 100
+        training.training_id = training.insert()
+        scheduled = Schedule.scheduled_trainings(schedules, reference)
+        assert scheduled[schedules[0]].guild_id == 10
+        assert scheduled[schedules[1]] is None
+        assert [g[:2] for g in Stats.for_groups("location", 10)] == [("Fritzewiese", 1)]
+        assert Stats.for_groups("location", 20) == []
+        assert training.add_member(1, "Anna", "anna#1234")
+        assert User.get_for_discord_id_or_tag(1, guild_id=10) and not User.get_for_discord_id_or_tag(1, guild_id=20)
+
+    @unittest.skipIf(getattr(secrets, "guild_id", None) is None, "no guild configured in the secrets")
+    def test_migration_adopts_configured_guild(self):
+        db = DB(os.path.join(self.dir.name, "old.db"))
+        db.migrate(4)
+        db.commit("INSERT INTO users(name) VALUES(?)", ("a",))
+        db.migrate()
+        assert db.select("SELECT guild_id FROM users") == [(secrets.guild_id,)]
+        assert db.select("SELECT guild_id FROM guilds") == [(secrets.guild_id,)]
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
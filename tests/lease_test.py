@@ -0,0 +1,50 @@
+import unittest
+from datetime import datetime, timedelta
+
+from muddi.models import Lease, Training, User
+from tests import DatabaseTestCase
+
+
+class TestLease(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = datetime(2020, 9, 27, 18)
+        self.first, self.second = Lease("leader", "first"), Lease("leader", "second")
+
+    def test_one_holder(self):
+        assert self.first.acquire(self.now)
+        assert not self.second.acquire(self.now + timedelta(seconds=10))
+        # renewing moves the expiry
+        assert self.first.acquire(self.now + timedelta(seconds=20))
+        assert not self.second.acquire(self.now + timedelta(seconds=40))
+        assert self.first.current() == ("first", self.now + timedelta(seconds=50))
+
+    def test_takeover_after_expiry(self):
+        assert self.first.acquire(self.now)
+        assert self.second.acquire(self.now + timedelta(seconds=30))
+        assert not self.first.acquire(self.now + timedelta(seconds=31))
+        assert self.second.current()[0] == "second"
+
+    def test_release(self):
+        assert self.first.acquire(self.now)
+        assert not self.second.release()
+        assert self.first.release()
+        assert self.first.current() is None
+        assert self.second.acquire(self.now)
+
+    def test_participant_added_by_other_instance(self):
+        user = User(None, "a", "a#0001", 1, "w")
+        user.user_id = user.insert()
+        start = datetime(2020, 9, 27, 18)
+        training = Training(None, start, start + timedelta(hours=2), "x", "c", message_id=100)
+        training.training_id = training.insert()
+        other = Training.get_for_id(training.training_id)
+        training.participants
+        assert other.add_participant(user.user_id)
+        # the write is ignored, but the cached participants know about it now
+        assert not training.add_participant(user.user_id)
+        assert training.has_member(1) and training.gender_counts["w"] == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import asyncio
+import unittest
+
+from muddi.utils.locks import LockRegistry
+
+
+class TestLockRegistry(unittest.TestCase):
+
+    def test_keys_are_independent(self):
+        locks = LockRegistry()
+
+        async def run():
+            async with locks(1):
+                # would time out if key 2 shared the lock of key 1
+                async with locks(2):
+                    return locks.locked(1) and locks.locked(2)
+        assert asyncio.run(run())
+        assert len(locks) == 0
+
+    def test_same_key_is_exclusive(self):
+        locks = LockRegistry()
+        order = []
+
+        async def worker(name):
+            async with locks(1):
+                order.append(name)
+                await asyncio.sleep(0.01)
+                order.append(name)
+
+        async def run():
+            await asyncio.gather(worker("a"), worker("b"))
+        asyncio.run(run())
+        assert order == ["a", "a", "b", "b"]
+        assert len(locks) == 0
+
+    def test_timeout_releases_nothing(self):
+        locks = LockRegistry(timeout=0.01)
+
+        async def run():
+            async with locks(1):
+                with self.assertRaises(asyncio.TimeoutError):
+                    async with locks(1):
+                        pass
+                assert locks.locked(1)
+        asyncio.run(run())
+        assert len(locks) == 0
+
+    def test_timeout_while_acquiring_releases(self):
+        class LateLock(asyncio.Lock):
+            """ Acquires the lock even though the attempt is cancelled, like wait_for's race """
+            async def acquire(self):
+                try:
+                    await asyncio.sleep(1)
+                except asyncio.CancelledError:
+                    pass
+                return await super().acquire()
+
+        async def run():
+            lock = LateLock()
+            with self.assertRaises(asyncio.TimeoutError):
+                await LockRegistry.acquire(lock, 0.01)
+            return lock.locked()
+        assert not asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
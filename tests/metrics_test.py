@@ -0,0 +1,68 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from muddi.database.db import DB, statement_key
+from muddi.utils.metrics import Metrics, metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_time_counts_errors(self):
+        m = Metrics()
+        with m.time("gspread_call", call="get_users"):
+            pass
+        with self.assertRaises(ValueError):
+            with m.time("gspread_call", call="get_users"):
+                raise ValueError
+        histogram = m.histograms[("gspread_call_seconds", (("call", "get_users"),))]
+        assert histogram.count == 2
+        assert m.counters[("gspread_call_errors_total", (("call", "get_users"),))] == 1
+        assert m.summary("get_users")[0].endswith("1 failed")
+
+    def test_prometheus(self):
+        m = Metrics()
+        m.observe("command_seconds", 0.003, command="training cancel")
+        m.observe("command_seconds", 20, command="training cancel")
+        m.inc("command_errors_total", command='say "hi"')
+        text = m.prometheus()
+        assert '# TYPE muddi_command_seconds histogram' in text
+        assert 'muddi_command_seconds_bucket{command="training cancel",le="0.005"} 1' in text
+        assert 'muddi_command_seconds_bucket{command="training cancel",le="+Inf"} 2' in text
+        assert 'muddi_command_seconds_count{command="training cancel"} 2' in text
+        assert 'muddi_command_errors_total{command="say \\"hi\\""} 1' in text
+
+    def test_serve(self):
+        m = Metrics()
+        m.inc("events_total")
+
+        async def run():
+            server = await m.serve(port=0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return response.decode()
+        response = asyncio.run(run())
+        assert response.startswith("HTTP/1.1 200 OK")
+        assert response.endswith("muddi_events_total 1\n")
+
+    def test_db_statements(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db = DB(os.path.join(directory, "test.db"))
+            db.setup()
+            metrics.reset()
+            db.select("SELECT * FROM users WHERE user_id IN (?,?,?)", (1, 2, 3))
+            db.select("SELECT * FROM users WHERE user_id IN (?, ?)", (1, 2))
+            db.close()
+        key = statement_key("SELECT * FROM users WHERE user_id IN (?,?,?)")
+        assert key == "SELECT * FROM users WHERE user_id IN (?, ...)"
+        assert metrics.histograms[("db_statement_seconds", (("statement", key),))].count == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
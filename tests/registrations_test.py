@@ -0,0 +1,99 @@
+import asyncio
+import os
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from muddi.models import Stats, Training, User
+from muddi.registrations import RegistrationQueue
+from tests import DatabaseTestCase
+
+
+class TestRegistrationQueue(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [User(None, name, f"{name}#0001", i, "w") for i, name in enumerate(["a", "b", "c"], 1)]
+        for u in self.users:
+            u.user_id = u.insert()
+        start = datetime(2020, 9, 27, 18)
+        self.training = Training(None, start, start + timedelta(hours=2), "x", "c", message_id=100)
+        self.training.training_id = self.training.insert()
+        self.journal = os.path.join(self.dir.name, "registrations")
+        self.queue = RegistrationQueue(self.journal)
+
+    def stored(self):
+        return [u.user_id for u in Training.get_for_id(self.training.training_id).participants]
+
+    def test_batched(self):
+        async def run():
+            await self.queue.start()
+            for u in self.users:
+                assert self.queue.add(self.training, u)
+            assert not self.queue.add(self.training, self.users[0])
+            # visible right away, committed by the writer
+            assert self.training.has_member(1) and self.queue.pending(self.training.training_id)
+            await self.queue.stop()
+        asyncio.run(run())
+        assert self.stored() == [u.user_id for u in self.users]
+        assert Stats.for_training(self.training.training_id)["participants"] == 3
+        assert open(self.journal).read() == ""
+
+    def test_add_and_remove_cancel_out(self):
+        self.queue.add(self.training, self.users[0])
+        self.queue.add(self.training, self.users[1])
+        assert self.queue.remove(self.training, self.users[0])
+        assert not self.queue.remove(self.training, self.users[2])
+        assert len(self.queue) == 1
+        asyncio.run(self.queue.flush())
+        assert self.stored() == [self.users[1].user_id]
+
+    def test_replay_after_crash(self):
+        self.queue.add(self.training, self.users[0])
+        self.queue.add(self.training, self.users[1])
+        self.queue.remove(self.training, self.users[1])
+        # nothing has been committed when the process dies
+        self.queue._file.close()
+        assert self.stored() == []
+        assert RegistrationQueue(self.journal).replay() == 3
+        assert self.stored() == [self.users[0].user_id]
+        assert RegistrationQueue(self.journal).replay() == 0
+
+    def test_replay_skips_deleted(self):
+        self.queue.add(self.training, self.users[0])
+        self.queue.add(self.training, self.users[1])
+        self.queue._file.close()
+        self.db.commit("DELETE FROM users WHERE user_id = ?", (self.users[1].user_id,))
+        assert RegistrationQueue(self.journal).replay() == 1
+        assert self.stored() == [self.users[0].user_id]
+
+    def test_failed_batch_is_kept(self):
+        self.queue.add(self.training, self.users[0])
+        with mock.patch.object(Training, "write_participants", side_effect=RuntimeError("locked")):
+            asyncio.run(self.queue.flush())
+        assert len(self.queue) == 1 and self.stored() == []
+        asyncio.run(self.queue.flush())
+        assert self.stored() == [self.users[0].user_id]
+
+    def test_stop_while_writing(self):
+        write = Training.awrite_participants
+
+        async def run():
+            writing = asyncio.Event()
+
+            async def slow_write(changes):
+                writing.set()
+                await asyncio.sleep(0.05)
+                await write(changes)
+            with mock.patch.object(Training, "awrite_participants", side_effect=slow_write):
+                await self.queue.start()
+                self.queue.add(self.training, self.users[0])
+                await writing.wait()
+                self.queue.add(self.training, self.users[1])
+                await self.queue.stop()
+        asyncio.run(run())
+        assert self.stored() == [self.users[0].user_id, self.users[1].user_id]
+        assert open(self.journal).read() == ""
+
+
+if __name__ == '__main__':
+    unittest.main()
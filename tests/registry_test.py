@@ -0,0 +1,49 @@
+import asyncio
+import unittest
+from datetime import datetime, timedelta
+
+from muddi.models import Training, User
+from muddi.registry import TrainingRegistry
+
+
+def training(training_id, message_id, end):
+    tr = Training(training_id, end - timedelta(hours=2), end, "Fritzewiese", "Jesus", message_id=message_id)
+    tr._set_participants([User(1, "Anna", "anna#1234", 11, "w"), User(2, "Guest", gender="m")])
+    return tr
+
+
+class TestTrainingRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = TrainingRegistry()
+        self.now = datetime(2020, 9, 27, 20, 0)
+
+    def test_watch(self):
+        tr = training(1, 100, self.now)
+        asyncio.run(self.registry.watch(tr))
+        assert 100 in self.registry
+        assert self.registry.get(100) is tr
+        assert self.registry.get_for_id(1) is tr
+        assert tr.has_member(11) and not tr.has_member(12)
+        assert tr.participant_for_member(11).name == "Anna"
+
+    def test_moved_message(self):
+        tr = training(1, 100, self.now)
+        self.registry.add(tr)
+        tr.message_id = 101
+        self.registry.add(tr)
+        assert 100 not in self.registry
+        assert self.registry.get(101) is tr
+        assert len(self.registry) == 1
+
+    def test_unwatch(self):
+        old = training(1, 100, self.now - timedelta(days=1))
+        current = training(2, 200, self.now)
+        self.registry.add(old)
+        self.registry.add(current)
+        assert self.registry.unwatch(100) is old and self.registry.unwatch(100) is None
+        assert 100 not in self.registry and self.registry.get_for_id(1) is None
+        assert self.registry.values() == [current]
+
+
+if __name__ == '__main__':
+    unittest.main()
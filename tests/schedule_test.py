@@ -2,9 +2,10 @@ import unittest
 from datetime import datetime
 
 from muddi.models import Schedule
+from tests import DatabaseTestCase
 
 
-class TestSchedule(unittest.TestCase):
+class TestSchedule(DatabaseTestCase):
 
     def test_next_training(self):
         schedule = Schedule("Sunday", "18:00", "20:00",
@@ -16,6 +17,16 @@ class TestSchedule(unittest.TestCase):
         assert training.coach == schedule.coach
         assert training.location == schedule.location
 
+    def test_scheduled_trainings(self):
+        reference = datetime(2020, 9, 26)
+        sunday = Schedule("Sunday", "18:00", "20:00", "Jesus", "Fritzewiese", "", "Friday")
+        monday = Schedule("Monday", "18:00", "20:00", "Jesus", "Fritzewiese", "", "Friday")
+        training = sunday.next_training(reference)
+        training.message_id = 100
+        training.insert()
+        scheduled = Schedule.scheduled_trainings([sunday, monday], reference)
+        assert scheduled[sunday].message_id == 100
+        assert scheduled[monday] is None
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 
 import muddi.spreadsheet as sh
 from muddi.spreadsheet import Spreadsheet
@@ -16,5 +17,24 @@ class TestSpreadsheet(unittest.TestCase):
         assert self.sheet.users.row_values(1)[:4] == [sh.u_name, sh.discord_tag, sh.member_type, sh.gender]
 
 
+class TestSharedClient(unittest.TestCase):
+    def setUp(self):
+        sh.reset()
+
+    def tearDown(self):
+        sh.reset()
+
+    def test_opened_once(self):
+        gc = mock.Mock()
+        with mock.patch("gspread.service_account", return_value=gc) as service_account:
+            for _ in range(3):
+                sheet = Spreadsheet()
+                assert sheet.guests is sheet.guests
+                sheet.schedules
+        service_account.assert_called_once()
+        # only the schedule spreadsheet has been accessed
+        gc.open_by_key.assert_called_once_with(sh.schedule_key)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+from datetime import datetime, timedelta
+
+from muddi.models import Training, User, Stats
+from muddi.spreadsheet import GUEST
+from tests import DatabaseTestCase
+
+
+class TestStats(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [User(None, "a", "a#0001", 1, "w"), User(None, "b", "b#0001", 2, "m"),
+                      User(None, "g", gender="w", member_type=GUEST)]
+        for u in self.users:
+            u.user_id = u.insert()
+        self.trainings = []
+        for i, (start, coach) in enumerate([(datetime(2020, 9, 29, 18), "c"), (datetime(2020, 10, 1, 18), "d")]):
+            tr = Training(None, start, start + timedelta(hours=2), "x", coach, message_id=100 + i)
+            tr.training_id = tr.insert()
+            self.trainings.append(tr)
+
+    def snapshot(self):
+        return [self.db.select(f"SELECT * FROM {table} ORDER BY 1, 2")
+                for table in ["user_stats", "training_stats", "group_stats"]]
+
+    def test_incremental_matches_rebuild(self):
+        first, second = self.trainings
+        for u in self.users:
+            first.add_participant(u.user_id, u)
+            second.add_participant(u.user_id, u)
+        first.no_show(self.users[1].user_id)
+        first.no_show(self.users[1].user_id)
+        second.remove_participant(self.users[0].user_id)
+        second.coach = "c"
+        second.update()
+        assert Stats.for_user(self.users[1].user_id) == (2, 1)
+        assert Stats.for_training(first.training_id) == {"participants": 3, "women": 2, "men": 1, "guests": 1,
+                                                         "noshows": 1}
+        assert [g[:3] for g in Stats.for_groups("coach")] == [("c", 2, 5)]
+        assert [g[0] for g in Stats.for_groups("month")] == ["2020-09", "2020-10"]
+        incremental = self.snapshot()
+        assert Stats.rebuild()
+        assert self.snapshot() == incremental
+
+    def test_cancelled_trainings_dont_count(self):
+        first, second = self.trainings
+        first.add_participant(self.users[0].user_id, self.users[0])
+        first.cancelled = 1
+        first.update()
+        assert Stats.for_training(first.training_id) is None
+        assert Stats.for_user(self.users[0].user_id) == (0, 0)
+        assert [g[:2] for g in Stats.for_groups("location")] == [("x", 1)]
+        first.cancelled = 0
+        first.update()
+        assert Stats.for_user(self.users[0].user_id) == (1, 0)
+        incremental = self.snapshot()
+        Stats.rebuild()
+        assert self.snapshot() == incremental
+
+    def test_insert_after_cancel(self):
+        first, _ = self.trainings
+        first.add_participant(self.users[0].user_id, self.users[0])
+        first.cancelled = 1
+        first.update()
+        start = datetime(2020, 10, 3, 18)
+        third = Training(None, start, start + timedelta(hours=2), "y", "c", message_id=102)
+        third.training_id = third.insert()
+        assert Stats.for_training(first.training_id) is None
+        assert Stats.for_training(third.training_id) == {"participants": 0, "women": 0, "men": 0, "guests": 0,
+                                                         "noshows": 0}
+        incremental = self.snapshot()
+        Stats.rebuild()
+        assert self.snapshot() == incremental
+
+    def test_user_changes_between_add_and_remove(self):
+        first, second = self.trainings
+        guest = self.users[2]
+        first.add_participant(guest.user_id, guest)
+        second.add_participant(guest.user_id, guest)
+        guest.gender, guest.member_type = "m", "Mitglied"
+        guest.update()
+        first.remove_participant(guest.user_id)
+        second.cancelled = 1
+        second.update()
+        assert Stats.for_training(first.training_id) == {"participants": 0, "women": 0, "men": 0, "guests": 0,
+                                                         "noshows": 0}
+        assert [g[1:] for g in Stats.for_groups("location")] == [(1, 0, 0, 0, 0, 0)]
+        incremental = self.snapshot()
+        Stats.rebuild()
+        assert self.snapshot() == incremental
+
+
+    def test_changes_before_cancel_is_committed(self):
+        first, second = self.trainings
+        first.cancelled = 1
+        first.add_participant(self.users[0].user_id, self.users[0])
+        first.update()
+        second.cancelled = 1
+        second.update()
+        second.add_participant(self.users[1].user_id, self.users[1])
+        second.cancelled = 0
+        second.no_show(self.users[1].user_id)
+        second.update()
+        assert Stats.for_user(self.users[0].user_id) == (0, 0)
+        assert Stats.for_user(self.users[1].user_id) == (1, 1)
+        incremental = self.snapshot()
+        Stats.rebuild()
+        assert self.snapshot() == incremental
+
+
+if __name__ == '__main__':
+    unittest.main()
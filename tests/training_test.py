@@ -0,0 +1,85 @@
+import csv
+import gzip
+import io
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from muddi.database.db import DB
+from muddi.models import Stats, Training, User
+from muddi.utils.export import csv_buffer
+from tests import DatabaseTestCase
+
+
+class TestTraining(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [User(None, name, f"{name}#0001", i, "w") for i, name in enumerate(["b", "a", "c"], 1)]
+        for u in self.users:
+            u.user_id = u.insert()
+        start = datetime(2020, 9, 27, 18)
+        self.trainings = []
+        for i in range(3):
+            tr = Training(None, start + timedelta(days=i), start + timedelta(days=i, hours=2), "x", "c",
+                          message_id=100 + i)
+            tr.training_id = tr.insert()
+            self.trainings.append(tr)
+
+    def test_participants_in_registration_order(self):
+        tr = self.trainings[0]
+        for u in reversed(self.users):
+            assert tr.add_participant(u.user_id, u)
+        assert not tr.add_participant(self.users[0].user_id)
+        assert [u.name for u in Training.get_for_id(tr.training_id).participants] == ["c", "a", "b"]
+
+    def test_load_participants(self):
+        first, second, third = self.trainings
+        first.add_participant(self.users[0].user_id)
+        first.add_participant(self.users[1].user_id)
+        second.add_participant(self.users[2].user_id)
+        fresh = [Training.get_for_id(tr.training_id) for tr in self.trainings]
+        with mock.patch.object(DB, "select", autospec=True, side_effect=DB.select) as select:
+            Training.load_participants(fresh)
+            assert select.call_count == 1
+        assert [[u.name for u in tr.participants] for tr in fresh] == [["b", "a"], ["c"], []]
+        assert fresh[0].has_member(1) and not fresh[2].has_member(1)
+
+    def test_attendance(self):
+        first, second, third = self.trainings
+        first.add_participant(self.users[1].user_id)
+        first.add_participant(self.users[0].user_id)
+        third.add_participant(self.users[2].user_id)
+        rows = list(Training.attendance(training_ids=[third.training_id, first.training_id]))
+        assert [(r[0], r[5]) for r in rows] == [(1, "a"), (1, "b"), (3, "c")]
+        assert rows[0][-1] == 0
+        by_date = Training.attendance(since=datetime(2020, 9, 28), until=datetime(2020, 9, 30))
+        assert [r[5] for r in by_date] == ["c"]
+
+    def test_apply_reactions(self):
+        first, second, _ = self.trainings
+        guest = User(None, "guest", "", None, "m", "Gast")
+        guest.user_id = guest.insert()
+        first.add_participant(self.users[0].user_id)
+        first.add_participant(guest.user_id)
+        second.add_participant(self.users[1].user_id)
+        Training.load_participants([first, second])
+        # a reacted while offline, b took the reaction back, d is new. Guests have no reaction to compare.
+        changed = Training.apply_reactions([(first, {2: ("a", "a#0001"), 4: ("d", "d#0001")}),
+                                            (second, {2: ("a", "a#0001")})])
+        assert changed == [first]
+        assert [u.name for u in first.participants] == ["guest", "a", "d"]
+        assert [u.name for u in Training.get_for_id(first.training_id).participants] == ["guest", "a", "d"]
+        assert not first.has_member(1) and first.has_member(4)
+        assert Stats.for_training(first.training_id)["participants"] == 3
+
+    def test_csv_buffer(self):
+        rows = (("a", 1) for _ in range(3))
+        plain = csv_buffer(["name", "noshow"], rows).read().decode('UTF-8')
+        assert plain.splitlines() == ['"name","noshow"'] + ['"a",1'] * 3
+        compressed = csv_buffer(["name", "noshow"], [("a", 1)], compress=True)
+        assert list(csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=compressed), encoding='UTF-8'))) == \
+            [["name", "noshow"], ["a", "1"]]
+
+
+if __name__ == '__main__':
+    unittest.main()
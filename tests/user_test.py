@@ -0,0 +1,60 @@
+import unittest
+
+import muddi.spreadsheet as sh
+from muddi.models import User
+from tests import DatabaseTestCase, Member
+
+
+def row(name, tag="", gender="w", member_type=sh.EICHE):
+    return {sh.u_name: name, sh.discord_tag: tag, sh.gender: gender, sh.member_type: member_type}
+
+
+class TestUser(DatabaseTestCase):
+    def test_diff_sheet(self):
+        users = [User(1, "Anna", "anna#1234", gender="w", member_type=sh.EICHE),
+                 User(2, "Ben", gender="m", member_type=sh.GUEST)]
+        rows = [row("Anna", "anna#1234"), row("Benjamin", "ben#0001", "m"), row("Ben", gender="m"),
+                row("Cleo"), row("Cleo")]
+        changes = User.diff_sheet(rows, users)
+        assert [u.name for u in changes.inserts] == ["Benjamin", "Cleo"]
+        assert list(changes.updates) == [2]
+        assert changes.updates[2].member_type == sh.EICHE
+        assert changes.unchanged == 2
+
+    def test_update_from_sheet(self):
+        User(None, "Anna", "anna#1234", gender="m").insert()
+        changes = User.update_from_sheet([row("Anna", "anna#1234"), row("Ben", "ben#0001", "m")])
+        assert str(changes) == "1 inserted, 1 updated, 0 unchanged"
+        users = {u.name: u for u in User.get_all()}
+        assert users["Anna"].gender == "w"
+        assert users["Ben"].discord_tag == "ben#0001"
+        assert not User.update_from_sheet([row("Anna", "anna#1234"), row("Ben", "ben#0001", "m")])
+
+    def test_diff_discord_members(self):
+        users = [User(1, "Anna", "anna#1234"), User(2, "Ben", "ben#0001", 22), User(3, "Cleo", "cleo#0002", 33)]
+        members = [Member(11, "Anna", "anna#1234"), Member(22, "Ben", "benny#0001"), Member(33, "Cleo", "cleo#0002"),
+                   Member(44, "Dana", "dana#0003")]
+        changes = User.diff_discord_members(members, users)
+        assert changes.updates[1].discord_id == 11
+        assert changes.updates[2].discord_tag == "benny#0001"
+        assert [(u.name, u.discord_id) for u in changes.inserts] == [("Dana", 44)]
+        assert changes.unchanged == 1
+
+    def test_update_from_discord_members(self):
+        User(None, "Anna", "anna#1234").insert()
+        members = [Member(11, "Anna", "anna#1234"), Member(44, "Dana", "dana#0003")]
+        assert str(User.update_from_discord_members(members)) == "1 inserted, 1 updated, 0 unchanged"
+        assert User.get_for_discord_id_or_tag(11).name == "Anna"
+        assert not User.update_from_discord_members(members)
+
+    def test_update_from_member(self):
+        User(None, "Anna", "anna#1234").insert()
+        assert list(User.update_from_member(Member(11, "Anna", "anna#1234")).updates) == [1]
+        assert list(User.update_from_member(Member(11, "Anna", "anna#4321")).updates) == [1]
+        assert User.get_for_discord_id_or_tag(11).discord_tag == "anna#4321"
+        assert len(User.update_from_member(Member(44, "Dana", "dana#0003")).inserts) == 1
+        assert not User.update_from_member(Member(44, "Dana", "dana#0003"))
+
+
+if __name__ == '__main__':
+    unittest.main()